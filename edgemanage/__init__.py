@@ -4,6 +4,10 @@ import util
 from edgetest import *
 from edgelist import EdgeList
 from edgestate import EdgeState
-from decisionmaker import DecisionMaker
+from decisionmaker import DecisionMaker, get_decision_maker
 from statefile import StateFile
+from probeengine import get_probe_engine
+from probecache import ProbeCache
+from healthstore import get_health_store
 from edgemanage import EdgeManage
+from replay import Replay
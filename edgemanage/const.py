@@ -8,6 +8,9 @@ CONFIG_PATH = "/etc/edgemanage/edgemanage.yaml"
 FETCH_TIMEOUT = 10
 # Times to retry fetching an object if failed
 FETCH_RETRY = 3
+# Seconds to wait, at most, before retrying a connection to an edge.
+# Doubled for every retry after the first.
+RETRY_BACKOFF = 0.5
 
 # Number of objects to store in fetch histories
 FETCH_HISTORY = 2000
@@ -41,3 +44,88 @@ VALID_MODES = ["available", "force", "blindforce", "unavailable"]
 # decision being passed upon tests.
 VALID_HEALTHS = ["pass_threshold", "pass_window", "pass_average", "pass",
                  "fail"]
+
+# The healths that an edge can be made live in, best first. Edges are
+# chosen from each in turn.
+LIVE_HEALTHS = ["pass_threshold", "pass_window", "pass_average", "pass"]
+
+# Engines that can be selected with the probe_engine configuration
+# option to run edge tests.
+#  threads - run each fetch in a blocking worker thread
+#  eventloop - multiplex every fetch over non-blocking sockets on a
+#              single thread
+PROBE_ENGINES = ["threads", "eventloop"]
+
+# Default number of fetches the eventloop engine keeps in flight at once
+PROBE_CONCURRENCY = 1000
+
+# Number of threads the eventloop engine uses for (blocking) DNS lookups
+PROBE_RESOLVER_WORKERS = 4
+
+# Seconds between checks for completed DNS lookups in the eventloop engine
+PROBE_RESOLVE_INTERVAL = 0.01
+
+# Number of keep-alive connections held open to each edge between tests
+EDGE_POOL_SIZE = 2
+
+# Number of bytes of the test object read and hashed at a time
+FETCH_CHUNK_SIZE = 65536
+
+# Ways of testing an edge without transferring the whole test object
+#  None - always fetch and verify the whole object
+#  etag - revalidate with If-None-Match once the object has been
+#         verified, falling back to a full fetch if it has changed
+#  range - fetch and verify only the first RANGE_PROBE_SIZE bytes
+VALID_CONDITIONALS = [None, "etag", "range"]
+
+# Default number of bytes of the test object fetched by range probes
+RANGE_PROBE_SIZE = 4096
+
+# Phases of a fetch that are timed separately
+#  dns - resolving the name of the edge
+#  connect - TCP connection setup
+#  tls - TLS handshake
+#  ttfb - time from sending the request to receiving the response headers
+#  transfer - time spent receiving the body of the response
+PROBE_PHASES = ["dns", "connect", "tls", "ttfb", "transfer"]
+
+# Metrics that decisions can be made on. "fetch" is the fetch time as
+# recorded in the fetch_times of an edge, the rest are PROBE_PHASES.
+VALID_METRICS = ["fetch"] + PROBE_PHASES
+
+# Engines that can be selected with the decision_engine configuration
+# option to judge edges.
+#  python - judge each edge in turn
+#  numpy - judge every edge at once with array operations, if NumPy is
+#          installed
+DECISION_ENGINES = ["python", "numpy"]
+
+# Number of fetch times an edge needs before its fetches are hedged
+HEDGE_MIN_SAMPLES = 20
+
+# Seconds for which the result of testing an edge is reused by other
+# dnets managed by the same process
+PROBE_CACHE_AGE = 30
+
+# Ways of storing edge health data in healthdata_store
+#  json - a pretty-printed JSON .edgestore file per edge
+#  sqlite - every edge in one SQLite database, HEALTHDATA_DB
+HEALTHDATA_BACKENDS = ["json", "sqlite"]
+
+# Name of the database in healthdata_store used by the sqlite backend
+HEALTHDATA_DB = "edgestore.db"
+
+# Number of records - samples and rotations - appended to the sample
+# log of an edge before it is compacted into a fresh snapshot
+SAMPLE_LOG_COMPACT = 10000
+
+# Tiers of rollups of the fetch times of an edge, as (name, bucket
+# length in seconds, number of buckets kept)
+ROLLUP_TIERS = [("minute", 60, 60), ("hour", 3600, 168), ("day", 86400, 365)]
+
+# Percentiles estimated for each rollup bucket
+ROLLUP_QUANTILES = [50, 95, 99]
+
+# The period in seconds that dnschange_maxfreq limits the number of
+# rotations in, unless dnschange_period is set
+DNSCHANGE_PERIOD = 600
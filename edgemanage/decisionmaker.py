@@ -1,21 +1,122 @@
 import const
 
+import heapq
 import logging
 import time
 
+try:
+    import numpy
+except ImportError:
+    # NumPy is only needed by the numpy decision engine
+    numpy = None
+
+
+def get_decision_maker(config):
+    ''' Build a DecisionMaker for the decision_engine config option '''
+
+    engine_name = config.get("decision_engine", "python")
+    metric = config.get("decision_metric")
+    quantile = config.get("decision_quantile")
+    halflife = config.get("decision_halflife")
+    if engine_name == "python":
+        return DecisionMaker(metric, quantile, halflife)
+    elif engine_name == "numpy":
+        if numpy is None:
+            logging.warning("decision_engine is numpy but NumPy isn't installed - "
+                            "judging edges one by one instead")
+            return DecisionMaker(metric, quantile, halflife)
+        return VectorDecisionMaker(metric, quantile, halflife)
+    else:
+        raise ValueError("decision_engine must be one of %s, not %s" %
+                         (str(const.DECISION_ENGINES), engine_name))
+
 
 class DecisionMaker(object):
 
-    def __init__(self):
+    def __init__(self, metric=None, quantile=None, halflife=None):
+        '''
+         Judges edges on their samples. Judgements are kept from one
+         check_threshold to the next, and across reset(), and an edge
+         is only judged again once it has new samples - as noted by
+         add_edge_state - or the oldest sample in its time slice has
+         dropped out of it.
+
+         metric: the metric that edges are judged and ranked on, one of
+          VALID_METRICS. Defaults to the fetch time.
+         quantile: if set, judge and rank edges on this percentile of
+          the metric, rather than its mean, so that an edge that is
+          usually fast but often very slow isn't counted as fast.
+         halflife: if set, rank edges and judge them pass_average on an
+          exponentially weighted moving average of the metric with this
+          half-life in seconds, rather than its mean over the whole
+          history, so that an edge that has slowed down recently
+          isn't still ranked as fast.
+        '''
+        if metric is None:
+            metric = "fetch"
+        if metric not in const.VALID_METRICS:
+            raise ValueError("Metric must be one of %s, not %s" %
+                             (str(const.VALID_METRICS), metric))
+        if quantile is not None and not 0 < quantile <= 100:
+            raise ValueError("Quantile must be between 0 and 100, not %s" % quantile)
+        if halflife is not None and halflife <= 0:
+            raise ValueError("Half-life must be positive, not %s" % halflife)
+        if quantile is not None and halflife is not None:
+            raise ValueError("Edges can be judged on a quantile or a half-life, not both")
+        self.metric = metric
+        self.quantile = quantile
+        self.halflife = halflife
         self.edge_states = {}
         # A results dict with edge as key, string as value, one of
         # VALID_HEALTHS
         self.current_judgement = {}
         self.edges_disabled = False
+        # The number of edges in current_judgement with each health
+        self.judgement_counts = dict.fromkeys(const.VALID_HEALTHS, 0)
+        # Edges in edge_states that need to be judged
+        self.stale = set()
+        # edgename -> (sample_version, judgement, window expiry) as of
+        # the last time the edge was judged
+        self.judged = {}
+        # The good_enough that self.judged was judged against
+        self.good_enough = None
+        # A heap of (window expiry, edgename): when the oldest sample
+        # in the time slice of a judged edge drops out of it
+        self.window_expiries = []
+        # Where check_threshold gets the time from - a simulated clock
+        # when replaying old samples
+        self.clock = time.time
+
+    def reset(self):
+        '''Forget the edges and judgements of the last decision, keeping
+        what's needed to avoid judging unchanged edges again
+        '''
+        self.edge_states = {}
+        self.current_judgement = {}
+        self.edges_disabled = False
+        self.judgement_counts = dict.fromkeys(const.VALID_HEALTHS, 0)
+        self.stale = set()
 
     def add_edge_state(self, edge_state):
-        self.edge_states[edge_state.edgename] = edge_state
-        self.current_judgement[edge_state.edgename] = None
+        '''Add an edge to be judged - or note that an edge that has
+        already been added has new samples
+        '''
+        edgename = edge_state.edgename
+        self.edge_states[edgename] = edge_state
+        judged = self.judged.get(edgename)
+        if judged is not None and judged[0] == edge_state.sample_version:
+            self._set_judgement(edgename, judged[1])
+        else:
+            self._set_judgement(edgename, None)
+            self.stale.add(edgename)
+
+    def _set_judgement(self, edgename, judgement):
+        previous = self.current_judgement.get(edgename)
+        if previous is not None:
+            self.judgement_counts[previous] -= 1
+        self.current_judgement[edgename] = judgement
+        if judgement is not None:
+            self.judgement_counts[judgement] += 1
 
     def get_judgement(self, edgename):
         return self.current_judgement[edgename]
@@ -24,13 +125,43 @@ class DecisionMaker(object):
         return self.get_judgement(edgename) != "fail"
 
     def edge_average(self, edgename):
-        return self.edge_states[edgename].current_average()
+        return self.edge_states[edgename].current_average(self.metric)
+
+    def _history_score(self, edge_state):
+        '''The mean of the metric over the whole history of an edge - or
+        the quantile or EWMA of it, if judging on one
+        '''
+        if self.quantile is not None:
+            return edge_state.history_quantile(self.quantile, self.metric)
+        elif self.halflife is not None:
+            return edge_state.ewma(self.halflife, self.metric)
+        return edge_state.current_average(self.metric)
+
+    def edge_score(self, edgename):
+        ''' The value that edges are ranked on - lower is better '''
+        return self._history_score(self.edge_states[edgename])
+
+    def score_floor(self, edge_state, timestamp):
+        '''The lowest edge_score that an edge could have after one more
+        sample, taken at or before a timestamp - how well an edge that
+        is still being tested could be ranked
+        '''
+        with edge_state.lock:
+            series = edge_state.series(self.metric)
+            if self.quantile is not None:
+                return series.quantile_floor(self.quantile)
+            elif self.halflife is not None:
+                return series.ewma_floor(self.halflife, timestamp)
+            return series.average_floor()
 
     def check_threshold(self, good_enough):
 
         ''' Check fetch response times for being under the given
         threshold.
 
+        Only edges that have changed since they were last judged are
+        judged again. Returns the number of edges with each judgement.
+
         '''
 
         # dict for stats to return
@@ -43,53 +174,189 @@ class DecisionMaker(object):
             for edgename in self.edge_states:
                 results_dict["fail"] += 1
                 self.current_judgement[edgename] = "fail"
+            self.judgement_counts = dict(results_dict)
             logging.info("FAIL: %d edges have been disabled", results_dict["fail"])
             return results_dict
 
-        for edgename, edge_state in self.edge_states.iteritems():
-            time_slice = edge_state[time.time() - const.DECISION_SLICE_WINDOW:time.time()]
-            if time_slice:
-                time_slice_avg = sum(time_slice)/len(time_slice)
-                logging.debug("Analysing %s. Last val: %f, time slice: %f, average: %f",
-                              edgename, edge_state.last_value(), time_slice_avg,
-                              edge_state.current_average())
+        if good_enough != self.good_enough:
+            self.good_enough = good_enough
+            self.judged = {}
+            self.stale.update(self.edge_states)
+
+        now = self.clock()
+        while self.window_expiries and self.window_expiries[0][0] < now:
+            expiry, edgename = heapq.heappop(self.window_expiries)
+            judged = self.judged.get(edgename)
+            # Skip expiries of judgements that have since been replaced
+            if judged is not None and judged[2] == expiry:
+                del(self.judged[edgename])
+                if edgename in self.edge_states:
+                    self.stale.add(edgename)
+
+        if self.stale:
+            slice_start = now - const.DECISION_SLICE_WINDOW
+            sample_versions = dict((stale_edge, self.edge_states[stale_edge].sample_version)
+                                   for stale_edge in self.stale)
+            judgements = self._judge_edges(good_enough, list(self.stale), slice_start)
+            for edgename, judgement in judgements.iteritems():
+                expiry = self.edge_states[edgename].window_oldest(slice_start, self.metric)
+                if expiry is not None:
+                    expiry += const.DECISION_SLICE_WINDOW
+                    heapq.heappush(self.window_expiries, (expiry, edgename))
+                self.judged[edgename] = (sample_versions[edgename], judgement, expiry)
+                self._set_judgement(edgename, judgement)
+            self.stale = set()
+
+        results_dict.update(self.judgement_counts)
+        return results_dict
+
+    def _judge_edges(self, good_enough, edgenames, slice_start):
+        '''Judge edges on their samples, returning a dict of edgename to
+        judgement
+        '''
+        judgements = {}
+        for edgename in edgenames:
+            edge_state = self.edge_states[edgename]
+            slice_count, time_slice_avg = edge_state.window_average(slice_start, self.metric)
+            last_value = edge_state.last_value(self.metric)
+            average = self._history_score(edge_state)
+            if self.quantile is not None and slice_count:
+                # Judge the window on its tail instead of its mean too
+                time_slice_avg = edge_state.window_quantile(slice_start, self.quantile,
+                                                            self.metric)
+            if slice_count:
+                logging.debug("Analysing %s %s. Last val: %f, time slice: %f, average: %f",
+                              edgename, self.metric, last_value, time_slice_avg, average)
             else:
-                time_slice_avg = None
-                logging.debug("Analysing %s. Last val: %f, time slice: Not enough data, "
-                              "average: %f",
-                              edgename, edge_state.last_value(), edge_state.current_average())
-
-            if edge_state.last_value() < good_enough:
-                self.current_judgement[edgename] = "pass_threshold"
-                results_dict["pass_threshold"] += 1
+                logging.debug("Analysing %s %s. Last val: %f, time slice: Not enough data, "
+                              "average: %f", edgename, self.metric, last_value, average)
+
+            if last_value < good_enough:
+                judgements[edgename] = "pass_threshold"
                 logging.info("PASS: Last fetch for %s is under the good_enough threshold "
-                             "(%f < %f)", edgename, edge_state.last_value(), good_enough)
-            elif edge_state.last_value() == const.FETCH_TIMEOUT:
+                             "(%f < %f)", edgename, last_value, good_enough)
+            elif last_value == const.FETCH_TIMEOUT:
                 # FETCH_TIMEOUT must be checked before the average measurements. An edge
                 # whose most recent fetch has failed should be marked as fail even if
                 # the average value is still passing.
-                self.current_judgement[edgename] = "fail"
-                results_dict["fail"] += 1
+                judgements[edgename] = "fail"
                 logging.info(("FAIL: Fetch time for %s is equal to the FETCH_TIMEOUT of %d. "
                               "Automatic fail"),
                              edgename, const.FETCH_TIMEOUT)
-            elif time_slice and time_slice_avg < good_enough:
-                self.current_judgement[edgename] = "pass_window"
-                results_dict["pass_window"] += 1
+            elif slice_count and time_slice_avg < good_enough:
+                judgements[edgename] = "pass_window"
                 logging.info("UNSURE: Last fetch for %s is NOT under the good_enough threshold "
                              "but the average of the last %d items is (%f < %f)",
-                             edgename, len(time_slice), time_slice_avg, good_enough)
-            elif edge_state.current_average() < good_enough:
-                self.current_judgement[edgename] = "pass_average"
-                results_dict["pass_average"] += 1
+                             edgename, slice_count, time_slice_avg, good_enough)
+            elif average < good_enough:
+                judgements[edgename] = "pass_average"
                 logging.info("UNSURE: Last fetch for %s is NOT under the good_enough threshold "
                              "but under the average (%f < %f)",
-                             edgename, edge_state.current_average(), good_enough)
+                             edgename, average, good_enough)
             else:
-                self.current_judgement[edgename] = "pass"
-                results_dict["pass"] += 1
+                judgements[edgename] = "pass"
                 logging.info("PASS: Last fetch for %s is not under the good_enough threshold "
                              "but is passing (%f < %f)", edgename,
-                             edge_state.last_value(), const.FETCH_TIMEOUT)
+                             last_value, const.FETCH_TIMEOUT)
+        return judgements
 
-        return results_dict
+
+class VectorDecisionMaker(DecisionMaker):
+
+    # The judgements made by _judge_edges, in the order they're checked
+    JUDGEMENTS = ["pass_threshold", "fail", "pass_window", "pass_average", "pass"]
+
+    def __init__(self, metric=None, quantile=None, halflife=None):
+        '''A DecisionMaker that judges every edge at once. The samples
+        of all the edges are laid out as a 2-D array, and the last
+        value, window and overall averages and judgement of each edge
+        are worked out with array operations, rather than edge by edge.
+        Judgements are the same as DecisionMaker's. Requires NumPy.
+
+        '''
+        super(VectorDecisionMaker, self).__init__(metric, quantile, halflife)
+        # edgename -> edge_score as of the last time the edge was judged
+        self.scores = {}
+
+    def edge_score(self, edgename):
+        if edgename in self.scores and edgename not in self.stale:
+            return self.scores[edgename]
+        return super(VectorDecisionMaker, self).edge_score(edgename)
+
+    def _sample_arrays(self, edgenames, slice_start):
+        '''Lay out the samples of the metric of each edge as a row of 2-D
+        arrays of timestamps and values, padded with timestamps of -inf
+        and values of 0. Also returns arrays of the number of samples
+        and last value of each edge, and, if judging on a quantile, the
+        quantiles of its window, and if judging on a quantile or a
+        half-life, the _history_score of each edge.
+
+        '''
+        rows = len(edgenames)
+        width = max([len(self.edge_states[edgename].series(self.metric))
+                     for edgename in edgenames])
+        times = numpy.full((rows, width), -numpy.inf)
+        values = numpy.zeros((rows, width))
+        lengths = numpy.zeros(rows)
+        last_values = numpy.zeros(rows)
+        window_quantiles = numpy.full(rows, numpy.nan)
+        history_scores = numpy.full(rows, numpy.nan)
+        for row, edgename in enumerate(edgenames):
+            edge_state = self.edge_states[edgename]
+            # Values may be added by another thread while we're copying
+            with edge_state.lock:
+                series = edge_state.series(self.metric)
+                length = len(series)
+                if not length:
+                    continue
+                times[row, :length] = numpy.frombuffer(series.times, dtype=numpy.float64)
+                values[row, :length] = numpy.frombuffer(series.values, dtype=numpy.float64)
+                lengths[row] = length
+                last_values[row] = series.last()
+                if self.quantile is not None:
+                    window_quantile = edge_state.window_quantile(slice_start, self.quantile,
+                                                                 self.metric)
+                    if window_quantile is not None:
+                        window_quantiles[row] = window_quantile
+                if self.quantile is not None or self.halflife is not None:
+                    history_scores[row] = self._history_score(edge_state)
+        return times, values, lengths, last_values, window_quantiles, history_scores
+
+    def _judge_edges(self, good_enough, edgenames, slice_start):
+        (times, values, lengths, last_values,
+         window_quantiles, history_scores) = self._sample_arrays(edgenames, slice_start)
+
+        in_window = times >= slice_start
+        slice_counts = in_window.sum(axis=1)
+        if self.quantile is None:
+            slice_values = (values * in_window).sum(axis=1) / numpy.maximum(slice_counts, 1)
+        else:
+            slice_values = window_quantiles
+        if self.quantile is None and self.halflife is None:
+            history_values = values.sum(axis=1) / numpy.maximum(lengths, 1)
+        else:
+            history_values = history_scores
+
+        # The same checks as DecisionMaker, with the first that holds
+        # deciding the judgement
+        judgements = numpy.select([last_values < good_enough,
+                                   last_values == const.FETCH_TIMEOUT,
+                                   (slice_counts > 0) & (slice_values < good_enough),
+                                   history_values < good_enough],
+                                  range(len(self.JUDGEMENTS) - 1),
+                                  default=len(self.JUDGEMENTS) - 1)
+
+        judgement_counts = numpy.bincount(judgements, minlength=len(self.JUDGEMENTS))
+        judgements = dict(zip(edgenames, [self.JUDGEMENTS[index] for index in judgements]))
+        self.scores.update(zip(edgenames, history_values.tolist()))
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for row, edgename in enumerate(edgenames):
+                logging.debug("Judged %s on %s as %s. Last val: %f, time slice of %d: %f, "
+                              "overall: %f", edgename, self.metric, judgements[edgename],
+                              last_values[row], slice_counts[row], slice_values[row],
+                              history_values[row])
+        logging.info("Judged %d edges on %s: %s", len(edgenames), self.metric,
+                     ", ".join(["%d %s" % (count, judgement) for judgement, count
+                                in zip(self.JUDGEMENTS, judgement_counts)]))
+        return judgements
@@ -1,41 +1,22 @@
 #!/usr/bin/env python
 
-from .edgetest import EdgeTest, VerifyFailed, FetchFailed
-from .edgestate import EdgeState
-from .decisionmaker import DecisionMaker
+from .edgetest import EdgeTest, failed_phase_times
+from .decisionmaker import get_decision_maker
 from .edgelist import EdgeList
+from .probeengine import get_probe_engine, ProbeScheduler
+from .probecache import ProbeCache
+from .healthstore import get_health_store
 import const
 
-from concurrent.futures import ThreadPoolExecutor, as_completed, CancelledError
-import itertools
+from concurrent.futures import as_completed
 import glob
-import traceback
 import hashlib
+import heapq
 import logging
+import math
 import os
-
-
-def future_fetch(edgetest, testobject_host, testobject_path,
-                 testobject_proto, testobject_port, testobject_verify):
-    """Helper function to give us a return value that plays nice with as_completed"""
-
-    fetch_status = None
-    try:
-        fetch_result = edgetest.fetch(testobject_host, testobject_path,
-                                      testobject_proto, testobject_port,
-                                      testobject_verify)
-    except VerifyFailed:
-        # Ensure that we don't use hosts where verification has failed
-        fetch_result = const.FETCH_TIMEOUT
-        fetch_status = "verify_failed"
-    except FetchFailed:
-        # Ensure that we don't use hosts where fetching the object has
-        # caused a HTTP error
-        fetch_result = const.FETCH_TIMEOUT
-        fetch_status = "fetch_failed"
-    except Exception:
-        logging.error("Uncaught exception in fetch! %s", traceback.format_exc())
-    return {edgetest.edgename: (fetch_result, fetch_status)}
+import random
+import time
 
 
 class EdgeManage(object):
@@ -45,29 +26,79 @@ class EdgeManage(object):
         self.edgelist_obj = EdgeList()
         # Object we will use to make a decision about edge liveness based
         # on the stat stores
-        self.decision = DecisionMaker()
+        self.decision = get_decision_maker(self.config)
         self.canary_decision = None
 
         if self.canary_data:
             # Because we treat the behaviour of canaries differently
             # let's ringfence them here.
-            self.canary_decision = DecisionMaker()
+            self.canary_decision = get_decision_maker(self.config)
 
         self.edge_states = {}
+        # mtimes of the edge list files that edge_states were set from,
+        # kept by the caller so that unchanged lists aren't re-read
+        self.edgelist_mtimes = None
 
-        self.testobject_hash = self.get_testobject_hash()
+        self.testobject_mtime = None
+        self.refresh_testobject()
         self.current_mtimes = self.zone_mtime_setup()
 
-    def get_testobject_hash(self):
-        # Hash the local copy of the object to be requested from the edges
-        with open(self.config["testobject"]["local"]) as test_local_f:
-            testobject_hash = hashlib.md5(test_local_f.read()).hexdigest()
-            logging.info("Hash of local object %s is %s",
-                         self.config["testobject"]["local"], testobject_hash)
+    def prepare_run(self):
+        '''Get an EdgeManage kept from one run to the next ready for
+        another: start a new edge list and new judgements, and pick up
+        whatever has changed on disk since the last run.
+
+        '''
+        self.edgelist_obj = EdgeList()
+        self.decision.reset()
+        if self.canary_decision:
+            self.canary_decision.reset()
+        self.refresh_testobject()
+        self.current_mtimes = self.zone_mtime_setup()
+        for edge_state in self.edge_states.values():
+            edge_state.refresh()
 
-        return testobject_hash
+    def refresh_testobject(self):
+        '''Hash the local copy of the test object, if it has changed
+        since it was last hashed
+        '''
+        testobject_mtime = os.stat(self.config["testobject"]["local"]).st_mtime
+        if testobject_mtime == self.testobject_mtime:
+            return
+        (self.testobject_hash, self.testobject_size,
+         self.testobject_range_hash) = self.hash_testobject()
+        self.testobject_mtime = testobject_mtime
+
+    def hash_testobject(self):
+        '''Hash the local copy of the object to be requested from the
+        edges. Returns a tuple of the hash, the size of the object and
+        the hash of its first range_size bytes (None unless range
+        probes are in use).
 
-    def __init__(self, dnet, config, state, canary_data={}, dry_run=False):
+        '''
+        test_dict = self.config["testobject"]
+        range_size = test_dict.get("range_size", const.RANGE_PROBE_SIZE)
+        testobject_hash = hashlib.md5()
+        range_hash = None
+        if test_dict.get("conditional") == "range":
+            range_hash = hashlib.md5()
+        testobject_size = 0
+
+        with open(test_dict["local"], "rb") as test_local_f:
+            for chunk in iter(lambda: test_local_f.read(const.FETCH_CHUNK_SIZE), ""):
+                testobject_hash.update(chunk)
+                if range_hash and testobject_size < range_size:
+                    range_hash.update(chunk[:range_size - testobject_size])
+                testobject_size += len(chunk)
+
+        logging.info("Hash of local object %s is %s",
+                     test_dict["local"], testobject_hash.hexdigest())
+        if range_hash:
+            range_hash = range_hash.hexdigest()
+        return testobject_hash.hexdigest(), testobject_size, range_hash
+
+    def __init__(self, dnet, config, state, canary_data={}, dry_run=False,
+                 edgetests=None, probe_engine=None, probe_cache=None):
         '''
          Upper-level edgemanage object that is used to create
         lower-level edgemanage objects and accomplish the overall task
@@ -78,6 +109,12 @@ class EdgeManage(object):
          config: configuration dictionary
          state: state object
          canary_data: per-site canary site->canary_ip dict
+         edgetests: edgename->EdgeTest dict, kept by the caller between
+          runs so that connections to the edges can be reused
+         probe_engine: a probe engine shared with other dnets. If None,
+          an engine is set up for each run of edge tests
+         probe_cache: a ProbeCache shared with other dnets, so that
+          edges in more than one dnet are only tested once
 
         '''
 
@@ -87,6 +124,16 @@ class EdgeManage(object):
         self.state_obj = state
 
         self.canary_data = canary_data
+        # The canary IPs, for checking whether an edge is a canary
+        self.canary_edges = frozenset(canary_data.values())
+        if edgetests is None:
+            edgetests = {}
+        self.edgetests = edgetests
+        self.probe_engine = probe_engine
+        if probe_cache is None:
+            probe_cache = ProbeCache()
+        self.probe_cache = probe_cache
+        self.health_store = get_health_store(config)
 
         self._init_objects()
 
@@ -101,8 +148,12 @@ class EdgeManage(object):
         return current_mtimes
 
     def add_edge_state(self, edge, edge_healthdata_path, nowrite=False):
+        # Edge states are written out together by flush_edge_states
+        # rather than every time they change
         try:
-            edge_state = EdgeState(edge, edge_healthdata_path, nowrite=nowrite)
+            edge_state = self.probe_cache.edge_state(edge, edge_healthdata_path,
+                                                     nowrite=nowrite, defer_writes=True,
+                                                     store=self.health_store)
         except ValueError as exc:
             logging.error("Failed to load edgestate file for %s: %s", edge, str(exc))
 
@@ -110,13 +161,96 @@ class EdgeManage(object):
         self.edge_states[edge] = edge_state
         return True
 
-    def check_canary_kill_treshhold(self, canary_futures):
+    def set_edges(self, edges, edge_healthdata_path, nowrite=False):
+        '''Manage exactly the given edges, loading the states of edges
+        that are new since the last call and dropping those of edges
+        that are no longer there
+
+        '''
+        for edge in set(self.edge_states) - set(edges):
+            logging.info("No longer managing edge %s", edge)
+            self.edge_states.pop(edge).flush()
+        for edge in edges:
+            if edge not in self.edge_states:
+                self.add_edge_state(edge, edge_healthdata_path, nowrite)
+
+    def get_edgetest(self, edgename):
+        ''' Get the EdgeTest for an edge, reusing one from a previous run if we can '''
+        test_dict = self.config["testobject"]
+        edge_t = self.edgetests.get(edgename)
+        if edge_t is None:
+            edge_t = EdgeTest(edgename, self.testobject_hash,
+                              self.config.get("edge_pool_size", const.EDGE_POOL_SIZE),
+                              local_size=self.testobject_size,
+                              conditional=test_dict.get("conditional"),
+                              range_size=test_dict.get("range_size", const.RANGE_PROBE_SIZE),
+                              range_sum=self.testobject_range_hash)
+            self.edgetests[edgename] = edge_t
+        else:
+            # The local copy of the object may have changed since last run
+            edge_t.set_local_object(self.testobject_hash, self.testobject_size,
+                                    self.testobject_range_hash)
+        return edge_t
+
+    def prune_edgetests(self):
+        ''' Close connections to edges that are no longer being tested '''
+        for edgename in list(self.edgetests):
+            if edgename not in self.edge_states:
+                logging.debug("Closing connections to %s as it is no longer tested", edgename)
+                self.edgetests.pop(edgename).close()
+
+    def hedge_delay(self, edgename):
+        '''Seconds after which to send a hedged request to an edge - the
+        hedge_percentile of its fetch times - or None if fetches to it
+        shouldn't be hedged.
+
+        '''
+        hedge_percentile = self.config.get("hedge_percentile")
+        edge_state = self.edge_states[edgename]
+        if not hedge_percentile or len(edge_state) < const.HEDGE_MIN_SAMPLES:
+            return None
+        delay = edge_state.percentile(hedge_percentile)
+        if delay >= const.FETCH_TIMEOUT:
+            # The fetch would time out before the hedge had a chance
+            return None
+        return delay
+
+    def probe_offsets(self):
+        '''Seconds to wait before testing each edge, spreading the tests
+        evenly over probe_spread seconds rather than sending them all
+        at once. Each edge keeps its slot from run to run, and is
+        tested at a random point within it.
+
+        '''
+        spread = self.config.get("probe_spread")
+        if not spread or not self.edge_states:
+            return dict.fromkeys(self.edge_states, 0)
+
+        ordered_edges = sorted(self.edge_states,
+                               key=lambda edgename: hashlib.md5(edgename).hexdigest())
+        slot = float(spread) / len(ordered_edges)
+        return dict([(edgename, (index + random.random()) * slot)
+                     for index, edgename in enumerate(ordered_edges)])
+
+    def canary_result(self, edge, probe_scheduler, owned_probes):
+        '''Check the canary kill threshold after a result for an edge has
+        been recorded, if the edge is a canary and the canaries can
+        still be killed
+        '''
+        if (edge in self.canary_edges and self.config["canary_killer"] and
+                not self.canary_decision.edges_disabled):
+            self.check_canary_kill_treshhold(probe_scheduler, owned_probes)
+
+    def check_canary_kill_treshhold(self, probe_scheduler, owned_probes):
         """
         Cancel canary tests and disable all canaries if too many are failing.
 
         All canary tests which have not run already are canceled and their
         result time will be set to the FETCH_TIMEOUT value. All finished
         canary tests will be failed in DecisionMaker when `edges_disabled` is True.
+
+        The canary decision maker keeps count of its judgements, only
+        judging canaries with new results, so this is O(1) per result.
         """
         canary_stats = self.canary_decision.check_threshold(self.config["goodenough"])
 
@@ -124,17 +258,40 @@ class EdgeManage(object):
         if canary_stats["fail"] >= self.config["canary_killer"]:
             self.canary_decision.edges_disabled = True
 
-            cancelled = [future.cancel() for future in canary_futures]
-            logging.info("Hit canary kill limit! canceled %d / %d queued canary tests.",
-                         cancelled.count(True), len(cancelled))
+            if probe_scheduler is None:
+                logging.info("Hit canary kill limit! Disabling all canaries.")
+            else:
+                cancelled, total = probe_scheduler.cancel(self.canary_edges)
+                logging.info("Hit canary kill limit! canceled %d / %d queued canary tests.",
+                             cancelled, total)
 
             # Set every untested canary as TIMEOUT when we disable them.
-            for untested_edge in [edge for edge in self.canary_data.values() if
+            for untested_edge in [edge for edge in self.canary_edges if
                                   edge not in self.canary_decision.edge_states]:
-                self.edge_states[untested_edge].add_value(const.FETCH_TIMEOUT)
+                # Canaries being tested by another dnet get their
+                # result recorded there
+                if untested_edge in owned_probes:
+                    self.edge_states[untested_edge].add_value(const.FETCH_TIMEOUT)
+                    self.probe_cache.publish(untested_edge, owned_probes.pop(untested_edge),
+                                             const.FETCH_TIMEOUT, None, failed_phase_times())
                 self.canary_decision.add_edge_state(self.edge_states[untested_edge])
 
-    def do_edge_tests(self):
+    def do_edge_tests(self, on_live_edge_failing=None, on_decided=None):
+        '''Test every edge, recording the results and handing the edges
+        to their decision makers. Returns the edges that failed
+        verification.
+
+        Args:
+         on_live_edge_failing: called with the name of any edge that
+          was live as of the last decision and has now failed a test
+         on_decided: called, at most once, as soon as decision_settled
+          finds that the results still to come can't change which
+          edges make_edges_live would choose, so that the decision can
+          be made without waiting for the slowest edges. Their results
+          are still recorded once they arrive, and judged once they all
+          have.
+
+        '''
         test_dict = self.config["testobject"]
         test_host = test_dict["host"]
         test_path = test_dict["uri"]
@@ -145,39 +302,43 @@ class EdgeManage(object):
             # Allow FETCH_TIMEOUT to be overridden in TESTING mode.
             const.FETCH_TIMEOUT = self.config.get("timeout") or const.FETCH_TIMEOUT
 
-        edgescore_futures = []
-        canary_futures = []
         verification_failues = []
-        with ThreadPoolExecutor(max_workers=self.config["workers"]) as executor:
+        decided = on_decided is None
+        # Edges tested after on_decided was called
+        late_edges = []
+        # edgename -> ProbeCache Future for the edges this dnet tests
+        owned_probes = {}
+        # ProbeCache Future -> edgename for edges tested by other dnets
+        shared_probes = {}
+        probe_engine = self.probe_engine
+        if probe_engine is None:
+            probe_engine = get_probe_engine(self.config)
+        retry = self.config.get("retry", const.FETCH_RETRY)
+        retry_backoff = self.config.get("retry_backoff", const.RETRY_BACKOFF)
+        # Every edge is started by then
+        spread_end = time.time() + (self.config.get("probe_spread") or 0)
+        try:
+            probe_scheduler = ProbeScheduler(probe_engine, retry, retry_backoff)
+            probe_offsets = self.probe_offsets()
             for edgename in self.edge_states:
                 # Send raw IP as the host header when in the testing environment
                 if self.config.get("testing"):
                     test_host = edgename
 
-                edge_t = EdgeTest(edgename, self.testobject_hash)
-                edgetest_future = executor.submit(future_fetch,
-                                                  edge_t, test_host,
-                                                  test_path,
-                                                  test_proto,
-                                                  test_port,
-                                                  test_verify)
-
-                # Check if the current edge is a canary edge
-                if edgename not in self.canary_data.values():
-                    edgescore_futures.append(edgetest_future)
+                edge_t = self.get_edgetest(edgename)
+                fetch_args = (test_host, test_path, test_proto, test_port, test_verify)
+                probe_future, owner = self.probe_cache.claim(edge_t, fetch_args)
+                if owner:
+                    owned_probes[edgename] = probe_future
+                    probe_scheduler.add(edge_t, *fetch_args,
+                                        hedge_delay=self.hedge_delay(edgename),
+                                        start_delay=probe_offsets[edgename])
                 else:
-                    canary_futures.append(edgetest_future)
-
-            # Iterate over the results of both Futures lists
-            for f in as_completed(itertools.chain(edgescore_futures, canary_futures)):
-                try:
-                    result = f.result()
-                except CancelledError:
-                    # Do not try and process canceled edge tests
-                    continue
+                    shared_probes[probe_future] = edgename
 
-                edge, value = result.items()[0]
-                fetch_result, fetch_status = value
+            # Cancelled edge tests never show up here
+            for edge_t, fetch_result, fetch_status in probe_scheduler.results():
+                edge = edge_t.edgename
 
                 if fetch_status == "verify_failed":
                     verification_failues.append(edge)
@@ -189,30 +350,130 @@ class EdgeManage(object):
                                   "file corrupt?", edge)
                     continue
 
-                self.edge_states[edge].add_value(fetch_result)
-                logging.info("Fetch time for %s: %f avg: %f",
-                             edge, fetch_result,
-                             self.edge_states[edge].current_average())
-
-                # Skip edges that we have forced out of commission
-                if self.edge_states[edge].mode == "unavailable":
-                    logging.debug("Skipping edge %s as its status has been set to unavailable",
-                                  edge)
-                else:
-                    # otherwise add it to the appropriate decision maker
-                    if edge in self.canary_data.values():
-                        self.canary_decision.add_edge_state(self.edge_states[edge])
-                    elif edge in self.edge_states:
-                        self.decision.add_edge_state(self.edge_states[edge])
+                self.record_result(edge, fetch_result, edge_t.phase_times)
+                if on_decided and decided:
+                    late_edges.append(edge)
+                if on_live_edge_failing and self.live_edge_failing(edge, fetch_status):
+                    on_live_edge_failing(edge)
+                # Only now that the sample is in the EdgeState can other
+                # dnets use it. Canaries that were still being tested
+                # when the canary killer struck have already had a
+                # timeout published.
+                probe_future = owned_probes.pop(edge, None)
+                if probe_future is not None:
+                    self.probe_cache.publish(edge, probe_future, fetch_result,
+                                             fetch_status, edge_t.phase_times)
 
                 # Hard-kill the remaining canary tests if too many are failing. This
                 # also disables any canaries which have already been successfully tested.
-                if self.canary_data:
-                    if self.config["canary_killer"] and not self.canary_decision.edges_disabled:
-                        self.check_canary_kill_treshhold(canary_futures)
+                self.canary_result(edge, probe_scheduler, owned_probes)
+
+                if not decided and self.decision_settled(
+                        self.results_deadline(probe_engine, probe_scheduler, spread_end)):
+                    decided = True
+                    on_decided()
+
+            for probe_future in as_completed(shared_probes):
+                edge = shared_probes[probe_future]
+                shared_result = probe_future.result()
+                if shared_result is None:
+                    logging.warning("The dnet testing %s gave up on it, leaving it untested",
+                                    edge)
+                    continue
 
+                fetch_result, fetch_status, phase_times = shared_result
+                if fetch_status == "verify_failed":
+                    verification_failues.append(edge)
+                self.record_result(edge, fetch_result, phase_times, new_sample=False)
+                if on_decided and decided:
+                    late_edges.append(edge)
+                if on_live_edge_failing and self.live_edge_failing(edge, fetch_status):
+                    on_live_edge_failing(edge)
+
+                self.canary_result(edge, probe_scheduler, owned_probes)
+
+                if not decided and self.decision_settled(
+                        self.results_deadline(probe_engine, probe_scheduler, spread_end)):
+                    decided = True
+                    on_decided()
+        finally:
+            # Don't leave other dnets waiting on tests that never finished
+            for edge, probe_future in owned_probes.items():
+                self.probe_cache.abandon(edge, probe_future)
+            if self.probe_engine is None:
+                probe_engine.shutdown()
+
+        if late_edges:
+            self.judge_late_results(late_edges)
+        self.prune_edgetests()
         return verification_failues
 
+    def use_latest_results(self):
+        '''Hand every edge to its decision maker based on the results of
+        the tests last run on it, wherever they were run, instead of
+        testing the edges now. Returns the edges that failed
+        verification.
+
+        '''
+        verification_failues = []
+        for edge in self.edge_states:
+            latest_result = self.probe_cache.latest(edge)
+            if latest_result is None:
+                logging.debug("Not deciding on %s as it hasn't been tested yet", edge)
+                continue
+
+            fetch_result, fetch_status, phase_times = latest_result
+            if fetch_status == "verify_failed":
+                verification_failues.append(edge)
+            self.record_result(edge, fetch_result, phase_times, new_sample=False)
+
+        if self.canary_data:
+            if self.config["canary_killer"] and not self.canary_decision.edges_disabled:
+                self.check_canary_kill_treshhold(None, {})
+        return verification_failues
+
+    def live_edge_failing(self, edge, fetch_status):
+        '''Whether an edge that was made live and judged healthy by the
+        last decision has just failed a test, and so would no longer be
+        kept live
+
+        '''
+        if (edge not in self.state_obj.last_live or
+                self.edge_states[edge].health not in const.LIVE_HEALTHS):
+            return False
+        return (fetch_status == "verify_failed" or
+                self.edge_states[edge].last_value(self.decision.metric) >=
+                self.config["goodenough"])
+
+    def record_result(self, edge, fetch_result, phase_times, new_sample=True):
+        '''Record the result of testing an edge and hand the edge to the
+        appropriate decision maker.
+
+        Args:
+         new_sample: False if the result was shared by another dnet,
+          which has already added it to the EdgeState
+
+        '''
+        if new_sample:
+            self.edge_states[edge].add_value(fetch_result, phase_times=phase_times)
+        logging.info("Fetch time for %s: %f avg: %f",
+                     edge, fetch_result,
+                     self.edge_states[edge].current_average())
+        logging.debug("Phase times for %s: %s", edge,
+                      ", ".join(["%s %f" % (phase, phase_times[phase])
+                                 for phase in const.PROBE_PHASES]))
+
+        # Skip edges that we have forced out of commission
+        if self.edge_states[edge].mode == "unavailable":
+            logging.debug("Skipping edge %s as its status has been set to unavailable",
+                          edge)
+        else:
+            # otherwise add it to the appropriate decision maker
+            if edge in self.canary_edges:
+                self.canary_decision.add_edge_state(self.edge_states[edge])
+            elif edge in self.edge_states:
+                self.decision.add_edge_state(self.edge_states[edge])
+
     def check_last_live(self):
         """
         A list of edges that were in use last time that are still
@@ -254,27 +515,115 @@ class EdgeManage(object):
 
         return list(set(still_healthy))
 
-    def get_fastest_edges_by_state(self, edge_list, state, desired_count):
-        """
-        Get the top `desired_count` fastest edges with the specified state
-        """
-        edges_in_state = [edge for edge in edge_list
-                          if self.decision.get_judgement(edge) == state]
+    def rank_candidates(self, edge_list, count):
+        '''Rank edges for being made live, best first: by the order of
+        their health in LIVE_HEALTHS, then by their edge score, with
+        ties left in the order of edge_list. Returns the top count as
+        (edgename, health, score) tuples - or all of them if count is
+        negative.
 
-        # Sort the list of edges with specified state
-        edge_list = sorted(edges_in_state,
-                           key=lambda edge: self.decision.edge_average(edge))
+        '''
+        health_ranks = dict((health, index) for index, health in enumerate(const.LIVE_HEALTHS))
+        candidates = []
+        for edge in edge_list:
+            health = self.decision.get_judgement(edge)
+            if health in health_ranks:
+                candidates.append((edge, health, self.decision.edge_score(edge)))
+
+        def rank(candidate):
+            return health_ranks[candidate[1]], candidate[2]
+
+        if count < 0:
+            return sorted(candidates, key=rank)
+        # heapq.nsmallest is equivalent to sorting and slicing, but only
+        # keeps count candidates in order
+        return heapq.nsmallest(count, candidates, key=rank)
+
+    def required_edge_count(self):
+        ''' The number of edges to make live in this dnet '''
+        return self.config["dnet_edge_count"].get(self.dnet, self.config["edge_count"])
+
+    def results_deadline(self, probe_engine, probe_scheduler, spread_end):
+        '''The time by which every edge still being tested will have a
+        result, however many times it's retried. The fetches on the
+        probe engine - other dnets' included - and the edges waiting to
+        be started or retried are taken to run concurrency at a time,
+        each holding on to its place for every attempt at it, from
+        spread_end at the earliest.
 
-        logging.debug("Sorted %s edges: %s", state, edge_list)
+        '''
+        retry = self.config.get("retry", const.FETCH_RETRY)
+        retry_backoff = self.config.get("retry_backoff", const.RETRY_BACKOFF)
+        pending = probe_engine.outstanding() + probe_scheduler.waiting()
+        rounds = max(1, int(math.ceil(float(pending) / probe_engine.concurrency)))
+        return (max(time.time(), spread_end) +
+                rounds * ((retry + 1) * const.FETCH_TIMEOUT + retry_backoff * 2 ** retry))
+
+    def decision_settled(self, results_deadline):
+        '''Whether make_edges_live would choose the same edges now as
+        once every edge still being tested has a result: either the
+        edges that were live have all passed the good_enough threshold
+        again, or enough other edges have that none of the untested
+        edges could be ranked ahead of them, whatever their results.
+        Untested edges that were live, that are forced live or that are
+        canaries are always waited for.
 
-        choosen_edges = []
-        for edge in edge_list:
-            if len(choosen_edges) == desired_count:
-                logging.debug("Edgemanage got enough (%d) edges in state %s",
-                              desired_count, state)
-                break
-            choosen_edges.append(edge)
-        return choosen_edges
+        Args:
+         results_deadline: the time by which the untested edges will
+          have their results, as given by results_deadline
+
+        '''
+        untested = [edge for edge, edge_state in self.edge_states.iteritems()
+                    if edge_state.mode != "unavailable" and
+                    edge not in self.decision.edge_states and
+                    not (self.canary_decision and edge in self.canary_decision.edge_states)]
+        last_live = set(self.state_obj.last_live)
+        for edge in untested:
+            if (edge in last_live or edge in self.canary_edges or
+                    self.edge_states[edge].mode == "force"):
+                return False
+
+        required_edge_count = self.required_edge_count()
+        self.decision.check_threshold(self.config["goodenough"])
+        # As check_last_live, without logging about every edge each time
+        still_healthy = set([edge for edge in last_live if
+                             self.decision.current_judgement.get(edge) == "pass_threshold"])
+        if len(still_healthy) == required_edge_count:
+            return True
+
+        # The edges that make_edges_live would make live before ranking
+        # the rest
+        live_edges = set()
+        for edgename, edge_state in self.edge_states.iteritems():
+            if edgename in self.canary_edges:
+                continue
+            if edge_state.mode == "blindforce" or (
+                    edge_state.mode == "force" and edgename in self.decision.current_judgement and
+                    self.decision.edge_is_passing(edgename)):
+                live_edges.add(edgename)
+        live_edges.update(still_healthy)
+
+        needed_edges = required_edge_count - len(live_edges)
+        if needed_edges < 0:
+            # Which edges are made live would depend on the order they
+            # were added in
+            return False
+        chosen_edges = self.rank_candidates(
+            [edgename for edgename in self.decision.current_judgement
+             if edgename not in live_edges], needed_edges)
+        if (len(chosen_edges) < needed_edges or
+                [health for edge, health, score in chosen_edges
+                 if health != const.LIVE_HEALTHS[0]]):
+            return False
+        if not chosen_edges:
+            return True
+        # An untested edge could only take the place of one of the
+        # chosen edges by passing the threshold with a better score
+        worst_score = chosen_edges[-1][2]
+        for edge in untested:
+            if self.decision.score_floor(self.edge_states[edge], results_deadline) <= worst_score:
+                return False
+        return True
 
     def make_edges_live(self, force_update):
 
@@ -288,9 +637,7 @@ class EdgeManage(object):
         # Returns true if any changes were made.
 
         good_enough = self.config["goodenough"]
-        required_edge_count = self.config["edge_count"]
-        if self.dnet in self.config["dnet_edge_count"]:
-            required_edge_count = self.config["dnet_edge_count"][self.dnet]
+        required_edge_count = self.required_edge_count()
 
         # Has the edgelist changed since last iteration?
         edgelist_changed = None
@@ -309,7 +656,7 @@ class EdgeManage(object):
         still_healthy_from_last_run = self.check_last_live()
 
         for edgename, edge_state in self.edge_states.iteritems():
-            if edgename not in self.canary_data.values() and edge_state.mode == "force":
+            if edgename not in self.canary_edges and edge_state.mode == "force":
                 if self.decision.edge_is_passing(edgename):
                     logging.debug(
                         "Making host %s live because it is in mode force and it is in state pass",
@@ -321,7 +668,7 @@ class EdgeManage(object):
                         self.edgelist_obj.add_edge(edgename, state="pass", live=True)
                         edgelist_changed = True
 
-            elif edgename not in self.canary_data.values() and edge_state.mode == "blindforce":
+            elif edgename not in self.canary_edges and edge_state.mode == "blindforce":
                 logging.debug("Making host %s live because it is in mode blindforce.",
                               edgename)
                 self.edgelist_obj.add_edge(edgename, state="pass", live=True)
@@ -364,23 +711,28 @@ class EdgeManage(object):
             logging.debug("List of previously passing edges is currently %s",
                           self.edgelist_obj.get_live_edges())
 
-            # Attempt to meet demand starting with the most responsive edge states
-            for desired_state in ["pass_threshold", "pass_window", "pass_average", "pass"]:
-                needed_edges = required_edge_count - self.edgelist_obj.get_live_count()
-                filled_by_current_state = self.get_fastest_edges_by_state(remaining_edges,
-                                                                          desired_state,
-                                                                          needed_edges)
-                for edge in filled_by_current_state:
-                    self.edgelist_obj.add_edge(edge, state=desired_state, live=True)
-
-                if self.edgelist_obj.get_live_count() == required_edge_count:
-                    logging.info("Filled requirement for %d edges with edges in state %s",
-                                 required_edge_count, desired_state)
-                    break
+            # Attempt to meet demand starting with the most responsive
+            # edge states, and the fastest edges in each. More edges
+            # forced live than needed leave needed_edges negative, in
+            # which case every candidate is taken.
+            needed_edges = required_edge_count - self.edgelist_obj.get_live_count()
+            ranked_edges = self.rank_candidates(
+                remaining_edges, needed_edges + required_edge_count if needed_edges >= 0 else -1)
+            chosen_edges = ranked_edges if needed_edges < 0 else ranked_edges[:needed_edges]
+            self.state_obj.next_in_line = [list(candidate) for candidate
+                                           in ranked_edges[len(chosen_edges):]]
+            logging.debug("Ranked edges are %s", ranked_edges)
+            for edge, health, score in chosen_edges:
+                self.edgelist_obj.add_edge(edge, state=health, live=True)
+
+            if self.edgelist_obj.get_live_count() == required_edge_count:
+                logging.info("Filled requirement for %d edges with edges in state %s",
+                             required_edge_count,
+                             chosen_edges[-1][1] if chosen_edges else const.LIVE_HEALTHS[0])
+                if self.state_obj.next_in_line:
+                    logging.info("Next in line are %s",
+                                 [edge for edge, health, score in self.state_obj.next_in_line])
             else:
-                # Entering an "else" in the context of a "for" loop means
-                # "we didn't break". It's horrible but it's exactly what
-                # we need here.
                 logging.error("Tried to add edges from all acceptable states but failed")
 
                 # As a last option we add use the last live set of edges, even if
@@ -495,19 +847,9 @@ class EdgeManage(object):
         # We've got our edges, one way or another - let's set their states
         # Note in the statefile that this edge has been put into rotation
         for edge in self.edge_states:
-            try:
-                if edge in self.canary_data.values():
-                    is_canary = True
-                    current_health = self.canary_decision.get_judgement(edge)
-                else:
-                    is_canary = False
-                    current_health = self.decision.get_judgement(edge)
+            self.set_health(edge)
 
-                self.edge_states[edge].set_health(current_health)
-            except KeyError:
-                logging.debug("Could not get health judgement for edge %s", edge)
-
-            if is_canary is False:
+            if edge not in self.canary_edges:
                 if self.edgelist_obj.is_live(edge):
                     # Note in the statefile that this edge has been put into rotation
                     logging.debug("Setting edge %s to state in", edge)
@@ -523,5 +865,35 @@ class EdgeManage(object):
                 self.edge_states[edge].set_state("out")
 
         self.state_obj.zone_mtimes = self.current_mtimes
+        self.flush_edge_states()
 
         return any_changes or edgelist_changed
+
+    def set_health(self, edge):
+        ''' Note the health an edge was last judged to have in its edge state '''
+        try:
+            if edge in self.canary_edges:
+                current_health = self.canary_decision.get_judgement(edge)
+            else:
+                current_health = self.decision.get_judgement(edge)
+
+            self.edge_states[edge].set_health(current_health)
+        except KeyError:
+            logging.debug("Could not get health judgement for edge %s", edge)
+
+    def judge_late_results(self, edges):
+        '''Judge edges whose results came in after the decision was
+        made, so that their health is up to date for this run all the
+        same
+        '''
+        good_enough = self.config["goodenough"]
+        self.decision.check_threshold(good_enough)
+        if self.canary_decision:
+            self.canary_decision.check_threshold(good_enough)
+        for edge in edges:
+            self.set_health(edge)
+
+    def flush_edge_states(self):
+        ''' Write out the changes made to every edge state '''
+        for edge_state in self.edge_states.values():
+            edge_state.flush()
@@ -1,22 +1,35 @@
-import os
-import json
 import time
 import logging
-import datetime
 import copy
+import threading
 
-from const import FETCH_HISTORY, VALID_MODES, VALID_HEALTHS
-from util import open_atomic
+from const import (FETCH_HISTORY, FETCH_TIMEOUT, VALID_MODES, VALID_HEALTHS, PROBE_PHASES,
+                   SAMPLE_LOG_COMPACT)
+from timeseries import TimeSeries
+from rollup import Rollups
+from healthstore import JSONHealthStore, METADATA_VALS
 
 ASSUMED_VALS = {
     # A list of timestamps of when this edge has been in rotation
     "rotation_history": [],
     # A dict keyed by timestamps with values of floats containing
-    # fetch times - limited to FETCH_HISTORY items
+    # fetch times - limited to FETCH_HISTORY items. Held as a
+    # TimeSeries while loaded.
     "fetch_times": {},
-    # A dict keyed by timestamps which keeps an average of fetch times
-    # for FETCH_HISTORY days
-    "historical_average": {},
+    # A dict keyed by the PROBE_PHASES, each a dict keyed by the same
+    # timestamps as fetch_times with values of floats containing the
+    # time spent on that phase of the fetch. Each is held as a
+    # TimeSeries while loaded.
+    "phase_times": {},
+    # Per-minute, hour and day rollups of fetch times, bounded as per
+    # ROLLUP_TIERS. Held as a Rollups while loaded.
+    "rollups": {},
+    # Exponentially weighted moving averages of metrics, keyed by
+    # metric, each as [half-life, total, weight, time] - see
+    # TimeSeries.ewma_state. Only kept for the metrics a DecisionMaker
+    # has asked for the EWMA of. Held in the TimeSeries of each metric
+    # while loaded.
+    "ewmas": {},
     "state": "out",
     "mode": "available",
     "health": "pass",
@@ -25,6 +38,10 @@ ASSUMED_VALS = {
     "comment": "",
 }
 
+# The values that edge_conf changes, taken from the store when it
+# changes on disk while we have changes of our own to write out
+OPERATOR_VALS = ["mode", "state_entry_time", "comment"]
+
 # ASSUMED_VALS is used to dynamically fill EdgeState attributes, we need
 # to disable pylint member checks as it one be able to check these attributes.
 # pylint: disable=no-member, access-member-before-definition
@@ -32,26 +49,79 @@ ASSUMED_VALS = {
 
 class EdgeState(object):
 
-    def __init__(self, edgename, store_dir, nowrite=False):
+    def __init__(self, edgename, store_dir, nowrite=False, defer_writes=False,
+                 store=None, lazy=False):
         '''An object representing a simple set of time series data,
-        backed by a local JSON file store. Also some state variables.
+        backed by a health store - by default, a local JSON file store.
+        Also some state variables.
 
          Aka: Anything but RRD.
+
+         defer_writes: if true, changes are only written out to the
+          store by flush() rather than as they're made
+         store: the health store to keep the edge in, in place of a
+          JSONHealthStore of store_dir
+         lazy: if true, only the METADATA_VALS - like the mode and the
+          state - are loaded up front. The samples and history are
+          loaded when first used.
+
+        New samples and rotations are appended to the store's sample
+        log rather than rewriting the whole edge, until there are
+        SAMPLE_LOG_COMPACT records in the log or something else about
+        the edge changes.
         '''
 
         self.edgename = edgename
         self.nowrite = nowrite
-        self.statfile = os.path.join(store_dir, "%s.edgestore" % edgename)
-        if os.path.isfile(self.statfile) and os.path.getsize(self.statfile) != 0:
-            with open(self.statfile) as statfile_f:
-                try:
-                    stat_info = json.load(statfile_f)
-                except ValueError:
-                    logging.exception("Edgestore file %s is invalid", self.statfile)
-                    # Default to creating a new empty state file if current file is invalid
-                    stat_info = {}
+        self.defer_writes = defer_writes
+        # Whether there are changes that haven't been written out yet
+        self.dirty = False
+        # (metric, timestamp, value) records yet to be appended to the
+        # sample log, and the number of records already in it
+        self.pending_samples = []
+        self.logged_samples = 0
+        # Counts changes to the samples, so that they can be told apart
+        # from the samples as they were when last looked at
+        self.sample_version = 0
+        self.store = store or JSONHealthStore(store_dir)
+        self.statfile = self.store.location(edgename)
+        # Held while changing or writing out the store, which may be
+        # shared by the threads of several dnets
+        self.lock = threading.RLock()
+        # mtime of the edge in the store when it was last read or written
+        self.store_mtime = None
+        self.lazy = lazy
+        self._load(METADATA_VALS if lazy else None)
+        # Whether anything but samples and rotations has changed since
+        # the edge was last written out in full. New edges have never
+        # been.
+        self.needs_snapshot = self.store_mtime is None
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, like the values
+        # that a lazy EdgeState hasn't loaded yet
+        if name in ASSUMED_VALS and self.__dict__.get("lazy"):
+            with self.lock:
+                if name not in self.__dict__:
+                    self._load([val_key for val_key in ASSUMED_VALS
+                                if val_key not in METADATA_VALS])
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _loaded(self):
+        ''' Whether the values outside METADATA_VALS have been loaded '''
+        return "fetch_times" in self.__dict__
 
+    def _load(self, val_keys=None):
+        '''Read in stat data from the store - only the values in
+        val_keys, if given
+        '''
+        self.store_mtime = self.store.mtime(self.edgename)
+        stat_info = self.store.load(self.edgename, val_keys)
+        if stat_info is not None:
             for val_key, val_type in ASSUMED_VALS.iteritems():
+                if val_keys is not None and val_key not in val_keys:
+                    continue
                 # Set self attributes for all dict vals in the stat
                 # store.
                 try:
@@ -69,24 +139,118 @@ class EdgeState(object):
             # There is no stat file, just load empty assumed vals
             logging.warning("Initialising previously untracked edge %s", self.edgename)
             for val_key, val_type in ASSUMED_VALS.iteritems():
-                setattr(self, val_key, copy.copy(val_type))
+                if val_keys is None or val_key in val_keys:
+                    setattr(self, val_key, copy.copy(val_type))
+
+        if val_keys is None or "fetch_times" in val_keys:
+            self.sample_version += 1
+            self.fetch_times = TimeSeries.from_dict(FETCH_HISTORY, self.fetch_times)
+        if val_keys is None or "phase_times" in val_keys:
+            self.phase_times = dict([(phase, TimeSeries.from_dict(FETCH_HISTORY, phase_values))
+                                     for phase, phase_values in self.phase_times.iteritems()])
+        if val_keys is None or "rollups" in val_keys:
+            self.rollups = Rollups.from_dict(self.rollups)
+            if stat_info and "rollups" not in stat_info:
+                # Stores from before rollups were kept start with
+                # rollups of the fetch times that they do have
+                for timestamp, value in self.fetch_times.items():
+                    self.rollups.add(timestamp, value)
+        if val_keys is None or "ewmas" in val_keys:
+            for metric, ewma_state in self.ewmas.iteritems():
+                self.series(metric).set_ewma(*ewma_state)
+        if stat_info and "sample_log" in stat_info:
+            self._replay(stat_info["sample_log"])
 
-    def _dump(self):
-        ''' Write out stat data to file '''
-        output = {}
+    def _replay(self, sample_log):
+        '''Apply the records of the sample log on top of the values that
+        were just loaded
+        '''
+        # Records from before the values were last written out in full
+        # can be left behind by a crash
+        fetched_until = self.fetch_times.items()[-1][0] if len(self.fetch_times) else None
+        rotated_until = self.rotation_history[-1] if self.rotation_history else None
+        for metric, timestamp, value in sample_log:
+            if metric == "rotation":
+                if rotated_until is None or timestamp > rotated_until:
+                    self.rotation_history.append(timestamp)
+            elif fetched_until is None or timestamp > fetched_until:
+                if metric == "fetch":
+                    self._append_fetch(timestamp, value)
+                else:
+                    self.series(metric).append(timestamp, value)
+        self.pending_samples = []
+        self.logged_samples = len(sample_log)
+
+    def refresh(self):
+        '''Re-read the stat data if something else, like edge_conf, has
+        written to the file since we last did
+        '''
+        with self.lock:
+            if self.store.mtime(self.edgename) != self.store_mtime:
+                logging.debug("Reloading %s as it has changed on disk", self.statfile)
+                if self.dirty:
+                    # Keep the changes we've yet to write out
+                    self._load(OPERATOR_VALS)
+                elif self.lazy and not self._loaded():
+                    self._load(METADATA_VALS)
+                else:
+                    self._load()
 
+    def _dump(self, snapshot=True):
+        '''Write out stat data to file - or with defer_writes, note that
+        it needs writing out
+
+         snapshot: false if only samples and rotations have changed,
+          which can be appended to the sample log
+        '''
         if self.nowrite:
             logging.debug("Not writing %s because nowrite=True", self.statfile)
             return
 
-        for val_key, val_type in ASSUMED_VALS.iteritems():
-            output[val_key] = getattr(self, val_key)
-        # The statfile must be written atomically to prevent file corruption
-        # if edgemanage is kiled during the write. A broken statfile will
-        # prevent edgemanage from running.
-        with open_atomic(self.statfile, mode="w") as statfile_f:
-            json.dump(output, statfile_f, sort_keys=True, indent=4)
-        os.chmod(self.statfile, 0644)
+        with self.lock:
+            if snapshot:
+                self.needs_snapshot = True
+            if self.defer_writes:
+                self.dirty = True
+            else:
+                self._write()
+
+    def flush(self):
+        ''' Write out any changes held back by defer_writes '''
+        with self.lock:
+            if self.dirty:
+                self._write()
+
+    def _stat_info(self, val_keys=ASSUMED_VALS):
+        stat_info = dict([(val_key, getattr(self, val_key)) for val_key in val_keys])
+        if "ewmas" in stat_info:
+            stat_info["ewmas"] = dict([(metric, series.ewma_state()) for metric, series in
+                                       [("fetch", self.fetch_times)] + self.phase_times.items()
+                                       if series.halflife is not None])
+        return stat_info
+
+    def _write(self):
+        with self.lock:
+            if not self._loaded():
+                # Nothing but the metadata can have changed
+                self.store.save_metadata(self.edgename, self._stat_info(METADATA_VALS))
+            elif (self.needs_snapshot or
+                  self.logged_samples + len(self.pending_samples) > SAMPLE_LOG_COMPACT):
+                # Compact the sample log into a fresh snapshot
+                self.store.save(self.edgename, self._stat_info())
+                self.logged_samples = 0
+            elif self.pending_samples:
+                self.store.append_samples(self.edgename, self.pending_samples)
+                self.logged_samples += len(self.pending_samples)
+            self.pending_samples = []
+            self.needs_snapshot = False
+            self.store_mtime = self.store.mtime(self.edgename)
+            self.dirty = False
+
+    def copy_to(self, store):
+        ''' Write out the edge to another health store '''
+        with self.lock:
+            store.save(self.edgename, self._stat_info())
 
     def set_comment(self, comment):
         self.comment = comment
@@ -126,9 +290,34 @@ class EdgeState(object):
                 self.mode = mode
                 self._dump()
 
-    def current_average(self):
+    def series(self, metric=None):
+        '''Return the TimeSeries of a metric - one of VALID_METRICS,
+        defaulting to the fetch time
+        '''
+        if metric is None or metric == "fetch":
+            return self.fetch_times
+        elif metric in PROBE_PHASES:
+            if metric not in self.phase_times:
+                self.phase_times[metric] = TimeSeries(FETCH_HISTORY)
+            return self.phase_times[metric]
+        else:
+            raise ValueError("Metric must be fetch or one of %s, not %s" %
+                             (str(PROBE_PHASES), metric))
+
+    def current_average(self, metric=None):
         ''' Return an average of the current live set of values '''
-        return sum(self.fetch_times.values())/len(self.fetch_times)
+        return self.series(metric).average()
+
+    def percentile(self, percent, metric=None):
+        '''Return the value that percent of the current live set of
+        values fall at or below, or None if there are no values
+        '''
+        with self.lock:
+            values = sorted(self.series(metric).value_list())
+        if not values:
+            return None
+        index = int(round(percent / 100.0 * (len(values) - 1)))
+        return values[min(max(index, 0), len(values) - 1)]
 
     def __len__(self):
         ''' Return the number of values for fetch times we have '''
@@ -139,54 +328,118 @@ class EdgeState(object):
         dates between two timestamps
         '''
         if isinstance(index, slice):
-            return_dict = {}
-            for key, val in self.fetch_times.iteritems():
-                if key >= index.start and key <= index.stop:
-                    return_dict[key] = val
-
-            return return_dict
+            return self.window(index.start, index.stop)
         else:
             return self.fetch_times[index]
 
-    def last_value(self):
-        ''' Get the most recent value stored '''
-        return self.fetch_times[max(self.fetch_times.keys())]
+    def window(self, start, stop, metric=None):
+        ''' Return the values of a metric between two timestamps '''
+        # Values may be added by another thread while we're looking
+        with self.lock:
+            return self.series(metric).window(start, stop)
 
-    def add_rotation(self):
-        self.rotation_history.append(time.time())
-        self._dump()
+    def window_average(self, start, metric=None):
+        '''Return the number of values of a metric since a timestamp and
+        their average, or None for the average if there are none. This
+        is O(1) when called with a start that moves forward over time.
+        '''
+        with self.lock:
+            count, total = self.series(metric).summary_since(start)
+        if not count:
+            return 0, None
+        return count, total / count
+
+    def window_oldest(self, start, metric=None):
+        '''Return the timestamp of the oldest value of a metric since a
+        timestamp, or None if there are none
+        '''
+        with self.lock:
+            return self.series(metric).first_since(start)
 
-    def add_value(self, new_value, timestamp=None):
-        '''Add a new value to the fetch times store and check if we
-        need to make a historical average
+    def window_quantile(self, start, percent, metric=None):
+        '''Estimate the value that percent of the values of a metric
+        since a timestamp fall at or below, or None if there are none.
+        Like window_average, this is O(1) for a start that moves forward.
+        '''
+        with self.lock:
+            series = self.series(metric)
+            series.summary_since(start)
+            return series.since_sketch.quantile(percent)
 
+    def history_quantile(self, percent, metric=None):
+        '''Estimate the value that percent of all the current values of a
+        metric fall at or below, or None if there are none
         '''
+        return self.series(metric).sketch.quantile(percent)
 
-        if timestamp:
-            the_time = timestamp
-        else:
-            the_time = time.time()
+    def ewma(self, halflife, metric=None):
+        '''Return the exponentially weighted moving average of a metric
+        with a half-life in seconds, or None if there are no values.
+        This is O(1) once it has been asked for with the same half-life.
+        '''
+        with self.lock:
+            return self.series(metric).ewma(halflife)
 
-        # HACK: for legacy reasons, we need to cast to string
-        # here. It's stupid. Need to fix this in future versions with
-        # migration path for old state files.
-        self.fetch_times[str(the_time)] = new_value
+    def trend(self, tier_name, since=None):
+        '''Return summaries of the fetch times in each bucket of a
+        rollup tier, oldest first - see Rollups.summaries
+        '''
+        with self.lock:
+            return self.rollups.summaries(tier_name, since)
 
-        # prune our values if there's too many of them
-        if len(self.fetch_times) > FETCH_HISTORY:
-            min_value = sorted(self.fetch_times.keys())[0]
-            logging.debug("Rotating out item with timestamp %s and value %f due to "
+    def last_value(self, metric=None):
+        ''' Get the most recent value stored '''
+        return self.series(metric).last()
+
+    def add_rotation(self):
+        with self.lock:
+            self.rotation_history.append(time.time())
+            self._log_sample("rotation", self.rotation_history[-1], 0.0)
+            self._dump(snapshot=False)
+
+    def _log_sample(self, metric, timestamp, value):
+        ''' Note a record to be appended to the sample log '''
+        if not self.nowrite:
+            self.pending_samples.append((metric, timestamp, value))
+
+    def _append_fetch(self, timestamp, value):
+        ''' Add a fetch time to the fetch times and rollups '''
+        # The oldest value is rotated out once there are
+        # FETCH_HISTORY of them. Phase times are held to FETCH_HISTORY
+        # as well, so rotate out on their own.
+        evicted = self.fetch_times.append(timestamp, value)
+        if evicted:
+            logging.debug("Rotated out item with timestamp %f and value %f due to "
                           "fetch cache being over %d items",
-                          min_value, self.fetch_times[min_value], FETCH_HISTORY)
-            del(self.fetch_times[min_value])
+                          evicted[0], evicted[1], FETCH_HISTORY)
+        self.rollups.add(timestamp, value)
 
-        the_time_datetime = datetime.datetime.utcfromtimestamp(the_time)
-        if the_time_datetime.minute == 0:
-            # prune our values if there's too many of them
-            if len(self.historical_average) > FETCH_HISTORY:
-                min_value = sorted(self.historical_average.keys())[0]
-                del(self.historical_average[min_value])
-            self.historical_average[the_time] = self.current_average()
+    def add_value(self, new_value, timestamp=None, phase_times=None):
+        '''Add a new value to the fetch times store, and to the
+        rollups of it
 
-        self._dump()
+         phase_times: optional dict of PROBE_PHASES to the time spent
+          on each during the fetch. Fetches that timed out count as
+          timeouts in every phase.
+
+        '''
+
+        with self.lock:
+            if timestamp:
+                the_time = timestamp
+            else:
+                the_time = time.time()
+
+            self.sample_version += 1
+            self._append_fetch(the_time, new_value)
+            self._log_sample("fetch", the_time, new_value)
+
+            if phase_times is None and new_value == FETCH_TIMEOUT:
+                phase_times = dict.fromkeys(PROBE_PHASES, FETCH_TIMEOUT)
+            if phase_times:
+                for phase in PROBE_PHASES:
+                    self.series(phase).append(the_time, phase_times[phase])
+                    self._log_sample(phase, the_time, phase_times[phase])
+
+            self._dump(snapshot=False)
         return the_time
@@ -1,13 +1,20 @@
 # stdlib
+import copy
 import urlparse
 import hashlib
 import logging
+import socket
+import threading
+import time
 
 # local
 import const
 
 # external
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 # Make requests stop logging so much. I love you but you need to shut
@@ -19,6 +26,77 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 USER_AGENT = "Edgemanage v2 (https://github.com/equalitie/edgemanage)"
 
+# Phase timings of the last connection opened by this thread.
+# Connections are opened deep inside urllib3 on whichever thread is
+# making the request, so this is how the times get back to EdgeTest.
+_phase_timer = threading.local()
+
+
+def _timed_new_conn(connection, new_conn):
+    '''Open a connection with new_conn, recording DNS resolution and
+    TCP connect times separately by resolving the host ourselves
+    first.
+
+    '''
+    start = time.time()
+    try:
+        dns_host = socket.getaddrinfo(connection._dns_host, connection.port,
+                                      0, socket.SOCK_STREAM)[0][4][0]
+    except socket.error:
+        # Let urllib3 fail in its own way
+        return new_conn(connection)
+    resolved = time.time()
+
+    orig_dns_host = connection._dns_host
+    connection._dns_host = dns_host
+    try:
+        conn = new_conn(connection)
+    finally:
+        connection._dns_host = orig_dns_host
+
+    _phase_timer.dns = resolved - start
+    _phase_timer.connect = time.time() - resolved
+    return conn
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+    def _new_conn(self):
+        return _timed_new_conn(self, HTTPConnection._new_conn)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+
+    def _new_conn(self):
+        return _timed_new_conn(self, HTTPSConnection._new_conn)
+
+    def connect(self):
+        start = time.time()
+        HTTPSConnection.connect(self)
+        # Whatever wasn't spent on DNS and TCP went on the TLS handshake
+        _phase_timer.tls = max(0.0, time.time() - start - _phase_timer.dns -
+                               _phase_timer.connect)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class EdgeAdapter(HTTPAdapter):
+
+    ''' A requests adapter that keeps track of connection setup time '''
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
 
 class FetchFailed(Exception):
     def __init__(self, edgetest, fetch_host, fetch_object, reason):
@@ -45,61 +123,222 @@ class VerifyFailed(Exception):
         self.fetch_object = fetch_object
 
 
+class ConnectFailed(Exception):
+    def __init__(self, edgetest, fetch_host, fetch_object, reason):
+        message = "Failed to connect to %s for %s/%s: %s" % (edgetest.edgename, fetch_host,
+                                                             fetch_object, reason)
+        super(ConnectFailed, self).__init__(message)
+
+        self.edgename = edgetest.edgename
+        self.fetch_host = fetch_host
+        self.fetch_object = fetch_object
+
+
+def failed_phase_times():
+    ''' Phase times for a fetch that failed - every phase took forever '''
+    return dict.fromkeys(const.PROBE_PHASES, const.FETCH_TIMEOUT)
+
+
+class ObjectHasher(object):
+
+    def __init__(self, expected_sum, max_size=None):
+        '''Incrementally hash a response body as it is read, refusing
+        to take in more than max_size bytes.
+
+         expected_sum: the checksum the body should have
+         max_size: the size of the local object, if known
+        '''
+        self.expected_sum = expected_sum
+        self.max_size = max_size
+        self.size = 0
+        self.body_hash = hashlib.md5()
+
+    def update(self, chunk):
+        ''' Hash a chunk of the body, returning False if the body is too big '''
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            return False
+        self.body_hash.update(chunk)
+        return True
+
+    def hexdigest(self):
+        return self.body_hash.hexdigest()
+
+
 class EdgeTest(object):
 
-    def __init__(self, edgename, local_sum):
+    def __init__(self, edgename, local_sum, pool_size=const.EDGE_POOL_SIZE,
+                 local_size=None, conditional=None, range_size=const.RANGE_PROBE_SIZE,
+                 range_sum=None):
         """
          edgename: FQDN string of the edge to be tested
          local_sum: the pre-computed known checksum of the object to be fetched
+         pool_size: the number of keep-alive connections to hold open to the edge
+         local_size: the size of the object to be fetched - bodies that
+          grow past this are abandoned
+         conditional: one of VALID_CONDITIONALS, how to avoid fetching
+          the whole object on every test
+         range_size: the number of bytes fetched by range probes
+         range_sum: the checksum of the first range_size bytes of the object
+
+        EdgeTest objects are meant to be kept around between runs so
+        that connections to the edge (and with them, TLS sessions) are
+        reused rather than set up from scratch for every fetch.
         """
 
+        if conditional not in const.VALID_CONDITIONALS:
+            raise ValueError("Conditional fetch mode must be one of %s, not %s" %
+                             (str(const.VALID_CONDITIONALS), conditional))
+
         self.edgename = edgename
+        self.conditional = conditional
+        self.range_size = range_size
+        # ETag of the last fully verified copy of the object on the edge
+        self.etag = None
+        self.set_local_object(local_sum, local_size, range_sum)
+        # Seconds spent on DNS, TCP connect and TLS handshake during
+        # the last fetch, or None if an existing connection was reused
+        self.connect_time = None
+        # A dict of PROBE_PHASES to the seconds spent on each during
+        # the last fetch
+        self.phase_times = failed_phase_times()
+
+        self.session = requests.Session()
+        adapter = EdgeAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def set_local_object(self, local_sum, local_size=None, range_sum=None):
+        ''' Update what we know about the local copy of the object '''
+        if local_sum != getattr(self, "local_sum", None):
+            # The object has changed - what the edge had before is no
+            # good to us now.
+            self.etag = None
         self.local_sum = local_sum
+        self.local_size = local_size
+        self.range_sum = range_sum
+
+    def hedge(self):
+        '''A copy of this EdgeTest sharing its connections, for running a
+        second fetch alongside one that is already in flight without
+        the two overwriting each other's timings.
+
+        '''
+        hedge_t = copy.copy(self)
+        hedge_t.connect_time = None
+        hedge_t.phase_times = failed_phase_times()
+        return hedge_t
+
+    def take_validators(self, hedge_t):
+        '''Keep what a hedge learnt about the edge's copy of the object,
+        so that the next conditional fetch is made against it
+        '''
+        self.etag = hedge_t.etag
+
+    def close(self):
+        ''' Close any connections held open to the edge '''
+        self.session.close()
+
+    def request_headers(self, fetch_host):
+        headers = {"Host": fetch_host, "User-Agent": USER_AGENT}
+        if self.conditional == "etag" and self.etag:
+            headers["If-None-Match"] = self.etag
+        elif self.conditional == "range" and self.range_sum:
+            headers["Range"] = "bytes=0-%d" % (self.range_size - 1)
+        return headers
+
+    def start_verify(self, fetch_host, fetch_object, status, request_headers):
+        '''Check the status of a response, returning an ObjectHasher to
+        feed the body into, or None if the edge has confirmed it still
+        holds the copy of the object we verified last time.
+
+        '''
+        if status == 304 and "If-None-Match" in request_headers:
+            return None
+        if status == 206 and "Range" in request_headers:
+            return ObjectHasher(self.range_sum, self.range_size)
+        if not 200 <= status < 300:
+            logging.error("Object fetch failed on %s: HTTP status %d", self.edgename, status)
+            raise FetchFailed(self, fetch_host, fetch_object, "HTTP status %d" % status)
+        return ObjectHasher(self.local_sum, self.local_size)
+
+    def body_too_large(self, fetch_host, fetch_object, hasher):
+        logging.error("Failed to verify %s, body is larger than the %d byte object!!",
+                      self.edgename, hasher.max_size)
+        raise VerifyFailed(self, fetch_host, fetch_object,
+                           "body larger than %d bytes" % hasher.max_size)
+
+    def finish_verify(self, fetch_host, fetch_object, hasher, etag=None):
+        remote_hash = hasher.hexdigest()
+        if remote_hash != hasher.expected_sum:
+            logging.error("Failed to verify hash on %s!!", self.edgename)
+            raise VerifyFailed(self, fetch_host, fetch_object, remote_hash)
+        if self.conditional == "etag" and hasher.expected_sum == self.local_sum:
+            self.etag = etag
 
     def make_request(self, fetch_host, fetch_object, proto, port, verify):
         request_url = urlparse.urljoin(proto + "://" + self.edgename + ":" + str(port),
                                        fetch_object)
-        return requests.get(request_url, verify=verify, timeout=const.FETCH_TIMEOUT,
-                            headers={"Host": fetch_host, "User-Agent": USER_AGENT})
-        pass
+        _phase_timer.dns = _phase_timer.connect = _phase_timer.tls = None
+        try:
+            return self.session.get(request_url, verify=verify, timeout=const.FETCH_TIMEOUT,
+                                    headers=self.request_headers(fetch_host), stream=True)
+        finally:
+            self.connect_time = None
+            if _phase_timer.connect is not None:
+                self.connect_time = sum([_phase_timer.dns, _phase_timer.connect,
+                                         _phase_timer.tls or 0.0])
 
     def fetch(self, fetch_host, fetch_object, proto="https", port=80, verify=False):
         """
          fetch_host: The Host header to use when fetching
          fetch_object: The path to the object to be fetched
         """
+        # Until we know better, the fetch has failed
+        self.phase_times = failed_phase_times()
         try:
             response = self.make_request(fetch_host, fetch_object, proto, port, verify)
         except requests.exceptions.Timeout as e:
             # Just assume it took the maximum amount of time
             return const.FETCH_TIMEOUT
         except requests.exceptions.ConnectionError as e:
+            # Retrying is left to the caller, which can get on with
+            # testing other edges in the meantime.
             logging.error("Connection error when fetching from %s: %s", self.edgename, str(e))
-            for i in range(const.FETCH_RETRY-1):
-                logging.warning("Retrying connection to %s", self.edgename)
-                try:
-                    response = self.make_request(fetch_host, fetch_object, proto, port, verify)
-                    # Request was successful, stop retrying and
-                    # continue
-                    break
-                except requests.exceptions.ConnectionError as e:
-                    continue
-            else:
-                logging.error("Failed to connect to %s after retrying %d times",
-                              self.edgename, const.FETCH_RETRY)
-                # The loop finished without a break - we got more
-                # connection errors. Let's bail and return the maximum
-                # amount of time. for/else is weird.
-                return const.FETCH_TIMEOUT
-
-        if not response.ok:
-            logging.error("Object fetch failed on %s:%s", self.edgename, port)
-            raise FetchFailed(self, fetch_host, fetch_object, response.text)
-
-        remote_hash = hashlib.md5(response.content).hexdigest()
-
-        if remote_hash != self.local_sum:
-            logging.error("Failed to verify hash on %s!!", self.edgename)
-            raise VerifyFailed(self, fetch_host, fetch_object, remote_hash)
+            raise ConnectFailed(self, fetch_host, fetch_object, str(e))
+
+        phase_times = {
+            "dns": _phase_timer.dns or 0.0,
+            "connect": _phase_timer.connect or 0.0,
+            "tls": _phase_timer.tls or 0.0,
+        }
+        # Connection setup is reported separately in connect_time so
+        # that a fresh connection doesn't make an edge look slower
+        # than one with a connection already open.
+        phase_times["ttfb"] = max(0.0, response.elapsed.total_seconds() -
+                                  (self.connect_time or 0.0))
+
+        # The body is streamed through the hasher rather than held in
+        # memory, and closing the response hands the connection back
+        # to the pool once it's fully read.
+        transfer_start = time.time()
+        try:
+            hasher = self.start_verify(fetch_host, fetch_object, response.status_code,
+                                       response.request.headers)
+            # A 304 has no body to verify, but it's still read so that
+            # the connection can be reused
+            for chunk in response.iter_content(const.FETCH_CHUNK_SIZE):
+                if hasher is not None and not hasher.update(chunk):
+                    self.body_too_large(fetch_host, fetch_object, hasher)
+            if hasher is not None:
+                self.finish_verify(fetch_host, fetch_object, hasher,
+                                   response.headers.get("ETag"))
+        except requests.exceptions.RequestException as e:
+            logging.error("Failed to read object body from %s: %s", self.edgename, str(e))
+            return const.FETCH_TIMEOUT
+        finally:
+            response.close()
 
-        return response.elapsed.total_seconds()
+        phase_times["transfer"] = time.time() - transfer_start
+        self.phase_times = phase_times
+        return phase_times["ttfb"]
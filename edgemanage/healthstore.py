@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import struct
+import logging
+import sqlite3
+import threading
+
+from const import HEALTHDATA_BACKENDS, HEALTHDATA_DB, VALID_METRICS
+from util import open_atomic
+
+# The health stores that have been opened, keyed by backend and path,
+# so that everything in a process shares the one database connection
+_health_stores = {}
+_health_stores_lock = threading.Lock()
+
+# The small values describing an edge, as opposed to its samples and
+# history, which can be read without reading the rest
+METADATA_VALS = ["state", "mode", "health", "state_entry_time", "comment"]
+
+# The kinds of records in a sample log: a sample of one of the
+# VALID_METRICS, or the time that an edge was put into rotation
+SAMPLE_LOG_METRICS = VALID_METRICS + ["rotation"]
+# A record is the index of its kind in SAMPLE_LOG_METRICS, a timestamp
+# and a value
+SAMPLE_LOG_RECORD = struct.Struct("<Bdd")
+
+
+def get_health_store(config):
+    ''' Get the health store described by the config '''
+    backend = config.get("healthdata_backend", "json")
+    if backend not in HEALTHDATA_BACKENDS:
+        raise ValueError("healthdata_backend must be one of %s, not %s" %
+                         (str(HEALTHDATA_BACKENDS), backend))
+
+    with _health_stores_lock:
+        key = (backend, config["healthdata_store"])
+        if key not in _health_stores:
+            if backend == "sqlite":
+                _health_stores[key] = SQLiteHealthStore(
+                    os.path.join(config["healthdata_store"], HEALTHDATA_DB))
+            else:
+                _health_stores[key] = JSONHealthStore(config["healthdata_store"])
+        return _health_stores[key]
+
+
+class JSONHealthStore(object):
+
+    def __init__(self, store_dir):
+        '''A health store keeping each edge in its own pretty-printed
+        JSON .edgestore file in store_dir.
+
+        The METADATA_VALS are written on the first line of the file, so
+        that they can be read without parsing the samples after them.
+
+        Samples and rotations added since the file was last written are
+        appended to a .edgelog file beside it as fixed size
+        SAMPLE_LOG_RECORDs, which is emptied whenever the .edgestore
+        file is written out in full.
+
+        '''
+        self.store_dir = store_dir
+
+    def location(self, edgename):
+        return os.path.join(self.store_dir, "%s.edgestore" % edgename)
+
+    def log_location(self, edgename):
+        return os.path.join(self.store_dir, "%s.edgelog" % edgename)
+
+    def exists(self, edgename):
+        return os.path.exists(self.location(edgename))
+
+    def edgenames(self):
+        ''' Every edge in the store '''
+        return sorted([filename[:-len(".edgestore")] for filename in os.listdir(self.store_dir)
+                       if filename.endswith(".edgestore")])
+
+    def mtime(self, edgename):
+        ''' When the edge was last written to, or None if it never was '''
+        try:
+            mtime = os.stat(self.location(edgename)).st_mtime
+        except OSError:
+            return None
+        try:
+            return max(mtime, os.stat(self.log_location(edgename)).st_mtime)
+        except OSError:
+            return mtime
+
+    def load(self, edgename, val_keys=None):
+        '''Load the stat data of an edge - None if it isn't stored, or
+        an empty dict if it's stored but unreadable. If val_keys only
+        asks for METADATA_VALS, only the first line of the file is read
+        - unless it's from before they were written there.
+
+        Unless val_keys leaves out the samples, the records appended to
+        the sample log since are included as sample_log, a list of
+        (metric, timestamp, value) tuples, oldest first.
+
+        '''
+        stat_info = self._load_snapshot(edgename, val_keys)
+        if stat_info is not None and (val_keys is None or "fetch_times" in val_keys):
+            stat_info["sample_log"] = self._read_log(edgename)
+        return stat_info
+
+    def _load_snapshot(self, edgename, val_keys=None):
+        statfile = self.location(edgename)
+        if not os.path.isfile(statfile) or os.path.getsize(statfile) == 0:
+            return None
+
+        with open(statfile) as statfile_f:
+            if val_keys is not None and set(val_keys) <= set(METADATA_VALS):
+                header = self._read_header(statfile_f)
+                if header is not None:
+                    return header
+                statfile_f.seek(0)
+            try:
+                return json.load(statfile_f)
+            except ValueError:
+                logging.exception("Edgestore file %s is invalid", statfile)
+                # Default to creating a new empty state file if current file is invalid
+                return {}
+
+    @staticmethod
+    def _read_header(statfile_f):
+        ''' Parse the METADATA_VALS from the first line of a file '''
+        line = statfile_f.readline().rstrip()
+        if not line.startswith('{"') or not line.endswith(","):
+            return None
+        try:
+            return json.loads(line[:-1] + "}")
+        except ValueError:
+            return None
+
+    def _read_log(self, edgename):
+        try:
+            with open(self.log_location(edgename), "rb") as log_f:
+                contents = log_f.read()
+        except IOError:
+            return []
+
+        records = []
+        # A partly written record left by a crash is ignored
+        for offset in xrange(0, len(contents) - SAMPLE_LOG_RECORD.size + 1,
+                             SAMPLE_LOG_RECORD.size):
+            metric_index, timestamp, value = SAMPLE_LOG_RECORD.unpack_from(contents, offset)
+            if metric_index < len(SAMPLE_LOG_METRICS):
+                records.append((SAMPLE_LOG_METRICS[metric_index], timestamp, value))
+        return records
+
+    def save(self, edgename, stat_info):
+        '''Write out the stat data of an edge, with fetch_times and
+        phase_times held as TimeSeries and rollups as Rollups, emptying
+        its sample log
+
+        '''
+        output = dict(stat_info)
+        output["fetch_times"] = stat_info["fetch_times"].to_dict()
+        output["phase_times"] = dict([(phase, series.to_dict()) for phase, series
+                                      in stat_info["phase_times"].iteritems()])
+        output["rollups"] = stat_info["rollups"].to_dict()
+        self._write(edgename, output)
+        # Records left in the log by a crash before this are older than
+        # the samples just written, and are skipped when it's loaded
+        try:
+            os.remove(self.log_location(edgename))
+        except OSError:
+            pass
+
+    def append_samples(self, edgename, records):
+        '''Append (metric, timestamp, value) records to the sample log
+        of an edge - metric being one of SAMPLE_LOG_METRICS
+
+        '''
+        log_location = self.log_location(edgename)
+        log_exists = os.path.exists(log_location)
+        log_size = os.path.getsize(log_location) if log_exists else 0
+        with open(log_location, "ab") as log_f:
+            if log_size % SAMPLE_LOG_RECORD.size:
+                # Drop a partly written record so that the records
+                # after it line up
+                log_f.truncate(log_size - log_size % SAMPLE_LOG_RECORD.size)
+            log_f.write("".join([SAMPLE_LOG_RECORD.pack(SAMPLE_LOG_METRICS.index(metric),
+                                                        timestamp, value)
+                                 for metric, timestamp, value in records]))
+        if not log_exists:
+            os.chmod(log_location, 0644)
+
+    def save_metadata(self, edgename, metadata):
+        ''' Write out only the METADATA_VALS of an edge '''
+        output = self._load_snapshot(edgename) or {}
+        output.update(metadata)
+        self._write(edgename, output)
+
+    def _write(self, edgename, output):
+        header = dict([(val_key, output[val_key]) for val_key in METADATA_VALS
+                       if val_key in output])
+        body = dict([(val_key, value) for val_key, value in output.iteritems()
+                     if val_key not in header])
+        if body:
+            # The header's closing brace and the body's opening one are
+            # dropped to join them into one object
+            contents = (json.dumps(header, sort_keys=True)[:-1] + ",\n" +
+                        json.dumps(body, sort_keys=True, indent=4)[2:] + "\n")
+        else:
+            contents = json.dumps(header, sort_keys=True) + "\n"
+
+        statfile = self.location(edgename)
+        # The statfile must be written atomically to prevent file corruption
+        # if edgemanage is kiled during the write. A broken statfile will
+        # prevent edgemanage from running.
+        with open_atomic(statfile, mode="w") as statfile_f:
+            statfile_f.write(contents)
+        os.chmod(statfile, 0644)
+
+    def latest_values(self, edgenames=None, state=None):
+        '''The most recent fetch time of each edge that has one, as a
+        dict keyed by edgename - only the edges in a state, if given
+
+        '''
+        latest = {}
+        for edgename in edgenames if edgenames is not None else self.edgenames():
+            stat_info = self.load(edgename)
+            if not stat_info:
+                continue
+            if state is not None and stat_info.get("state") != state:
+                continue
+            logged = [value for metric, timestamp, value in stat_info["sample_log"]
+                      if metric == "fetch"]
+            fetch_times = stat_info.get("fetch_times")
+            if logged:
+                latest[edgename] = logged[-1]
+            elif fetch_times:
+                latest[edgename] = fetch_times[max(fetch_times, key=float)]
+        return latest
+
+
+class SQLiteHealthStore(object):
+
+    # Values of ASSUMED_VALS kept in columns of the edges table, the
+    # rest of which are JSON. Samples go in the samples table.
+    COLUMN_VALS = METADATA_VALS
+    JSON_VALS = ["rotation_history", "rollups", "ewmas"]
+
+    def __init__(self, path):
+        '''A health store keeping every edge in one SQLite database in
+        WAL mode, so that readers don't block edge_manage and can query
+        the latest samples without loading whole histories.
+
+        Edges are written incrementally: only samples added since the
+        last write are inserted, and rotated out samples deleted. In
+        between, samples and rotations are appended to the sample_log
+        table, which is emptied of an edge's records as it's written.
+
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS edges ("
+                    " edgename TEXT PRIMARY KEY,"
+                    " state TEXT, mode TEXT, health TEXT, state_entry_time REAL,"
+                    " comment TEXT, rotation_history TEXT, rollups TEXT, ewmas TEXT,"
+                    " updated REAL NOT NULL)")
+                columns = [row[1] for row in self.conn.execute("PRAGMA table_info(edges)")]
+                if "ewmas" not in columns:
+                    # Databases from before EWMAs were kept
+                    self.conn.execute("ALTER TABLE edges ADD COLUMN ewmas TEXT")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS edges_state ON edges (state)")
+                # metric is "fetch" or one of PROBE_PHASES
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS samples ("
+                    " edgename TEXT NOT NULL, metric TEXT NOT NULL,"
+                    " timestamp REAL NOT NULL, value REAL NOT NULL,"
+                    " PRIMARY KEY (edgename, metric, timestamp))")
+                # metric is one of SAMPLE_LOG_METRICS
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sample_log ("
+                    " edgename TEXT NOT NULL, metric TEXT NOT NULL,"
+                    " timestamp REAL NOT NULL, value REAL NOT NULL)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS sample_log_edgename"
+                                  " ON sample_log (edgename)")
+
+    def location(self, edgename):
+        return "%s:%s" % (self.path, edgename)
+
+    def exists(self, edgename):
+        return self.mtime(edgename) is not None
+
+    def edgenames(self):
+        ''' Every edge in the store '''
+        with self.lock:
+            return [row[0] for row in
+                    self.conn.execute("SELECT edgename FROM edges ORDER BY edgename")]
+
+    def mtime(self, edgename):
+        ''' When the edge was last written to, or None if it never was '''
+        with self.lock:
+            row = self.conn.execute("SELECT updated FROM edges WHERE edgename = ?",
+                                    (edgename,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, edgename, val_keys=None):
+        '''Load the stat data of an edge, or None if it isn't stored.
+        Only the METADATA_VALS are always read, the rest only if
+        val_keys, if given, asks for them. The sample log is included
+        with the samples, as in JSONHealthStore.load.
+
+        '''
+        json_vals = [val_key for val_key in self.JSON_VALS
+                     if val_keys is None or val_key in val_keys]
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT %s FROM edges WHERE edgename = ?" %
+                ", ".join(self.COLUMN_VALS + json_vals), (edgename,)).fetchone()
+            if row is None:
+                return None
+
+            stat_info = dict(zip(self.COLUMN_VALS, row))
+            for val_key, value in zip(json_vals, row[len(self.COLUMN_VALS):]):
+                # Columns added since the edge was last written are NULL
+                if value is not None:
+                    stat_info[val_key] = json.loads(value)
+
+            if val_keys is None or "fetch_times" in val_keys or "phase_times" in val_keys:
+                stat_info["fetch_times"] = {}
+                stat_info["phase_times"] = {}
+                for metric, timestamp, value in self.conn.execute(
+                        "SELECT metric, timestamp, value FROM samples WHERE edgename = ?",
+                        (edgename,)):
+                    if metric == "fetch":
+                        series = stat_info["fetch_times"]
+                    else:
+                        series = stat_info["phase_times"].setdefault(metric, {})
+                    series[repr(timestamp)] = value
+                stat_info["sample_log"] = self.conn.execute(
+                    "SELECT metric, timestamp, value FROM sample_log WHERE edgename = ?"
+                    " ORDER BY rowid", (edgename,)).fetchall()
+        return stat_info
+
+    def save(self, edgename, stat_info):
+        '''Write out the stat data of an edge, with fetch_times and
+        phase_times held as TimeSeries and rollups as Rollups, emptying
+        its sample log
+
+        '''
+        stat_info = dict(stat_info, rollups=stat_info["rollups"].to_dict())
+        columns = self.COLUMN_VALS + self.JSON_VALS + ["updated"]
+        values = ([stat_info[val_key] for val_key in self.COLUMN_VALS] +
+                  [json.dumps(stat_info[val_key]) for val_key in self.JSON_VALS] +
+                  [time.time()])
+        metric_series = [("fetch", stat_info["fetch_times"])] + \
+            sorted(stat_info["phase_times"].items())
+
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO edges (edgename, %s) VALUES (?, %s)" %
+                              (", ".join(columns), ", ".join(["?"] * len(columns))),
+                              [edgename] + values)
+            for metric, series in metric_series:
+                items = series.items()
+                if not items:
+                    self.conn.execute("DELETE FROM samples WHERE edgename = ? AND metric = ?",
+                                      (edgename, metric))
+                    continue
+
+                stored_until = self.conn.execute(
+                    "SELECT MAX(timestamp) FROM samples WHERE edgename = ? AND metric = ?",
+                    (edgename, metric)).fetchone()[0]
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)",
+                    [(edgename, metric, timestamp, value) for timestamp, value in items
+                     if stored_until is None or timestamp > stored_until])
+                self.conn.execute("DELETE FROM samples WHERE edgename = ? AND metric = ? "
+                                  "AND timestamp < ?", (edgename, metric, items[0][0]))
+            self.conn.execute("DELETE FROM sample_log WHERE edgename = ?", (edgename,))
+
+    def append_samples(self, edgename, records):
+        '''Append (metric, timestamp, value) records to the sample log
+        of an edge - metric being one of SAMPLE_LOG_METRICS
+
+        '''
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO sample_log VALUES (?, ?, ?, ?)",
+                                  [(edgename, metric, timestamp, value)
+                                   for metric, timestamp, value in records])
+            self.conn.execute("UPDATE edges SET updated = ? WHERE edgename = ?",
+                              (time.time(), edgename))
+
+    def save_metadata(self, edgename, metadata):
+        ''' Write out only the METADATA_VALS of an edge '''
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO edges (edgename, rotation_history, "
+                              "rollups, ewmas, updated) VALUES (?, '[]', '{}', '{}', 0)",
+                              (edgename,))
+            self.conn.execute("UPDATE edges SET %s, updated = ? WHERE edgename = ?" %
+                              ", ".join(["%s = ?" % val_key for val_key in self.COLUMN_VALS]),
+                              [metadata[val_key] for val_key in self.COLUMN_VALS] +
+                              [time.time(), edgename])
+
+    def latest_values(self, edgenames=None, state=None):
+        '''The most recent fetch time of each edge that has one, as a
+        dict keyed by edgename - only the edges in a state, if given
+
+        '''
+        query = ("SELECT edges.edgename, samples.value FROM edges JOIN samples"
+                 " ON samples.edgename = edges.edgename AND samples.metric = 'fetch'"
+                 " AND samples.timestamp = (SELECT MAX(timestamp) FROM samples"
+                 "  WHERE edgename = edges.edgename AND metric = 'fetch')")
+        # Samples in the log are newer than any in the samples table.
+        # SQLite takes the value from the row with the MAX(timestamp).
+        log_query = ("SELECT sample_log.edgename, value, MAX(timestamp) FROM sample_log"
+                     " JOIN edges ON sample_log.edgename = edges.edgename"
+                     " WHERE metric = 'fetch'")
+        params = []
+        if state is not None:
+            query += " WHERE edges.state = ?"
+            log_query += " AND edges.state = ?"
+            params.append(state)
+        log_query += " GROUP BY sample_log.edgename"
+        with self.lock:
+            latest = dict(self.conn.execute(query, params).fetchall())
+            for edgename, value, timestamp in self.conn.execute(log_query, params):
+                latest[edgename] = value
+        if edgenames is not None:
+            latest = dict([(edgename, value) for edgename, value in latest.iteritems()
+                           if edgename in edgenames])
+        return latest
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,114 @@
+# stdlib
+import logging
+import threading
+import time
+
+# local
+from edgestate import EdgeState
+
+# external
+from concurrent.futures import Future
+
+
+class ProbeCache(object):
+
+    def __init__(self, max_age=0):
+        '''Probe results and edge states shared by every dnet managed by
+        a process, so that an edge that is in several dnets is only
+        probed once and has only one EdgeState writing to its store.
+
+        The first dnet to claim an edge probes it and records the
+        sample; any other dnet claiming the edge while that probe is in
+        flight, or within max_age seconds of it finishing, is handed
+        the same result instead of probing again.
+
+        Args:
+         max_age: seconds for which a finished probe's result is reused
+
+        '''
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # edgename -> _CachedProbe
+        self.probes = {}
+        # edgename -> EdgeState
+        self.edge_states = {}
+        # edgename -> the most recently published result
+        self.latest_results = {}
+
+    def edge_state(self, edgename, store_dir, nowrite=False, defer_writes=False,
+                   store=None):
+        '''Get the EdgeState of an edge, loading it the first time it's
+        asked for and picking up changes made on disk after that
+
+        '''
+        with self.lock:
+            edge_state = self.edge_states.get(edgename)
+            if edge_state is None:
+                edge_state = EdgeState(edgename, store_dir, nowrite=nowrite,
+                                       defer_writes=defer_writes, store=store)
+                self.edge_states[edgename] = edge_state
+                return edge_state
+        edge_state.refresh()
+        return edge_state
+
+    def claim(self, edgetest, fetch_args):
+        '''Claim a probe of an edge.
+
+        Returns a tuple of a Future and whether the caller now owns the
+        probe. The owner must probe the edge, record the result and
+        then pass it to publish or abandon, which resolves the Future.
+        Otherwise the Future resolves to the (fetch_result,
+        fetch_status, phase_times) of another dnet's probe - or None if
+        that probe was abandoned.
+
+        '''
+        key = (edgetest.local_sum,) + tuple(fetch_args)
+        now = time.time()
+        with self.lock:
+            cached = self.probes.get(edgetest.edgename)
+            if cached is not None and cached.key == key:
+                if cached.finished is None:
+                    return cached.future, False
+                if (now - cached.finished <= self.max_age and
+                        cached.future.result() is not None):
+                    logging.debug("Reusing a result for %s from %f seconds ago",
+                                  edgetest.edgename, now - cached.finished)
+                    return cached.future, False
+
+            cached = _CachedProbe(key)
+            self.probes[edgetest.edgename] = cached
+            return cached.future, True
+
+    def latest(self, edgename):
+        '''The (fetch_result, fetch_status, phase_times) of the most recent
+        probe of an edge to finish, or None if it hasn't been probed yet
+        '''
+        return self.latest_results.get(edgename)
+
+    def publish(self, edgename, future, fetch_result, fetch_status, phase_times):
+        ''' Hand the recorded result of an owned probe on to other dnets '''
+        result = (fetch_result, fetch_status, dict(phase_times))
+        self.latest_results[edgename] = result
+        self._finish(edgename, future, result)
+
+    def abandon(self, edgename, future):
+        ''' Give up on an owned probe, leaving other dnets without a result '''
+        if not future.done():
+            self._finish(edgename, future, None)
+
+    def _finish(self, edgename, future, result):
+        with self.lock:
+            cached = self.probes.get(edgename)
+            if cached is not None and cached.future is future:
+                cached.finished = time.time()
+        future.set_result(result)
+
+
+class _CachedProbe(object):
+
+    def __init__(self, key):
+        ''' A probe of an edge, as shared through a ProbeCache '''
+        self.key = key
+        self.future = Future()
+        # time.time() at which the result was published
+        self.finished = None
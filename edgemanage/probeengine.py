@@ -0,0 +1,842 @@
+# stdlib
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import Queue
+import random
+import select
+import socket
+import ssl
+import threading
+import time
+import traceback
+
+# local
+import const
+from edgetest import ConnectFailed, VerifyFailed, FetchFailed, failed_phase_times
+
+# external
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+# Upper bound on the size of a response header block before the event
+# loop engine gives up on a fetch
+MAX_HEADER_SIZE = 65536
+
+
+def future_fetch(edgetest, testobject_host, testobject_path,
+                 testobject_proto, testobject_port, testobject_verify):
+    """Helper function to give us a return value that plays nice with as_completed"""
+
+    fetch_status = None
+    try:
+        fetch_result = edgetest.fetch(testobject_host, testobject_path,
+                                      testobject_proto, testobject_port,
+                                      testobject_verify)
+    except VerifyFailed:
+        # Ensure that we don't use hosts where verification has failed
+        fetch_result = const.FETCH_TIMEOUT
+        fetch_status = "verify_failed"
+    except FetchFailed:
+        # Ensure that we don't use hosts where fetching the object has
+        # caused a HTTP error
+        fetch_result = const.FETCH_TIMEOUT
+        fetch_status = "fetch_failed"
+    except ConnectFailed:
+        # Worth another go - ProbeScheduler decides whether to retry
+        fetch_result = const.FETCH_TIMEOUT
+        fetch_status = "connect_failed"
+    except Exception:
+        logging.error("Uncaught exception in fetch! %s", traceback.format_exc())
+    return {edgetest.edgename: (fetch_result, fetch_status)}
+
+
+def _timed_getaddrinfo(host, port):
+    ''' Resolve host in the resolver pool, returning the time it took too '''
+    start = time.time()
+    addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    return addrinfo, time.time() - start
+
+
+def get_probe_engine(config):
+    ''' Build the probe engine selected by the probe_engine config option '''
+
+    engine_name = config.get("probe_engine", "threads")
+    if engine_name == "threads":
+        return ThreadedProbeEngine(config["workers"])
+    elif engine_name == "eventloop":
+        return EventLoopProbeEngine(config.get("probe_concurrency",
+                                               const.PROBE_CONCURRENCY))
+    else:
+        raise ValueError("probe_engine must be one of %s, not %s" %
+                         (str(const.PROBE_ENGINES), engine_name))
+
+
+class ThreadedProbeEngine(object):
+
+    def __init__(self, workers):
+        '''A probe engine that runs every EdgeTest.fetch in a blocking
+        worker thread.
+
+        Args:
+         workers: the number of fetches to run in parallel
+
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.concurrency = workers
+        # The number of fetches submitted that have yet to finish
+        self.unfinished = 0
+        self.unfinished_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+    def submit(self, edgetest, fetch_host, fetch_object, proto, port, verify):
+        ''' Queue a fetch, returning a Future for its future_fetch result '''
+        future = self.executor.submit(future_fetch, edgetest, fetch_host,
+                                      fetch_object, proto, port, verify)
+        with self.unfinished_lock:
+            self.unfinished += 1
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self.unfinished_lock:
+            self.unfinished -= 1
+
+    def outstanding(self):
+        ''' The number of fetches that are queued or running '''
+        return self.unfinished
+
+    def as_completed(self, futures):
+        return as_completed(futures)
+
+    def collect(self, completed, timeout=None):
+        '''Wait up to timeout seconds for futures to be put on the
+        completed queue, returning all that have been.
+
+        '''
+        try:
+            done = [completed.get(timeout=timeout)]
+        except Queue.Empty:
+            return []
+        while True:
+            try:
+                done.append(completed.get_nowait())
+            except Queue.Empty:
+                return done
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class EventLoopProbeEngine(object):
+
+    def __init__(self, concurrency):
+        '''A probe engine that multiplexes fetches over non-blocking
+        sockets on the calling thread, so that the number of fetches
+        in flight is not bound by the number of worker threads. Only
+        DNS lookups are handed off to a small thread pool as the
+        resolver has no non-blocking interface.
+
+        The loop is driven from as_completed and collect - nothing
+        happens in the background while the caller isn't waiting on
+        results. The engine can be shared between threads, in which
+        case whichever thread is collecting results runs the loop for
+        the others.
+
+        Args:
+         concurrency: the maximum number of fetches in flight at once
+
+        '''
+        self.concurrency = concurrency
+        # Probes that have been submitted but not yet started. These
+        # can still be cancelled through their Future.
+        self.queued = collections.deque()
+        self.running = set()
+        self.fd_map = {}
+        self.poller = select.poll()
+        self.resolver = ThreadPoolExecutor(max_workers=const.PROBE_RESOLVER_WORKERS)
+        # verify -> SSLContext for https probes, made once as loading
+        # the CA store takes a while
+        self.ssl_contexts = {True: ssl.create_default_context(),
+                             False: ssl.create_default_context()}
+        self.ssl_contexts[False].check_hostname = False
+        self.ssl_contexts[False].verify_mode = ssl.CERT_NONE
+        # Held by the thread running the loop
+        self.lock = threading.Lock()
+        # Written to by submit to get a running loop to start new probes
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for wakeup_fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(wakeup_fd, fcntl.F_SETFL,
+                        fcntl.fcntl(wakeup_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_r, select.POLLIN)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+    def submit(self, edgetest, fetch_host, fetch_object, proto, port, verify):
+        ''' Queue a fetch, returning a Future for its future_fetch result '''
+        probe = _LoopProbe(edgetest, fetch_host, fetch_object, proto, port, verify)
+        self.queued.append(probe)
+        try:
+            os.write(self.wakeup_w, "x")
+        except OSError as exc:
+            # The pipe is full, so the loop has plenty of wakeups
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return probe.future
+
+    def outstanding(self):
+        ''' The number of fetches that are queued or running '''
+        return len(self.queued) + len(self.running)
+
+    def as_completed(self, futures):
+        ''' Run the loop, yielding futures as they complete '''
+        pending = set(futures)
+        while pending:
+            done = [future for future in pending if future.done()]
+            if not done:
+                with self.lock:
+                    self._tick()
+                continue
+            for future in done:
+                pending.discard(future)
+                yield future
+
+    def collect(self, completed, timeout=None):
+        '''Run the loop for up to timeout seconds or until futures have
+        been put on the completed queue, returning all that have been.
+
+        '''
+        until = None
+        if timeout is not None:
+            until = time.time() + timeout
+        while completed.empty() and (self.queued or self.running):
+            if until is not None and time.time() >= until:
+                break
+            if self.lock.acquire(False):
+                try:
+                    self._tick(until)
+                finally:
+                    self.lock.release()
+            else:
+                # Another thread is running the loop - check in every
+                # so often in case it stops.
+                wait = const.PROBE_RESOLVE_INTERVAL
+                if until is not None:
+                    wait = max(0, min(wait, until - time.time()))
+                try:
+                    return [completed.get(timeout=wait)] + self._drain(completed)
+                except Queue.Empty:
+                    pass
+
+        done = self._drain(completed)
+        if not done and until is not None:
+            # Nothing left in the loop to wait on
+            time.sleep(max(0, until - time.time()))
+        return done
+
+    def shutdown(self):
+        with self.lock:
+            while self.queued or self.running:
+                self._tick()
+        self.resolver.shutdown(wait=True)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def _drain(self, completed):
+        done = []
+        while True:
+            try:
+                done.append(completed.get_nowait())
+            except Queue.Empty:
+                return done
+
+    def _start_queued(self, now):
+        while self.queued and len(self.running) < self.concurrency:
+            probe = self.queued.popleft()
+            # Returns False if the future has been cancelled
+            if probe.future.set_running_or_notify_cancel():
+                probe.start(now, self.resolver, self.ssl_contexts)
+                self.running.add(probe)
+
+    def _step(self, probe, handler, now):
+        try:
+            handler(now)
+        except Exception:
+            logging.error("Uncaught exception in fetch! %s", traceback.format_exc())
+            probe.finish(const.FETCH_TIMEOUT, "fetch_failed")
+        self._sync(probe)
+
+    def _sync(self, probe):
+        ''' Bring the poller registration in line with what a probe waits on '''
+        wanted_fd = None
+        if probe.sock is not None and probe.want:
+            wanted_fd = probe.fd
+
+        if probe.registered_fd is not None and probe.registered_fd != wanted_fd:
+            self.poller.unregister(probe.registered_fd)
+            del(self.fd_map[probe.registered_fd])
+            probe.registered_fd = None
+
+        if wanted_fd is not None:
+            if probe.registered_fd == wanted_fd:
+                self.poller.modify(wanted_fd, probe.want)
+            else:
+                self.poller.register(wanted_fd, probe.want)
+                self.fd_map[wanted_fd] = probe
+                probe.registered_fd = wanted_fd
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _tick(self, until=None):
+        now = time.time()
+        self._start_queued(now)
+        if not self.running:
+            return
+
+        for probe in list(self.running):
+            if probe.state == "resolve" and probe.resolve_future.done():
+                self._step(probe, probe.resolved, now)
+
+        if any([probe.state == "resolve" for probe in self.running]):
+            # Keep checking in on lookups running in the resolver pool
+            timeout = const.PROBE_RESOLVE_INTERVAL
+        else:
+            timeout = min([probe.deadline for probe in self.running]) - now
+        if until is not None:
+            timeout = min(timeout, until - now)
+        timeout_ms = max(0, int(timeout * 1000)) + 1
+
+        for fd, _ in self.poller.poll(timeout_ms):
+            if fd == self.wakeup_r:
+                self._drain_wakeups()
+                continue
+            probe = self.fd_map.get(fd)
+            if probe is not None:
+                self._step(probe, probe.io_ready, time.time())
+
+        now = time.time()
+        for probe in list(self.running):
+            if probe.result is None and now >= probe.deadline:
+                probe.timed_out()
+                self._sync(probe)
+            if probe.result is not None:
+                self.running.discard(probe)
+                probe.future.set_result({probe.edgetest.edgename: probe.result})
+
+
+class ProbeScheduler(object):
+
+    def __init__(self, probe_engine, max_attempts=const.FETCH_RETRY,
+                 retry_backoff=const.RETRY_BACKOFF):
+        '''Runs the fetches for a set of edges on a probe engine,
+        retrying connection errors and hedging slow fetches.
+
+        Rather than retrying straight away and holding on to a worker
+        while doing so, a failed connection is handed back here and
+        retried after a jittered exponential backoff, leaving the
+        engine free to test other edges in the meantime. Retries are
+        bounded by max_attempts rather than by time, so that an edge
+        that spent a while queued behind others still gets them.
+
+        Args:
+         probe_engine: the engine to submit fetches to
+         max_attempts: the number of times to try connecting to an edge
+         retry_backoff: seconds to wait, at most, before the first retry -
+          doubled for every retry after that
+
+        '''
+        self.probe_engine = probe_engine
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+
+        self.tasks = {}
+        # future -> (_EdgeProbes, the EdgeTest it was submitted with)
+        self.futures = {}
+        # Futures are put here as they complete
+        self.completed = Queue.Queue()
+        # A heap of (due time, sequence, action, _EdgeProbes) for
+        # retries and hedges that are yet to be started
+        self.timers = []
+        self.timer_seq = itertools.count()
+
+    def add(self, edgetest, fetch_host, fetch_object, proto, port, verify,
+            hedge_delay=None, start_delay=0):
+        '''Start testing an edge
+
+        Args:
+         hedge_delay: seconds after which a second fetch is sent to the
+          edge if the first still hasn't been answered, or None to never
+          hedge
+         start_delay: seconds to wait before testing the edge
+
+        '''
+        task = _EdgeProbes(edgetest, (fetch_host, fetch_object, proto, port, verify))
+        task.hedge_delay = hedge_delay
+        self.tasks[edgetest.edgename] = task
+        if start_delay > 0:
+            self._schedule(time.time() + start_delay, "start", task)
+        else:
+            self._start(task, time.time())
+
+    def cancel(self, edgenames):
+        '''Give up on testing edges. Fetches that have yet to start are
+        cancelled and failed connections are no longer retried, though
+        fetches that are already running still have their results
+        returned.
+
+        Returns a tuple of the number of fetches cancelled and the
+        number of edges that were given up on.
+
+        '''
+        cancelled = 0
+        total = 0
+        for edgename in edgenames:
+            task = self.tasks.get(edgename)
+            if task is None or task.finished:
+                continue
+            total += 1
+            task.cancelled = True
+            if task.started is None:
+                # Still waiting for its start_delay to pass
+                cancelled += 1
+            for future in list(task.in_flight):
+                if future.cancel():
+                    cancelled += 1
+        return cancelled, total
+
+    def waiting(self):
+        '''The number of edges that are waiting to be started or retried,
+        rather than having a fetch on the probe engine
+        '''
+        return len([task for task in self.tasks.itervalues()
+                    if not (task.finished or task.cancelled or task.in_flight)])
+
+    def results(self):
+        '''Run until every edge has been tested, yielding a tuple of
+        (EdgeTest, fetch_result, fetch_status) for each. The EdgeTest
+        is the one the result came from, which may be a hedge of the
+        one that was added.
+
+        '''
+        while True:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, action, task = heapq.heappop(self.timers)
+                if action == "start":
+                    self._start(task, now)
+                elif action == "retry":
+                    self._retry(task)
+                else:
+                    self._hedge(task, now)
+            # Don't hang around for retries and hedges of edges that
+            # are already done with
+            while self.timers and (self.timers[0][3].finished or
+                                   self.timers[0][3].cancelled):
+                heapq.heappop(self.timers)
+            if not self.futures and not self.timers:
+                break
+
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            if not self.futures:
+                time.sleep(timeout)
+                continue
+
+            for future in self.probe_engine.collect(self.completed, timeout):
+                result = self._completed(future, time.time())
+                if result is not None:
+                    yield result
+
+    def _schedule(self, when, action, task):
+        heapq.heappush(self.timers, (when, next(self.timer_seq), action, task))
+
+    def _submit(self, task, edgetest):
+        future = self.probe_engine.submit(edgetest, *task.fetch_args)
+        self.futures[future] = (task, edgetest)
+        task.in_flight.add(future)
+        future.add_done_callback(self.completed.put)
+
+    def _start(self, task, now):
+        if task.cancelled:
+            return
+        task.started = now
+        self._submit(task, task.edgetest)
+        if task.hedge_delay is not None:
+            self._schedule(now + task.hedge_delay, "hedge", task)
+
+    def _retry(self, task):
+        if task.cancelled:
+            return
+        task.attempts += 1
+        self._submit(task, task.edgetest)
+
+    def _hedge(self, task, now):
+        if task.finished or task.cancelled or task.hedged or not task.in_flight:
+            return
+        if not any([future.running() for future in task.in_flight]):
+            # Still waiting on a worker, so the fetch isn't slow yet
+            self._schedule(now + task.hedge_delay, "hedge", task)
+            return
+        logging.debug("No answer from %s after %f seconds, sending hedged request",
+                      task.edgetest.edgename, task.hedge_delay)
+        task.hedged = True
+        self._submit(task, task.edgetest.hedge())
+
+    def _completed(self, future, now):
+        if future not in self.futures:
+            # Lost out to another fetch from the same edge
+            return None
+        task, edgetest = self.futures.pop(future)
+        task.in_flight.discard(future)
+        if future.cancelled():
+            return None
+
+        fetch_result, fetch_status = future.result()[edgetest.edgename]
+        if fetch_status == "connect_failed":
+            if task.in_flight:
+                # The other fetch might still get through
+                return None
+            if not task.cancelled and task.attempts < self.max_attempts:
+                # Full jitter, so that edges that failed together don't
+                # all come back at once
+                delay = random.uniform(0, self.retry_backoff * 2 ** (task.attempts - 1))
+                logging.warning("Retrying connection to %s in %f seconds",
+                                edgetest.edgename, delay)
+                self._schedule(now + delay, "retry", task)
+                return None
+            logging.error("Failed to connect to %s after trying %d times",
+                          edgetest.edgename, task.attempts)
+            fetch_status = None
+        elif (fetch_result == const.FETCH_TIMEOUT and fetch_status is None and
+              task.in_flight):
+            # Timed out, but the other fetch could still beat the clock
+            return None
+
+        task.finished = True
+        if edgetest is not task.edgetest:
+            # The hedge won
+            task.edgetest.take_validators(edgetest)
+        for other_future in task.in_flight:
+            other_future.cancel()
+            del(self.futures[other_future])
+        task.in_flight.clear()
+        return edgetest, fetch_result, fetch_status
+
+
+class _EdgeProbes(object):
+
+    def __init__(self, edgetest, fetch_args):
+        ''' The fetches ProbeScheduler has made to a single edge '''
+
+        self.edgetest = edgetest
+        self.fetch_args = fetch_args
+        # time.time() of the first fetch
+        self.started = None
+        self.attempts = 1
+        self.hedge_delay = None
+        self.hedged = False
+        self.in_flight = set()
+        self.cancelled = False
+        self.finished = False
+
+
+class _LoopProbe(object):
+
+    def __init__(self, edgetest, fetch_host, fetch_object, proto, port, verify):
+        ''' The state of a single fetch running on the EventLoopProbeEngine '''
+
+        self.edgetest = edgetest
+        self.future = Future()
+        self.fetch_host = fetch_host
+        self.proto = proto
+        self.port = int(port)
+        self.verify = verify
+        if not fetch_object.startswith("/"):
+            fetch_object = "/" + fetch_object
+        self.fetch_object = fetch_object
+
+        self.request_headers = edgetest.request_headers(fetch_host)
+        self.request = "GET %s HTTP/1.0\r\n%sConnection: close\r\n\r\n" % (
+            fetch_object, "".join(["%s: %s\r\n" % header
+                                   for header in self.request_headers.iteritems()]))
+
+        # One of resolve, connect, handshake, send, recv_head or
+        # recv_body
+        self.state = None
+        self.resolve_future = None
+        self.ssl_context = None
+        self.started = None
+        self.deadline = None
+        self.sock = None
+        self.fd = None
+        self.registered_fd = None
+        # select.POLLIN or select.POLLOUT
+        self.want = None
+
+        self.outbuf = ""
+        self.inbuf = ""
+        self.hasher = None
+        self.etag = None
+        self.body_left = None
+        self.connect_time = None
+        self.phase_times = {}
+        self.connect_started = None
+        self.connected_at = None
+        self.request_started = None
+        self.headers_at = None
+        self.elapsed = None
+        # (fetch_result, fetch_status) once the fetch is over
+        self.result = None
+
+    def start(self, now, resolver, ssl_contexts):
+        self.started = now
+        self.ssl_context = ssl_contexts[bool(self.verify)]
+        self.deadline = now + const.FETCH_TIMEOUT
+        self.state = "resolve"
+        self.want = None
+        self.resolve_future = resolver.submit(_timed_getaddrinfo, self.edgetest.edgename,
+                                              self.port)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self.want = None
+
+    def finish(self, fetch_result, fetch_status=None, phase_times=None):
+        self.close()
+        self.edgetest.connect_time = self.connect_time
+        self.edgetest.phase_times = phase_times or failed_phase_times()
+        self.result = (fetch_result, fetch_status)
+
+    def succeed(self, now):
+        self.phase_times["transfer"] = now - self.headers_at
+        self.finish(self.elapsed, phase_times=self.phase_times)
+
+    def timed_out(self):
+        # Just assume it took the maximum amount of time
+        self.finish(const.FETCH_TIMEOUT)
+
+    def connection_failed(self, now, exc):
+        # As with future_fetch, retrying is left to ProbeScheduler
+        logging.error("Connection error when fetching from %s: %s",
+                      self.edgetest.edgename, str(exc))
+        self.finish(const.FETCH_TIMEOUT, "connect_failed")
+
+    def fetch_failed(self, reason):
+        logging.error("Object fetch failed on %s:%s (%s)",
+                      self.edgetest.edgename, self.port, reason)
+        self.finish(const.FETCH_TIMEOUT, "fetch_failed")
+
+    def resolved(self, now):
+        try:
+            addrinfo, self.phase_times["dns"] = self.resolve_future.result()
+        except socket.error as exc:
+            return self.connection_failed(now, exc)
+        family, socktype, proto, _, sockaddr = addrinfo[0]
+        self.connect_started = now
+
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.outbuf = self.request
+        self.inbuf = ""
+
+        connect_err = self.sock.connect_ex(sockaddr)
+        if connect_err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return self.connection_failed(now, socket.error(connect_err,
+                                                            os.strerror(connect_err)))
+        self.state = "connect"
+        self.want = select.POLLOUT
+
+    def io_ready(self, now):
+        if self.state == "connect":
+            self._connected(now)
+        elif self.state == "handshake":
+            self._handshake(now)
+        elif self.state == "send":
+            self._send(now)
+        elif self.state in ("recv_head", "recv_body"):
+            self._recv(now)
+
+    def _connected(self, now):
+        connect_err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if connect_err:
+            return self.connection_failed(now, socket.error(connect_err,
+                                                            os.strerror(connect_err)))
+
+        self.phase_times["connect"] = now - self.connect_started
+        self.connected_at = now
+        if self.proto == "https":
+            # Like requests, verify against the name of the edge
+            # rather than the Host header
+            self.sock = self.ssl_context.wrap_socket(self.sock,
+                                                     server_hostname=self.edgetest.edgename,
+                                                     do_handshake_on_connect=False)
+            self.state = "handshake"
+            self._handshake(now)
+        else:
+            self._start_request(now)
+
+    def _handshake(self, now):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want = select.POLLIN
+            return
+        except ssl.SSLWantWriteError:
+            self.want = select.POLLOUT
+            return
+        except socket.error as exc:
+            return self.connection_failed(now, exc)
+
+        self._start_request(now)
+
+    def _start_request(self, now):
+        # Every fetch on this engine sets up a new connection, which
+        # is timed separately so that fetch times are comparable with
+        # those of the threads engine reusing connections.
+        if self.proto == "https":
+            self.phase_times["tls"] = now - self.connected_at
+        else:
+            self.phase_times["tls"] = 0.0
+        self.connect_time = sum([self.phase_times["dns"], self.phase_times["connect"],
+                                 self.phase_times["tls"]])
+        self.request_started = now
+        self.state = "send"
+        self._send(now)
+
+    def _send(self, now):
+        try:
+            sent = self.sock.send(self.outbuf)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            sent = 0
+        except socket.error as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return self.connection_failed(now, exc)
+            sent = 0
+
+        self.outbuf = self.outbuf[sent:]
+        if self.outbuf:
+            self.want = select.POLLOUT
+        else:
+            self.state = "recv_head"
+            self.want = select.POLLIN
+
+    def _recv(self, now):
+        while self.result is None:
+            try:
+                chunk = self.sock.recv(const.FETCH_CHUNK_SIZE)
+            except ssl.SSLWantReadError:
+                self.want = select.POLLIN
+                return
+            except ssl.SSLWantWriteError:
+                self.want = select.POLLOUT
+                return
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.want = select.POLLIN
+                    return
+                if self.state == "recv_head":
+                    return self.connection_failed(now, exc)
+                return self.fetch_failed(str(exc))
+
+            if not chunk:
+                return self._eof(now)
+            self._feed(chunk, now)
+
+    def _feed(self, chunk, now):
+        if self.state == "recv_head":
+            self.inbuf += chunk
+            head_end = self.inbuf.find("\r\n\r\n")
+            if head_end == -1:
+                if len(self.inbuf) > MAX_HEADER_SIZE:
+                    self.fetch_failed("response header too large")
+                return
+
+            head_lines = self.inbuf[:head_end].split("\r\n")
+            chunk = self.inbuf[head_end + 4:]
+            self.inbuf = ""
+            # Mirrors requests' response.elapsed, which stops the
+            # clock once the headers have been parsed
+            self.elapsed = now - self.request_started
+            self.phase_times["ttfb"] = self.elapsed
+            self.headers_at = now
+
+            status_line = head_lines[0].split(None, 2)
+            try:
+                status = int(status_line[1])
+            except (IndexError, ValueError):
+                return self.fetch_failed("malformed status line %r" % head_lines[0])
+
+            for header_line in head_lines[1:]:
+                header_name, _, header_value = header_line.partition(":")
+                header_name = header_name.strip().lower()
+                if header_name == "content-length":
+                    try:
+                        self.body_left = int(header_value.strip())
+                    except ValueError:
+                        return self.fetch_failed("bad Content-Length %r" % header_value)
+                elif header_name == "etag":
+                    self.etag = header_value.strip()
+
+            # Redirects aren't followed, so anything but a 2xx (or a
+            # 304 for a conditional request) is a failure
+            try:
+                self.hasher = self.edgetest.start_verify(self.fetch_host, self.fetch_object,
+                                                         status, self.request_headers)
+            except FetchFailed:
+                return self.finish(const.FETCH_TIMEOUT, "fetch_failed")
+            if self.hasher is None:
+                return self.succeed(now)
+            self.state = "recv_body"
+
+        if not self.hasher.update(chunk):
+            try:
+                self.edgetest.body_too_large(self.fetch_host, self.fetch_object, self.hasher)
+            except VerifyFailed:
+                return self.finish(const.FETCH_TIMEOUT, "verify_failed")
+        if self.body_left is not None:
+            self.body_left -= len(chunk)
+            if self.body_left <= 0:
+                self._verify(now)
+
+    def _eof(self, now):
+        if self.state == "recv_head":
+            return self.connection_failed(now, "connection closed before response")
+        if self.body_left:
+            return self.fetch_failed("connection closed with %d bytes of body "
+                                     "outstanding" % self.body_left)
+        self._verify(now)
+
+    def _verify(self, now):
+        try:
+            self.edgetest.finish_verify(self.fetch_host, self.fetch_object,
+                                        self.hasher, self.etag)
+        except VerifyFailed:
+            return self.finish(const.FETCH_TIMEOUT, "verify_failed")
+        self.succeed(now)
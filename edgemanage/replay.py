@@ -0,0 +1,271 @@
+from .decisionmaker import get_decision_maker
+from .edgelist import EdgeList
+from .edgemanage import EdgeManage
+from .edgestate import EdgeState
+from .healthstore import JSONHealthStore
+from .statefile import StateFile
+import const
+
+import collections
+import shutil
+import tempfile
+
+
+def store_samples(store, edgenames=None):
+    '''Every fetch time kept in a health store - only those of the
+    given edges, if any - as (timestamp, edgename, value, phase_times)
+    samples, oldest first. phase_times is None unless the store has
+    the time of every phase of the fetch.
+
+    '''
+    samples = []
+    for edgename in store.edgenames():
+        if edgenames is not None and edgename not in edgenames:
+            continue
+        edge_state = EdgeState(edgename, None, nowrite=True, store=store)
+        phase_values = dict([(phase, dict(series.items())) for phase, series
+                             in edge_state.phase_times.iteritems()])
+        for timestamp, value in edge_state.fetch_times.items():
+            phase_times = dict([(phase, values[timestamp]) for phase, values
+                                in phase_values.iteritems() if timestamp in values])
+            if len(phase_times) != len(const.PROBE_PHASES):
+                phase_times = None
+            samples.append((timestamp, edgename, value, phase_times))
+    samples.sort(key=lambda sample: sample[:2])
+    return samples
+
+
+def read_samples(sample_f):
+    '''Read fetch times recorded one to a line as "edgename timestamp
+    value" - skipping blank lines and # comments - as samples, oldest
+    first, like store_samples
+
+    '''
+    samples = []
+    for line_number, line in enumerate(sample_f, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        try:
+            edgename, timestamp, value = line.split()
+            samples.append((float(timestamp), edgename, float(value), None))
+        except ValueError:
+            raise ValueError("Can't parse line %d of the samples: %s" % (line_number, line))
+    samples.sort(key=lambda sample: sample[:2])
+    return samples
+
+
+class ReplayEdgeManage(EdgeManage):
+
+    def __init__(self, dnet, config, state, clock):
+        '''An EdgeManage that only chooses edges, from edge states
+        handed to it, judged by a decision maker on a simulated clock.
+        There is no test object, no canaries and no zone files, so
+        make_edges_live writes nothing out.
+
+        '''
+        self.dnet = dnet
+        self.dry_run = True
+        self.config = config
+        self.state_obj = state
+        self.canary_data = {}
+        self.canary_edges = frozenset()
+        self.edgelist_obj = EdgeList()
+        self.decision = get_decision_maker(config)
+        self.decision.clock = clock
+        self.canary_decision = None
+        self.edge_states = {}
+        self.current_mtimes = {}
+
+    def flush_edge_states(self):
+        # Nothing is ever written out
+        pass
+
+
+class _NoRollups(object):
+
+    ''' Stands in for the Rollups of a replayed edge, as no decision uses them '''
+
+    def add(self, timestamp, value):
+        pass
+
+
+class Replay(object):
+
+    def __init__(self, config, dnet=None, interval=None):
+        '''Replays recorded samples through a DecisionMaker and the edge
+        selection of make_edges_live on a simulated clock, deciding
+        every interval seconds - by default every run_frequency - of
+        simulated time, without testing or writing anything.
+
+        Edges take part in a decision if they have a sample from the
+        last two intervals, as they would have been tested in the last
+        run. Decisions aren't made while there are none, as edgemanage
+        wasn't running. An interval in which nothing changed - no new
+        samples, no edges dropping out and no edges judged differently -
+        is taken to repeat the decision before it, once that decision
+        kept the live edges as they were. So is any interval in which
+        the live edges are all still passing the good_enough threshold,
+        once the decision before kept them live for it, as
+        make_edges_live would keep them whatever became of the rest.
+
+        '''
+        self.config = config
+        self.interval = interval or config.get("run_frequency") or 60
+        self.dnschange_period = config.get("dnschange_period", const.DNSCHANGE_PERIOD)
+        # The simulated time
+        self.now = None
+        self.state = StateFile()
+        self.edgemanage = ReplayEdgeManage(dnet, config, self.state, lambda: self.now)
+
+    def run(self, samples):
+        '''Replay samples - (timestamp, edgename, value, phase_times)
+        tuples, oldest first. Returns a summary of the decisions made:
+        how many there were, how many rotated the live edges, how many
+        would have rewritten the zone files and how many rotations
+        went over dnschange_maxfreq, along with the number of times
+        each edge was put into rotation and the seconds it spent in
+        rotation.
+
+        '''
+        store = JSONHealthStore(tempfile.mkdtemp())
+        try:
+            return self._run(samples, store)
+        finally:
+            shutil.rmtree(store.store_dir)
+
+    def _run(self, samples, store):
+        summary = {
+            "samples": len(samples),
+            "duration": samples[-1][0] - samples[0][0] if samples else 0,
+            "decisions": 0,
+            "rotations": 0,
+            "zone_rewrites": 0,
+            "maxfreq_exceeded": 0,
+            "edges": {},
+        }
+        # Edge states are kept in an empty store, and never written out
+        edge_states = {}
+        # edgename -> timestamp of its newest sample so far
+        last_sampled = {}
+        # edgename -> EdgeState of the edges that take part in decisions
+        tested = {}
+        # (timestamp, edgename) of the samples from the last two
+        # intervals, oldest first
+        recent = collections.deque()
+        # Whether the last decision left the live edges as they were
+        settled = False
+        # Whether it did so because they were all still passing the
+        # good_enough threshold
+        kept_live = False
+        # Times of the rotations in the last dnschange_period
+        rotation_times = collections.deque()
+        maxfreq = self.config.get("dnschange_maxfreq")
+        last_decision = None
+        index = 0
+        if samples:
+            self.now = samples[0][0]
+
+        while index < len(samples):
+            self.now += self.interval
+            changed = False
+            while index < len(samples) and samples[index][0] <= self.now:
+                timestamp, edgename, value, phase_times = samples[index]
+                if edgename not in edge_states:
+                    edge_states[edgename] = EdgeState(edgename, None, nowrite=True, store=store)
+                    edge_states[edgename].rollups = _NoRollups()
+                    summary["edges"][edgename] = {"rotations": 0, "time_in_rotation": 0}
+                edge_states[edgename].add_value(value, timestamp, phase_times)
+                last_sampled[edgename] = timestamp
+                tested[edgename] = edge_states[edgename]
+                recent.append((timestamp, edgename))
+                changed = True
+                index += 1
+            while recent and recent[0][0] <= self.now - 2 * self.interval:
+                timestamp, edgename = recent.popleft()
+                # Unless the edge has been sampled since
+                if (last_sampled[edgename] == timestamp and
+                        tested.pop(edgename, None) is not None):
+                    changed = True
+
+            if not tested:
+                # Skip ahead to the next sample
+                self.now = samples[index][0] - self.interval
+                continue
+
+            if last_decision is not None:
+                elapsed = min(self.now - last_decision, self.interval)
+                for edgename in self.state.last_live:
+                    summary["edges"][edgename]["time_in_rotation"] += elapsed
+            last_decision = self.now
+            summary["decisions"] += 1
+
+            if kept_live:
+                if self._live_edges_passing(tested):
+                    continue
+            elif settled and not changed and self._judgements_unchanged():
+                continue
+            any_changes = self._decide(dict(tested))
+            if any_changes:
+                summary["zone_rewrites"] += 1
+
+            live_edges = self.edgemanage.edgelist_obj.get_live_edges()
+            settled = live_edges == self.state.last_live and not any_changes
+            kept_live = (settled and
+                         len(live_edges) == self.edgemanage.required_edge_count() and
+                         all([self.edgemanage.decision.current_judgement.get(edgename) ==
+                              "pass_threshold" for edgename in live_edges]))
+            if live_edges != self.state.last_live:
+                # As counted by edge_manage
+                summary["rotations"] += 1
+                rotation_times.append(self.now)
+                while rotation_times[0] <= self.now - self.dnschange_period:
+                    rotation_times.popleft()
+                if maxfreq is not None and len(rotation_times) > maxfreq:
+                    summary["maxfreq_exceeded"] += 1
+                for edgename in set(live_edges) - set(self.state.last_live):
+                    summary["edges"][edgename]["rotations"] += 1
+            self.state.last_live = live_edges
+
+        for edgename in self.state.last_live:
+            summary["edges"][edgename]["time_in_rotation"] += self.interval
+        return summary
+
+    def _judgements_unchanged(self):
+        '''Whether the edges that took part in the last decision are
+        still judged as they were then, as the oldest samples in their
+        time slices drop out of it
+        '''
+        decision = self.edgemanage.decision
+        judgements = dict(decision.current_judgement)
+        decision.check_threshold(self.config["goodenough"])
+        return decision.current_judgement == judgements
+
+    def _live_edges_passing(self, tested):
+        '''Whether the live edges are all still being tested and passing
+        the good_enough threshold. Only the live edges are judged, and
+        only if they have new samples or their time slices have moved
+        on, leaving the decision maker holding just them.
+        '''
+        decision = self.edgemanage.decision
+        decision.reset()
+        for edgename in self.state.last_live:
+            if edgename not in tested:
+                return False
+            decision.add_edge_state(tested[edgename])
+        decision.check_threshold(self.config["goodenough"])
+        return all([judgement == "pass_threshold"
+                    for judgement in decision.current_judgement.itervalues()])
+
+    def _decide(self, edge_states):
+        '''Choose the live edges from edge states, as edge_manage does
+        after testing them. Returns whether the zone files would be
+        written out.
+
+        '''
+        self.edgemanage.edgelist_obj = EdgeList()
+        self.edgemanage.decision.reset()
+        self.edgemanage.edge_states = edge_states
+        for edge_state in edge_states.itervalues():
+            self.edgemanage.decision.add_edge_state(edge_state)
+        return self.edgemanage.make_edges_live(False)
@@ -0,0 +1,110 @@
+import collections
+
+from const import ROLLUP_TIERS, ROLLUP_QUANTILES
+from sketch import QuantileSketch
+
+
+class RollupBucket(object):
+
+    __slots__ = ["start", "count", "total", "minimum", "maximum", "sketch"]
+
+    def __init__(self, start, count=0, total=0.0, minimum=None, maximum=None, sketch=None):
+        '''The values that arrived in a period starting at a timestamp:
+        their count, total, minimum, maximum and a QuantileSketch of
+        them
+
+        '''
+        self.start = start
+        self.count = count
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sketch = sketch or QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.sketch.add(value)
+
+    def quantile(self, percent):
+        ''' Estimate the value that percent of the values fall at or below '''
+        if not self.count:
+            return None
+        if percent >= 100:
+            return self.maximum
+        if percent <= 0:
+            return self.minimum
+        return min(max(self.sketch.quantile(percent), self.minimum), self.maximum)
+
+    def summary(self):
+        summary = {
+            "start": self.start,
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.minimum,
+            "max": self.maximum,
+        }
+        for percent in ROLLUP_QUANTILES:
+            summary["p%d" % percent] = self.quantile(percent)
+        return summary
+
+    def to_list(self):
+        return [self.start, self.count, self.total, self.minimum, self.maximum,
+                self.sketch.to_dict()]
+
+    @classmethod
+    def from_list(cls, bucket_list):
+        start, count, total, minimum, maximum, sketch = bucket_list
+        return cls(start, count, total, minimum, maximum, QuantileSketch.from_dict(sketch))
+
+
+class Rollups(object):
+
+    def __init__(self):
+        '''RRD-style rollups of a series of values: for each of the
+        ROLLUP_TIERS, a bounded number of buckets of a fixed length,
+        updated as each value arrives. Adding a value is O(1) and the
+        size is constant however long the series goes on for.
+
+        '''
+        self.tiers = collections.OrderedDict()
+        for tier_name, length, size in ROLLUP_TIERS:
+            self.tiers[tier_name] = (length, collections.deque(maxlen=size))
+
+    def add(self, timestamp, value):
+        for length, buckets in self.tiers.itervalues():
+            start = timestamp - timestamp % length
+            if not buckets or buckets[-1].start < start:
+                # Older buckets fall off the other end of the deque
+                buckets.append(RollupBucket(start))
+            elif buckets[-1].start > start:
+                # Values are rolled up in time order, so a value from
+                # before the latest bucket is too late to be counted
+                continue
+            buckets[-1].add(value)
+
+    def summaries(self, tier_name, since=None):
+        '''Summaries of the buckets of a tier - their start, count,
+        mean, min, max and ROLLUP_QUANTILES - oldest first, optionally
+        only those starting at or after a timestamp
+
+        '''
+        length, buckets = self.tiers[tier_name]
+        return [bucket.summary() for bucket in buckets
+                if since is None or bucket.start >= since]
+
+    def to_dict(self):
+        return dict([(tier_name, [bucket.to_list() for bucket in buckets])
+                     for tier_name, (length, buckets) in self.tiers.iteritems()])
+
+    @classmethod
+    def from_dict(cls, rollups_dict):
+        rollups = cls()
+        for tier_name, (length, buckets) in rollups.tiers.iteritems():
+            for bucket_list in rollups_dict.get(tier_name, []):
+                buckets.append(RollupBucket.from_list(bucket_list))
+        return rollups
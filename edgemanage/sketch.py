@@ -0,0 +1,77 @@
+import math
+
+# Values are counted in logarithmic bins, each SKETCH_BIN_GROWTH times
+# wider than the last, starting from SKETCH_BIN_MIN seconds. Quantiles
+# estimated from the bins are within about 6% of the real value.
+SKETCH_BIN_MIN = 0.001
+SKETCH_BIN_GROWTH = 1.12
+
+
+def value_bin(value):
+    ''' The bin that a value is counted in '''
+    if value <= SKETCH_BIN_MIN:
+        return 0
+    return int(math.log(value / SKETCH_BIN_MIN) / math.log(SKETCH_BIN_GROWTH)) + 1
+
+
+def bin_value(index):
+    ''' The value in the middle of a bin '''
+    if index == 0:
+        return SKETCH_BIN_MIN
+    return SKETCH_BIN_MIN * SKETCH_BIN_GROWTH ** (index - 0.5)
+
+
+class QuantileSketch(object):
+
+    __slots__ = ["bins", "count"]
+
+    def __init__(self, bins=None):
+        '''A streaming quantile sketch: a sparse histogram of values in
+        logarithmic bins, keyed by value_bin. Its size depends only on
+        the range of the values - about 90 bins cover a millisecond to
+        ten seconds - and sketches can be merged, and values removed,
+        exactly.
+
+        '''
+        self.bins = bins or {}
+        self.count = sum(self.bins.itervalues())
+
+    def add(self, value, count=1):
+        index = value_bin(value)
+        self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+
+    def remove(self, value):
+        ''' Remove a value that was added earlier '''
+        index = value_bin(value)
+        if self.bins[index] == 1:
+            del(self.bins[index])
+        else:
+            self.bins[index] -= 1
+        self.count -= 1
+
+    def merge(self, other):
+        for index, count in other.bins.iteritems():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+
+    def quantile(self, percent):
+        '''Estimate the value that percent of the values fall at or
+        below, or None if there are none
+        '''
+        if not self.count:
+            return None
+        rank = max(percent / 100.0 * self.count, 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen >= rank:
+                return bin_value(index)
+        return bin_value(max(self.bins))
+
+    def to_dict(self):
+        return dict([(str(index), count) for index, count in self.bins.iteritems()])
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        return cls(dict([(int(index), count) for index, count in sketch_dict.iteritems()]))
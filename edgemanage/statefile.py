@@ -20,6 +20,9 @@ class StateFile(object):
         self.zone_mtimes = {}
         # Canary IP addresses in use for given domain
         self.active_canaries = {}
+        # The edges that would have been made live next the last time
+        # edges were chosen, best first, as [edgename, health, score]
+        self.next_in_line = []
 
         # Restore any existing saved values - setting values above
         # this means that we can add new values to the state file
@@ -0,0 +1,263 @@
+from array import array
+
+from sketch import QuantileSketch
+
+
+class TimeSeries(object):
+
+    def __init__(self, capacity):
+        '''A fixed capacity ring buffer of (timestamp, value) pairs,
+        oldest first. Appending to a full series evicts its oldest
+        value. Values must be appended in time order.
+
+        Timestamps and values are kept in parallel arrays of doubles
+        along with a running total, so appending, evicting and getting
+        the last value or the average are all O(1). So is summarising
+        the values since a time that moves steadily forward, like the
+        start of a sliding window. QuantileSketches of all the values and
+        of the values since that time are kept up to date along with
+        them, as is an exponentially weighted moving average once one
+        has been asked for.
+
+        '''
+        self.capacity = capacity
+        self.times = array('d')
+        self.values = array('d')
+        # Index of the oldest value once the arrays are full
+        self.start = 0
+        self.total = 0.0
+        # Number of values ever appended. Values are numbered in the
+        # order they were appended, and value n is at index n % capacity.
+        self.appended = 0
+        # Number of the first value included in since_total, as of the
+        # last call to summary_since
+        self.since_seq = 0
+        self.since_total = 0.0
+        self.sketch = QuantileSketch()
+        self.since_sketch = QuantileSketch()
+        # The half-life in seconds of the EWMA kept by ewma, if any,
+        # and the totals of the values and of their weights, decayed
+        # to ewma_time
+        self.halflife = None
+        self.ewma_total = 0.0
+        self.ewma_weight = 0.0
+        self.ewma_time = None
+
+    @classmethod
+    def from_dict(cls, capacity, series_dict):
+        '''Create a series from a dict keyed by stringified timestamps,
+        as kept in the edgestore, keeping the newest capacity values
+
+        '''
+        series = cls(capacity)
+        for timestamp, value in sorted([(float(key), value) for key, value in
+                                        series_dict.iteritems()])[-capacity:]:
+            series.append(timestamp, value)
+        return series
+
+    def to_dict(self):
+        ''' The series as a dict keyed by stringified timestamps '''
+        # HACK: for legacy reasons timestamps are stored as strings
+        return dict([(str(timestamp), value) for timestamp, value in self.items()])
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, timestamp):
+        ''' Get the value at a timestamp, stringified or not '''
+        timestamp = float(timestamp)
+        for item_time, value in self.items():
+            if item_time == timestamp:
+                return value
+        raise KeyError(timestamp)
+
+    def append(self, timestamp, value):
+        '''Add a value at the end of the series, returning the
+        (timestamp, value) it evicted if the series was full, or None
+
+        '''
+        evicted = None
+        if len(self.times) < self.capacity:
+            self.times.append(timestamp)
+            self.values.append(value)
+        else:
+            evicted = (self.times[self.start], self.values[self.start])
+            self.times[self.start] = timestamp
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+            self.total -= evicted[1]
+        self.total += value
+        self.since_total += value
+        self.sketch.add(value)
+        self.since_sketch.add(value)
+        self.appended += 1
+        if self.halflife is not None:
+            self._ewma_add(timestamp, value)
+        if evicted:
+            self.sketch.remove(evicted[1])
+        if evicted and self.since_seq < self.appended - len(self.times):
+            self.since_seq += 1
+            self.since_total -= evicted[1]
+            self.since_sketch.remove(evicted[1])
+        if evicted and self.start == 0:
+            # Recalculate the totals once per trip around the buffer so
+            # that floating point errors don't build up
+            self.total = sum(self.values)
+            self.since_total = sum([self.values[seq % self.capacity] for seq in
+                                    xrange(self.since_seq, self.appended)])
+        return evicted
+
+    def discard_until(self, timestamp):
+        ''' Drop every value at or before a timestamp '''
+        if not self.times or self.times[self.start] > timestamp:
+            return
+        items = [(item_time, value) for item_time, value in self.items()
+                 if item_time > timestamp]
+        # The EWMA already has the values that are kept in it
+        ewma_state = self.ewma_state()
+        self.halflife = None
+        self.times = array('d')
+        self.values = array('d')
+        self.start = 0
+        self.total = 0.0
+        self.appended = 0
+        self.since_seq = 0
+        self.since_total = 0.0
+        self.sketch = QuantileSketch()
+        self.since_sketch = QuantileSketch()
+        for item_time, value in items:
+            self.append(item_time, value)
+        if ewma_state is not None:
+            self.set_ewma(*ewma_state)
+
+    def _order(self):
+        ''' Indexes into the arrays, oldest first '''
+        return range(self.start, len(self.times)) + range(0, self.start)
+
+    def items(self):
+        ''' A list of (timestamp, value) pairs, oldest first '''
+        return [(self.times[index], self.values[index]) for index in self._order()]
+
+    def value_list(self):
+        return [self.values[index] for index in self._order()]
+
+    def last(self):
+        ''' The most recently added value '''
+        if not self.times:
+            raise IndexError("No values in series")
+        return self.values[self.start - 1]
+
+    def average(self):
+        return self.total / len(self.times)
+
+    def average_floor(self):
+        '''The lowest the average could be after appending one more
+        value, as none of the values are negative
+        '''
+        if len(self.times) < self.capacity:
+            return self.total / (len(self.times) + 1)
+        return (self.total - self.values[self.start]) / self.capacity
+
+    def quantile_floor(self, percent):
+        '''The lowest that sketch.quantile(percent) could be after
+        appending one more value
+        '''
+        sketch = QuantileSketch(dict(self.sketch.bins))
+        sketch.add(0.0)
+        if len(self.times) == self.capacity:
+            sketch.remove(self.values[self.start])
+        return sketch.quantile(percent)
+
+    def _ewma_decay(self, timestamp):
+        ''' What the EWMA totals decay by between ewma_time and a timestamp '''
+        if self.ewma_time is None or timestamp <= self.ewma_time:
+            return 1.0
+        return 0.5 ** ((timestamp - self.ewma_time) / self.halflife)
+
+    def _ewma_add(self, timestamp, value):
+        decay = self._ewma_decay(timestamp)
+        self.ewma_total = self.ewma_total * decay + value
+        self.ewma_weight = self.ewma_weight * decay + 1
+        if self.ewma_time is None or timestamp > self.ewma_time:
+            self.ewma_time = timestamp
+
+    def ewma(self, halflife):
+        '''The exponentially weighted moving average of the values, each
+        weighted half as much as one halflife seconds newer, or None if
+        there are none. Values that have been evicted still count, at
+        their weight.
+
+        The first call with a half-life works the EWMA out from the
+        values in the series. From then on it is kept up to date as
+        values are appended, in O(1).
+
+        '''
+        if halflife != self.halflife:
+            self.set_ewma(halflife, 0.0, 0.0, None)
+            for timestamp, value in self.items():
+                self._ewma_add(timestamp, value)
+        if not self.ewma_weight:
+            return None
+        return self.ewma_total / self.ewma_weight
+
+    def ewma_state(self):
+        '''The EWMA being kept, as [half-life, total, weight, time] for
+        set_ewma, or None if there isn't one
+        '''
+        if self.halflife is None:
+            return None
+        return [self.halflife, self.ewma_total, self.ewma_weight, self.ewma_time]
+
+    def set_ewma(self, halflife, total, weight, timestamp):
+        ''' Carry on keeping an EWMA saved from ewma_state '''
+        self.halflife = float(halflife)
+        self.ewma_total = total
+        self.ewma_weight = weight
+        self.ewma_time = timestamp
+
+    def ewma_floor(self, halflife, timestamp):
+        '''The lowest the EWMA could be after appending one more value
+        at or before a timestamp
+        '''
+        self.ewma(halflife)
+        decay = self._ewma_decay(timestamp)
+        return self.ewma_total * decay / (self.ewma_weight * decay + 1)
+
+    def summary_since(self, start):
+        '''The number and total of the values at or after a timestamp.
+        since_sketch is left holding the same values.
+
+        The values counted are tracked from one call to the next, so
+        this only looks at the values between the timestamp and the one
+        before, making it O(1) for a timestamp that moves forward with
+        new values.
+
+        '''
+        oldest_seq = self.appended - len(self.times)
+        # Drop values from before the timestamp...
+        while (self.since_seq < self.appended and
+               self.times[self.since_seq % self.capacity] < start):
+            self.since_total -= self.values[self.since_seq % self.capacity]
+            self.since_sketch.remove(self.values[self.since_seq % self.capacity])
+            self.since_seq += 1
+        # ...and take in values after it, if it moved back
+        while (self.since_seq > oldest_seq and
+               self.times[(self.since_seq - 1) % self.capacity] >= start):
+            self.since_seq -= 1
+            self.since_total += self.values[self.since_seq % self.capacity]
+            self.since_sketch.add(self.values[self.since_seq % self.capacity])
+        return self.appended - self.since_seq, self.since_total
+
+    def first_since(self, start):
+        '''The timestamp of the oldest value at or after a timestamp, or
+        None if there are none. O(1) like summary_since.
+        '''
+        self.summary_since(start)
+        if self.since_seq == self.appended:
+            return None
+        return self.times[self.since_seq % self.capacity]
+
+    def window(self, start, stop):
+        ''' A timestamp-keyed dict of the values between two timestamps '''
+        return dict([(timestamp, value) for timestamp, value in self.items()
+                     if timestamp >= start and timestamp <= stop])
@@ -3,6 +3,9 @@ import tempfile as tmp
 import fcntl
 from contextlib import contextmanager
 
+# Held in the healthdata_store by the edge_manage process using it
+STORE_LOCKFILE = "edgemanage.lock"
+
 
 def acquire_lock(lockfile):
     # lockfile should be an opened file in mode w
@@ -15,6 +18,36 @@ def acquire_lock(lockfile):
     return True
 
 
+def dnet_lockfile(lockfile, dnet):
+    '''Path of the lock file for a dnet. Dnets are locked separately, so
+    that they can be run at the same time. If the configured lockfile
+    has no {dnet} in it, the dnet is added on the end.
+
+    '''
+    if "{dnet}" in lockfile:
+        return lockfile.format(dnet=dnet)
+    return "%s.%s" % (lockfile, dnet)
+
+
+def acquire_store_lock(store_dir):
+    '''Lock a health store for this process, returning the open lock
+    file - which holds the lock until it is closed - or None if
+    another process has it. Processes keep their own copies of the
+    edge states, so they can't share a store.
+
+    The lock is an flock rather than a lockf so that it is kept by the
+    process that daemon_setup forks off.
+
+    '''
+    lock_f = open(os.path.join(store_dir, STORE_LOCKFILE), "w")
+    try:
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_f.close()
+        return None
+    return lock_f
+
+
 @contextmanager
 def tempfile(suffix='', dir=None):
     """ Context for temporary file.
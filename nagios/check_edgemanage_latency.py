@@ -2,12 +2,12 @@
 
 import sys
 import time
-import json
 import argparse
 import os.path
 
 import yaml
 
+from edgemanage import get_health_store
 from edgemanage.const import CONFIG_PATH
 
 DEFAULT_CRIT = 2.0
@@ -21,23 +21,13 @@ STATUS_MAP = {0: "OK",
 
 class CheckLatency(object):
 
-    def __init__(self, edgehealth_dir, edge_list, check_all=False, verbose=False):
-        self.latency_map = {}
+    def __init__(self, health_store, edge_list, check_all=False, verbose=False):
         self.now = time.time()
 
-        for edge_name in edge_list:
-            with open(os.path.join(edgehealth_dir, "%s.edgestore" % edge_name)) as health_f:
-                health_json = json.loads(health_f.read())
-                if "fetch_times" not in health_json or not health_json["fetch_times"]:
-                    # Skip uninitialised edges, or edges that have no data
-                    continue
-
-                if not check_all and health_json["state"] != "in":
-                    # if we're not explicitly checking all, then only check hosts that are in.
-                    continue
-
-                latest_fetch_time = sorted(health_json["fetch_times"].keys())[-1]
-                self.latency_map[edge_name] = health_json["fetch_times"][latest_fetch_time]
+        # Edges without data are skipped, and if we're not explicitly
+        # checking all, then only hosts that are in are checked.
+        self.latency_map = health_store.latest_values(edge_list,
+                                                      None if check_all else "in")
 
     def check_rotation(self, warn, crit):
         worst_latency = None
@@ -99,7 +89,7 @@ if __name__ == "__main__":
 
     edge_list += extra_edge_list
 
-    c = CheckLatency(config["healthdata_store"], edge_list, args.all, verbose=args.verbose)
+    c = CheckLatency(get_health_store(config), edge_list, args.all, verbose=args.verbose)
     status, message = c.check_rotation(args.warn, args.crit)
     print message
     sys.exit(status)
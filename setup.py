@@ -21,6 +21,9 @@ setup(
         "ipaddr==2.1.11",
         "MarkupSafe==1.1.1"
     ],
+    extras_require={
+        "numpy": ["numpy"],
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
@@ -28,5 +31,6 @@ setup(
         "Topic :: Internet :: Name Service (DNS)",
         "Topic :: Utilities",
         ],
-    scripts = ["edgemanage/edge_manage", "edgemanage/edge_query", "edgemanage/edge_conf"],
+    scripts = ["edgemanage/edge_manage", "edgemanage/edge_query", "edgemanage/edge_conf",
+               "edgemanage/edge_migrate_store", "edgemanage/edge_replay"],
     )
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import unittest
+import tempfile
+import time
 
 from .context import edgemanage
 
@@ -72,10 +74,176 @@ class DecisionMakerTest(EdgeStateTemplate):
                                                            'pass_average': 0,
                                                            'pass': 0})
 
+    def test_window_state(self):
+        # Slow long ago and just now, but fast within the window
+        es = self._make_store()
+        now = time.time()
+        es.add_value(GOOD_ENOUGH*9, timestamp=now - edgemanage.const.DECISION_SLICE_WINDOW*2)
+        es.add_value(GOOD_ENOUGH/10, timestamp=now - 10)
+        es.add_value(GOOD_ENOUGH/10, timestamp=now - 5)
+        es.add_value(GOOD_ENOUGH*1.5, timestamp=now)
+        dm = edgemanage.decisionmaker.DecisionMaker()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_window"], 1)
+
+    def test_phase_metric(self):
+        # Fast to respond but slow to transfer the object
+        es = self._make_store()
+        phase_times = dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.0)
+        phase_times["transfer"] = GOOD_ENOUGH*2
+        es.add_value(GOOD_ENOUGH/10, phase_times=phase_times)
+
+        dm = edgemanage.decisionmaker.DecisionMaker()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_threshold"], 1)
+
+        dm = edgemanage.decisionmaker.DecisionMaker("transfer")
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass"], 1)
+        self.assertEqual(dm.edge_average(TEST_EDGE), GOOD_ENOUGH*2)
+
+    def test_quantile(self):
+        # Mostly fast with a slow tail: the mean passes, the p95 doesn't
+        es = self._make_store()
+        for i in range(3):
+            es.add_value(GOOD_ENOUGH/10)
+        es.add_value(GOOD_ENOUGH*3)
+
+        dm = edgemanage.decisionmaker.DecisionMaker()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_window"], 1)
+
+        dm = edgemanage.decisionmaker.DecisionMaker(quantile=95)
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass"], 1)
+        self.assertTrue(dm.edge_score(TEST_EDGE) > GOOD_ENOUGH*2)
+
+    def test_halflife(self):
+        # Fast until it slowed down a minute ago: the mean passes, the
+        # EWMA doesn't
+        es = self._make_store()
+        now = time.time()
+        for i in range(3):
+            es.add_value(GOOD_ENOUGH/10, timestamp=now - 7200 + i)
+        es.add_value(GOOD_ENOUGH*3, timestamp=now - 60)
+
+        dm = edgemanage.decisionmaker.DecisionMaker()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_average"], 1)
+
+        dm = edgemanage.decisionmaker.DecisionMaker(halflife=600)
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass"], 1)
+        self.assertTrue(dm.edge_score(TEST_EDGE) > GOOD_ENOUGH*2)
+
+    def test_reset(self):
+        dm = edgemanage.decisionmaker.DecisionMaker()
+        dm.add_edge_state(self._get_failing_edge_state())
+        dm.edges_disabled = True
+        dm.check_threshold(GOOD_ENOUGH)
+        dm.reset()
+        self.assertEqual((dm.edge_states, dm.current_judgement), ({}, {}))
+        self.assertFalse(dm.edges_disabled)
+
+    def test_incremental(self):
+        judged = []
+
+        class CountingDecisionMaker(edgemanage.decisionmaker.DecisionMaker):
+            def _judge_edges(self, good_enough, edgenames, slice_start):
+                judged.extend(edgenames)
+                return super(CountingDecisionMaker, self)._judge_edges(
+                    good_enough, edgenames, slice_start)
+
+        es = self._get_good_enough_edge_state()
+        dm = CountingDecisionMaker()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_threshold"], 1)
+        # Nothing has changed, so nothing is judged again
+        dm.add_edge_state(es)
+        dm.check_threshold(GOOD_ENOUGH)
+        dm.reset()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_threshold"], 1)
+        self.assertEqual(judged, [TEST_EDGE])
+
+        # A new sample is
+        es.add_value(edgemanage.const.FETCH_TIMEOUT)
+        dm.add_edge_state(es)
+        results = dm.check_threshold(GOOD_ENOUGH)
+        self.assertEqual((results["pass_threshold"], results["fail"]), (0, 1))
+        self.assertEqual(judged, [TEST_EDGE, TEST_EDGE])
+
+    def test_window_expiry(self):
+        es = self._make_store()
+        window_start = time.time() - edgemanage.const.DECISION_SLICE_WINDOW
+        es.add_value(GOOD_ENOUGH/10, timestamp=window_start + 0.2)
+        es.add_value(GOOD_ENOUGH*1.5, timestamp=window_start + 0.3)
+        dm = edgemanage.decisionmaker.DecisionMaker()
+        dm.add_edge_state(es)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_window"], 1)
+        # Once the samples drop out of the time slice, only the
+        # average is left to pass on
+        time.sleep(0.5)
+        self.assertEqual(dm.check_threshold(GOOD_ENOUGH)["pass_average"], 1)
+        self.assertEqual(dm.get_judgement(TEST_EDGE), "pass_average")
+
     # def test_judgement(self):
     #    dm = DecisionMaker()
     #    passing_edge_state = _get_passing_edge_state()
     #    failing_edge_state = _get_failing_edge_state()
 
+
+@unittest.skipIf(edgemanage.decisionmaker.numpy is None, "NumPy is not installed")
+class VectorDecisionMakerTest(EdgeStateTemplate):
+
+    def _judge_both(self, edge_states, quantile=None, halflife=None):
+        dm = edgemanage.decisionmaker.DecisionMaker(quantile=quantile, halflife=halflife)
+        vdm = edgemanage.decisionmaker.VectorDecisionMaker(quantile=quantile,
+                                                           halflife=halflife)
+        for es in edge_states:
+            dm.add_edge_state(es)
+            vdm.add_edge_state(es)
+        self.assertEqual(vdm.check_threshold(GOOD_ENOUGH), dm.check_threshold(GOOD_ENOUGH))
+        self.assertEqual(vdm.current_judgement, dm.current_judgement)
+        for es in edge_states:
+            self.assertAlmostEqual(vdm.edge_score(es.edgename), dm.edge_score(es.edgename))
+
+    def test_same_judgements(self):
+        now = time.time()
+        edge_values = [
+            [GOOD_ENOUGH/10],
+            [edgemanage.const.FETCH_TIMEOUT],
+            [GOOD_ENOUGH*2, GOOD_ENOUGH/10, GOOD_ENOUGH*2],
+            [GOOD_ENOUGH/10, GOOD_ENOUGH/10, GOOD_ENOUGH*2],
+            [GOOD_ENOUGH*2],
+        ]
+        edge_states = []
+        for index, values in enumerate(edge_values):
+            es = edgemanage.edgestate.EdgeState("testedge%d" % index, self.store_dir)
+            for offset, value in enumerate(values):
+                # Only the last value is in the time slice
+                if offset == len(values) - 1:
+                    es.add_value(value, timestamp=now)
+                else:
+                    es.add_value(value, timestamp=now - 1000 + offset)
+            edge_states.append(es)
+        self._judge_both(edge_states)
+        self._judge_both(edge_states, quantile=95)
+        self._judge_both(edge_states, halflife=600)
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+
+class DecisionMakerMetricTest(unittest.TestCase):
+
+    def test_metric(self):
+        dm = edgemanage.decisionmaker.DecisionMaker("transfer")
+        self.assertEqual(dm.metric, "transfer")
+        self.assertEqual(edgemanage.decisionmaker.DecisionMaker().metric, "fetch")
+        self.assertRaises(ValueError, edgemanage.decisionmaker.DecisionMaker, "vibes")
+        self.assertRaises(ValueError, edgemanage.decisionmaker.DecisionMaker, None, 101)
+        self.assertRaises(ValueError, edgemanage.decisionmaker.DecisionMaker, None, 95, 600)
+
 if __name__ == '__main__':
     unittest.main()
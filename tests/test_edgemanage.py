@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+
+from concurrent.futures import Future
+
+from .context import edgemanage
+
+CONFIG = {
+    "goodenough": 0.7,
+    "edge_count": 3,
+    "dnet_edge_count": {},
+}
+NOW = 1000000.0
+
+
+class FixedDecisionMaker(edgemanage.DecisionMaker):
+
+    def __init__(self, healths):
+        ''' A DecisionMaker that judges each edge to have a given health '''
+        super(FixedDecisionMaker, self).__init__()
+        self.healths = healths
+
+    def _judge_edges(self, good_enough, edgenames, slice_start):
+        return dict((edgename, self.healths[edgename]) for edgename in edgenames)
+
+
+class ResultProbeEngine(edgemanage.probeengine.ThreadedProbeEngine):
+
+    def __init__(self, results, late=()):
+        '''A probe engine that answers every fetch with the
+        (fetch_result, fetch_status) given for the edge - straight
+        away, or a moment later for the edges in late
+        '''
+        super(ResultProbeEngine, self).__init__(1)
+        self.results = results
+        self.late = late
+
+    def submit(self, edgetest, fetch_host, fetch_object, proto, port, verify):
+        future = Future()
+        result = {edgetest.edgename: self.results[edgetest.edgename]}
+        if edgetest.edgename in self.late:
+            threading.Timer(0.1, future.set_result, [result]).start()
+        else:
+            future.set_result(result)
+        return future
+
+
+class EdgeManageTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = edgemanage.healthstore.JSONHealthStore(self.store_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def _edgemanage(self, samples, config=CONFIG, decision=None):
+        '''An EdgeManage with no test object or zone files, managing
+        edges with the given lists of samples, taken a second apart up
+        to NOW
+        '''
+        edge_m = edgemanage.replay.ReplayEdgeManage("testnet", config, edgemanage.StateFile(),
+                                                    lambda: NOW)
+        if decision is not None:
+            decision.clock = edge_m.decision.clock
+            edge_m.decision = decision
+        for edgename, values in samples.iteritems():
+            edge_state = edgemanage.EdgeState(edgename, None, nowrite=True, store=self.store)
+            for offset, value in enumerate(values, 1 - len(values)):
+                edge_state.add_value(value, timestamp=NOW + offset)
+            edge_m.edge_states[edgename] = edge_state
+            edge_m.decision.add_edge_state(edge_state)
+        return edge_m
+
+    def _testing_edgemanage(self, samples, results, config=CONFIG, last_live=(), late=()):
+        '''An EdgeManage as given by _edgemanage, that will get the given
+        results from testing its edges
+        '''
+        config = dict(config, testobject={"host": "test.com", "uri": "/test_object",
+                                          "proto": "http", "verify": True})
+        edge_m = self._edgemanage(samples, config)
+        edge_m.state_obj.last_live = list(last_live)
+        edge_m.testobject_hash = "nope"
+        edge_m.testobject_size = None
+        edge_m.testobject_range_hash = None
+        edge_m.edgetests = {}
+        edge_m.probe_cache = edgemanage.ProbeCache()
+        edge_m.probe_engine = ResultProbeEngine(results, late)
+        self.addCleanup(edge_m.probe_engine.shutdown)
+        return edge_m
+
+
+class RankTest(EdgeManageTemplate):
+
+    HEALTHS = {
+        "edge1": "pass", "edge2": "pass_window", "edge3": "fail", "edge4": "pass_average",
+        "edge5": "pass_window", "edge6": "pass", "edge7": "pass_threshold",
+        "edge8": "pass_average", "edge9": "pass_window", "edge10": "fail",
+    }
+
+    def _per_tier(self, edge_m, count):
+        ''' The edges chosen a health at a time, as they used to be '''
+        chosen = []
+        for health in edgemanage.const.LIVE_HEALTHS:
+            in_health = sorted([edgename for edgename in edge_m.decision.current_judgement
+                                if edge_m.decision.get_judgement(edgename) == health],
+                               key=edge_m.decision.edge_score)
+            chosen.extend(in_health[:count - len(chosen)])
+        return chosen
+
+    def test_rank(self):
+        # Scores are the reverse of the numbering, so that they don't
+        # agree with the healths
+        samples = dict((edgename, [1.0 / int(edgename[4:])]) for edgename in self.HEALTHS)
+        edge_m = self._edgemanage(samples, decision=FixedDecisionMaker(self.HEALTHS))
+        edge_m.make_edges_live(False)
+
+        expected = self._per_tier(edge_m, CONFIG["edge_count"] * 2)
+        self.assertEqual(expected, ["edge7", "edge9", "edge5", "edge2", "edge8", "edge4"])
+        self.assertEqual(sorted(edge_m.edgelist_obj.get_live_edges()),
+                         sorted(expected[:CONFIG["edge_count"]]))
+        self.assertEqual([edgename for edgename, _, _ in edge_m.state_obj.next_in_line],
+                         expected[CONFIG["edge_count"]:])
+        self.assertEqual([health for _, health, _ in edge_m.state_obj.next_in_line],
+                         [self.HEALTHS[edgename] for edgename in expected[CONFIG["edge_count"]:]])
+
+    def test_rank_all_failing(self):
+        healths = dict((edgename, "fail") for edgename in self.HEALTHS)
+        edge_m = self._edgemanage(dict((edgename, [0.5]) for edgename in healths),
+                                  decision=FixedDecisionMaker(healths))
+        edge_m.make_edges_live(False)
+        self.assertEqual(self._per_tier(edge_m, CONFIG["edge_count"]), [])
+        self.assertEqual(edge_m.edgelist_obj.get_live_edges(), [])
+        self.assertEqual(edge_m.state_obj.next_in_line, [])
+
+
+class CanaryTest(EdgeManageTemplate):
+
+    def _canary_edgemanage(self):
+        '''An EdgeManage with a fast edge and two canaries - one that has
+        failed and one that has yet to be tested - that kills the
+        canaries once one has failed
+        '''
+        config = dict(CONFIG, canary_killer=1)
+        edge_m = self._edgemanage({"edge1": [0.1]}, config)
+        edge_m.canary_edges = frozenset(["canary1", "canary2"])
+        edge_m.canary_decision = edgemanage.DecisionMaker()
+        for edgename in edge_m.canary_edges:
+            edge_m.edge_states[edgename] = edgemanage.EdgeState(edgename, None, nowrite=True,
+                                                                store=self.store)
+        edge_m.edge_states["canary1"].add_value(edgemanage.const.FETCH_TIMEOUT, timestamp=NOW)
+        edge_m.canary_decision.add_edge_state(edge_m.edge_states["canary1"])
+
+        edge_m.kill_checks = 0
+        check_canary_kill_treshhold = edge_m.check_canary_kill_treshhold
+
+        def count_kill_checks(*args):
+            edge_m.kill_checks += 1
+            return check_canary_kill_treshhold(*args)
+        edge_m.check_canary_kill_treshhold = count_kill_checks
+        return edge_m
+
+    def test_edge_result(self):
+        edge_m = self._canary_edgemanage()
+        edge_m.canary_result("edge1", None, {})
+        self.assertEqual(edge_m.kill_checks, 0)
+        self.assertFalse(edge_m.canary_decision.edges_disabled)
+
+    def test_canary_result(self):
+        edge_m = self._canary_edgemanage()
+        edge_m.canary_result("canary1", None, {})
+        self.assertEqual(edge_m.kill_checks, 1)
+        self.assertTrue(edge_m.canary_decision.edges_disabled)
+        # The untested canary is failed along with the rest
+        self.assertEqual(sorted(edge_m.canary_decision.edge_states), ["canary1", "canary2"])
+        self.assertEqual(edge_m.canary_decision.check_threshold(CONFIG["goodenough"])["fail"], 2)
+
+        # Once the canaries are killed, there's nothing left to check
+        edge_m.canary_result("canary2", None, {})
+        self.assertEqual(edge_m.kill_checks, 1)
+
+
+class LiveEdgeFailingTest(EdgeManageTemplate):
+
+    def _live_edgemanage(self, health="pass_threshold"):
+        edge_m = self._edgemanage({"edge1": [0.1], "edge2": [0.1]})
+        edge_m.state_obj.last_live = ["edge1"]
+        for edge_state in edge_m.edge_states.values():
+            edge_state.set_health(health)
+        return edge_m
+
+    def test_live_edge_failing(self):
+        edge_m = self._live_edgemanage()
+        self.assertFalse(edge_m.live_edge_failing("edge1", None))
+        edge_m.edge_states["edge1"].add_value(edgemanage.const.FETCH_TIMEOUT, timestamp=NOW)
+        self.assertTrue(edge_m.live_edge_failing("edge1", None))
+
+    def test_verify_failed(self):
+        edge_m = self._live_edgemanage()
+        self.assertTrue(edge_m.live_edge_failing("edge1", "verify_failed"))
+
+    def test_not_live(self):
+        edge_m = self._live_edgemanage()
+        edge_m.edge_states["edge2"].add_value(edgemanage.const.FETCH_TIMEOUT, timestamp=NOW)
+        self.assertFalse(edge_m.live_edge_failing("edge2", "verify_failed"))
+
+    def test_already_failing(self):
+        # The last decision already knew about it
+        edge_m = self._live_edgemanage("fail")
+        edge_m.edge_states["edge1"].add_value(edgemanage.const.FETCH_TIMEOUT, timestamp=NOW)
+        self.assertFalse(edge_m.live_edge_failing("edge1", None))
+
+    def test_do_edge_tests(self):
+        edge_m = self._testing_edgemanage(
+            {"edge1": [0.1], "edge2": [0.1], "edge3": [0.1]},
+            {"edge1": (edgemanage.const.FETCH_TIMEOUT, None), "edge2": (0.1, None),
+             "edge3": (edgemanage.const.FETCH_TIMEOUT, None)},
+            last_live=["edge1", "edge2"])
+        for edge_state in edge_m.edge_states.values():
+            edge_state.set_health("pass_window")
+        failing = []
+        self.assertEqual(edge_m.do_edge_tests(failing.append), [])
+        # edge3 wasn't live
+        self.assertEqual(failing, ["edge1"])
+
+
+class DecisionSettledTest(EdgeManageTemplate):
+
+    CONFIG = dict(CONFIG, edge_count=2)
+
+    def _settling_edgemanage(self, tested, untested, config=None, last_live=()):
+        '''An EdgeManage that has tested some edges, and is still
+        testing others, with samples as given to _edgemanage
+        '''
+        edge_m = self._edgemanage(dict(tested, **untested), config or self.CONFIG)
+        edge_m.decision.reset()
+        for edgename in tested:
+            edge_m.decision.add_edge_state(edge_m.edge_states[edgename])
+        edge_m.state_obj.last_live = list(last_live)
+        return edge_m
+
+    def _finish(self, edge_m, edgename, value):
+        ''' Record the outstanding result for an edge and decide '''
+        edge_m.edge_states[edgename].add_value(value, timestamp=NOW)
+        edge_m.decision.add_edge_state(edge_m.edge_states[edgename])
+        edge_m.make_edges_live(False)
+        return sorted(edge_m.edgelist_obj.get_live_edges())
+
+    def test_threshold(self):
+        # The live edges have passed again, so nothing else matters
+        edge_m = self._settling_edgemanage({"edge1": [0.1], "edge2": [0.2]},
+                                           {"edge3": [0.01]}, last_live=["edge1", "edge2"])
+        self.assertTrue(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge3", 0.01), ["edge1", "edge2"])
+
+    def test_threshold_live_untested(self):
+        # A live edge failing would have it replaced
+        edge_m = self._settling_edgemanage({"edge1": [0.1], "edge3": [0.2]},
+                                           {"edge2": [0.1]}, last_live=["edge1", "edge2"])
+        self.assertFalse(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge2", edgemanage.const.FETCH_TIMEOUT),
+                         ["edge1", "edge3"])
+
+    def test_average(self):
+        # Even a fetch time of 0 leaves edge3's average at 0.4
+        edge_m = self._settling_edgemanage({"edge1": [0.1], "edge2": [0.2]},
+                                           {"edge3": [0.5] * 4})
+        self.assertTrue(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge3", 0.0), ["edge1", "edge2"])
+
+    def test_average_could_change(self):
+        edge_m = self._settling_edgemanage({"edge1": [0.1], "edge2": [0.2]},
+                                           {"edge3": [0.3]})
+        self.assertFalse(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge3", 0.0), ["edge1", "edge3"])
+
+    def test_average_not_enough(self):
+        # Only one edge has passed the threshold so far
+        edge_m = self._settling_edgemanage({"edge1": [0.1], "edge2": [1.0]},
+                                           {"edge3": [0.5] * 4})
+        self.assertFalse(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge3", 0.0), ["edge1", "edge3"])
+
+    def test_quantile(self):
+        config = dict(self.CONFIG, decision_quantile=90)
+        edge_m = self._settling_edgemanage({"edge1": [0.1] * 5, "edge2": [0.2] * 5},
+                                           {"edge3": [0.1] * 4 + [0.5] * 6}, config)
+        self.assertTrue(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge3", 0.0), ["edge1", "edge2"])
+
+    def test_quantile_could_change(self):
+        # The same average as edge2, but a better tail
+        config = dict(self.CONFIG, decision_quantile=90)
+        edge_m = self._settling_edgemanage({"edge1": [0.1] * 5, "edge2": [0.1, 0.3] * 5},
+                                           {"edge3": [0.2] * 9}, config)
+        self.assertFalse(edge_m.decision_settled(NOW))
+        self.assertEqual(self._finish(edge_m, "edge3", 0.0), ["edge1", "edge3"])
+
+    def test_halflife(self):
+        # edge3's EWMA can only get as low as edge2's score if its
+        # result comes in 35 seconds or more from now
+        config = dict(self.CONFIG, decision_halflife=60)
+        edge_m = self._settling_edgemanage({"edge1": [0.1], "edge2": [0.2]},
+                                           {"edge3": [0.5]}, config)
+        self.assertTrue(edge_m.decision_settled(NOW + 30))
+        self.assertFalse(edge_m.decision_settled(NOW + 40))
+
+    def test_results_deadline(self):
+        config = dict(self.CONFIG, retry=2, retry_backoff=1)
+        edge_m = self._edgemanage({}, config)
+        # Every attempt at an edge timing out, after the longest backoff
+        edge_bound = 3 * edgemanage.const.FETCH_TIMEOUT + 4
+        spread_end = time.time() + 60
+        with edgemanage.probeengine.ThreadedProbeEngine(2) as engine:
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine)
+            for edgename in ("edge1", "edge2", "edge3", "edge4", "edge5"):
+                scheduler.add(edgemanage.EdgeTest(edgename, "nope"), "test.com",
+                              "/test_object", "http", 80, False, start_delay=60)
+            # Two workers get through five edges in three rounds, once
+            # they've all been started
+            self.assertEqual(edge_m.results_deadline(engine, scheduler, spread_end),
+                             spread_end + 3 * edge_bound)
+            scheduler.cancel(["edge1", "edge2", "edge3", "edge4"])
+            self.assertEqual(edge_m.results_deadline(engine, scheduler, spread_end),
+                             spread_end + edge_bound)
+            scheduler.cancel(["edge5"])
+
+    def test_late_results(self):
+        edge_m = self._testing_edgemanage(
+            {"edge1": [0.1], "edge2": [0.1], "edge3": [0.1]},
+            {"edge1": (0.1, None), "edge2": (0.1, None),
+             "edge3": (edgemanage.const.FETCH_TIMEOUT, None)},
+            dict(self.CONFIG, early_decision=True), last_live=["edge1", "edge2"],
+            late=["edge3"])
+        edge_m.decision.reset()
+        for edge_state in edge_m.edge_states.values():
+            edge_state.set_health("pass_threshold")
+        decided_healths = {}
+
+        def decide():
+            edge_m.make_edges_live(False)
+            decided_healths.update([(edgename, edge_state.health) for edgename, edge_state
+                                    in edge_m.edge_states.iteritems()])
+
+        edge_m.do_edge_tests(on_decided=decide)
+        self.assertEqual(sorted(edge_m.edgelist_obj.get_live_edges()), ["edge1", "edge2"])
+        # edge3 is judged on its result once it comes in
+        self.assertEqual(decided_healths["edge3"], "pass_threshold")
+        self.assertEqual(edge_m.edge_states["edge3"].health, "fail")
+        self.assertEqual(edge_m.edge_states["edge1"].health, "pass_threshold")
+
+if __name__ == '__main__':
+    unittest.main()
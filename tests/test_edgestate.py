@@ -4,6 +4,7 @@ import unittest
 import tempfile
 import shutil
 import time
+import json
 
 from .context import edgemanage
 
@@ -47,5 +48,85 @@ class EdgeStateTest(EdgeStateTemplate):
 
         self.assertEqual(len(a), TEST_FETCH_HISTORY)
 
+    def testPhaseTimes(self):
+        a = self._make_store()
+        phase_times = dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.0)
+        phase_times["ttfb"] = 1.0
+        for i in range(TEST_FETCH_HISTORY+1):
+            a.add_value(1, phase_times=phase_times)
+            time.sleep(0.01)
+
+        self.assertEqual(a.last_value("ttfb"), 1.0)
+        self.assertEqual(a.current_average("dns"), 0.0)
+        self.assertEqual(len(a.series("transfer")), TEST_FETCH_HISTORY)
+
+        # A timeout is a timeout in every phase
+        a.add_value(edgemanage.const.FETCH_TIMEOUT)
+        self.assertEqual(a.last_value("dns"), edgemanage.const.FETCH_TIMEOUT)
+        self.assertRaises(ValueError, a.series, "vibes")
+
+    def testPhaseRotation(self):
+        a = self._make_store()
+        for i in range(TEST_FETCH_HISTORY):
+            a.add_value(i, timestamp=i + 1, phase_times=dict.fromkeys(
+                edgemanage.const.PROBE_PHASES, float(i)))
+        sketches = [a.series(phase).sketch for phase in edgemanage.const.PROBE_PHASES]
+
+        a.add_value(TEST_FETCH_HISTORY, timestamp=TEST_FETCH_HISTORY + 1, phase_times=dict.fromkeys(
+            edgemanage.const.PROBE_PHASES, float(TEST_FETCH_HISTORY)))
+        for phase, sketch in zip(edgemanage.const.PROBE_PHASES, sketches):
+            self.assertEqual(a.series(phase).value_list(), range(1, TEST_FETCH_HISTORY + 1))
+            # Rotated out in place rather than rebuilt
+            self.assertIs(a.series(phase).sketch, sketch)
+
+    def testPercentile(self):
+        a = self._make_store()
+        self.assertIsNone(a.percentile(95))
+        for i in range(TEST_FETCH_HISTORY):
+            a.add_value(i + 1)
+            time.sleep(0.01)
+
+        self.assertEqual(a.percentile(0), 1)
+        self.assertEqual(a.percentile(50), 3)
+        self.assertEqual(a.percentile(100), TEST_FETCH_HISTORY)
+
+    def testTrend(self):
+        a = self._make_store()
+        a.add_value(1, timestamp=3600.0)
+        a.add_value(3, timestamp=3660.0)
+        self.assertEqual([hour["mean"] for hour in a.trend("hour")], [2])
+
+        # Stores from before rollups were kept have them made from
+        # the fetch times they have
+        with open(a.statfile) as statfile_f:
+            stat_info = json.load(statfile_f)
+        del(stat_info["rollups"])
+        with open(a.statfile, "w") as statfile_f:
+            json.dump(stat_info, statfile_f)
+        b = edgemanage.edgestate.EdgeState(TEST_EDGE, self.store_dir)
+        self.assertEqual(b.trend("minute"), a.trend("minute"))
+
+    def testDeferWrites(self):
+        self.store_dir = tempfile.mkdtemp()
+        a = edgemanage.edgestate.EdgeState(TEST_EDGE, self.store_dir, defer_writes=True)
+        a.add_value(1)
+        a.set_health("fail")
+        self.assertTrue(a.dirty)
+        self.assertEqual(len(edgemanage.edgestate.EdgeState(TEST_EDGE, self.store_dir)), 0)
+
+        a.flush()
+        self.assertFalse(a.dirty)
+        b = edgemanage.edgestate.EdgeState(TEST_EDGE, self.store_dir)
+        self.assertEqual(len(b), 1)
+        self.assertEqual(b.health, "fail")
+
+        # Modes set elsewhere are picked up without losing our changes
+        a.add_value(2)
+        time.sleep(0.01)
+        b.set_mode("unavailable")
+        a.refresh()
+        self.assertEqual(a.mode, "unavailable")
+        self.assertEqual(a.last_value(), 2)
+
 if __name__ == '__main__':
     unittest.main()
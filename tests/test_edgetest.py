@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import unittest
+
+from .context import edgemanage
+
+from test_probeengine import (ProbeEngineTemplate, TEST_EDGE, TEST_HASH, TEST_ETAG,
+                              TEST_OBJECT, TEST_RANGE_SIZE, TEST_RANGE_HASH)
+
+
+class EdgeTestTest(ProbeEngineTemplate):
+
+    def test_fetch(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+        fetch_result = edge_t.fetch("test.com", "/test_object", "http", self.port)
+        self.assertLess(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+        self.assertEqual(sorted(edge_t.phase_times), sorted(edgemanage.const.PROBE_PHASES))
+        self.assertEqual(edge_t.phase_times["ttfb"], fetch_result)
+        self.assertEqual(edge_t.phase_times["tls"], 0.0)
+        edge_t.close()
+
+    def test_verify_failed(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, "nope")
+        self.assertRaises(edgemanage.VerifyFailed, edge_t.fetch,
+                          "test.com", "/test_object", "http", self.port)
+        self.assertEqual(edge_t.phase_times["ttfb"], edgemanage.const.FETCH_TIMEOUT)
+        edge_t.close()
+
+    def test_body_too_large(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, local_size=len(TEST_OBJECT) - 1)
+        self.assertRaises(edgemanage.VerifyFailed, edge_t.fetch,
+                          "test.com", "/test_object", "http", self.port)
+        edge_t.close()
+
+    def test_etag_revalidation(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, conditional="etag")
+        edge_t.fetch("test.com", "/test_object", "http", self.port)
+        self.assertEqual(edge_t.etag, TEST_ETAG)
+        self.assertEqual(edge_t.request_headers("test.com")["If-None-Match"], TEST_ETAG)
+        # Answered with a 304, which needs no verification
+        edge_t.fetch("test.com", "/test_object", "http", self.port)
+        edge_t.close()
+
+    def test_range_probe(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, conditional="range",
+                                     range_size=TEST_RANGE_SIZE, range_sum=TEST_RANGE_HASH)
+        edge_t.fetch("test.com", "/test_object", "http", self.port)
+        edge_t.range_sum = "nope"
+        self.assertRaises(edgemanage.VerifyFailed, edge_t.fetch,
+                          "test.com", "/test_object", "http", self.port)
+        edge_t.close()
+
+    def test_bad_conditional(self):
+        self.assertRaises(ValueError, edgemanage.EdgeTest, TEST_EDGE, TEST_HASH,
+                          conditional="maybe")
+
+    def test_connection_reuse(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+        edge_t.fetch("test.com", "/test_object", "http", self.port)
+        self.assertIsNotNone(edge_t.connect_time)
+        # The second fetch goes over the connection left open by the first
+        edge_t.fetch("test.com", "/test_object", "http", self.port)
+        self.assertIsNone(edge_t.connect_time)
+        edge_t.close()
+
+    def test_connect_failed(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+        # Retries are up to the caller
+        self.assertRaises(edgemanage.ConnectFailed, edge_t.fetch,
+                          "test.com", "/test_object", "http", self._closed_port())
+        edge_t.close()
+
+    def test_hedge(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+        hedge_t = edge_t.hedge()
+        hedge_t.fetch("test.com", "/test_object", "http", self.port)
+        self.assertIs(hedge_t.session, edge_t.session)
+        self.assertEqual(edge_t.phase_times["ttfb"], edgemanage.const.FETCH_TIMEOUT)
+        edge_t.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import os
+import json
+
+from .context import edgemanage
+
+TEST_EDGE = "testedge1"
+
+
+class HealthStoreTemplate(object):
+    """
+    Tests run against every health store backend
+    """
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = self._make_store()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def _edge_state(self):
+        return edgemanage.EdgeState(TEST_EDGE, self.store_dir, store=self.store)
+
+    def test_round_trip(self):
+        self.assertFalse(self.store.exists(TEST_EDGE))
+        a = self._edge_state()
+        phase_times = dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.5)
+        a.add_value(1.5, timestamp=1000.25, phase_times=phase_times)
+        a.add_value(2.5, timestamp=1001.25, phase_times=phase_times)
+        a.set_mode("unavailable")
+        a.set_comment("testing")
+        self.assertTrue(self.store.exists(TEST_EDGE))
+        self.assertEqual(self.store.edgenames(), [TEST_EDGE])
+
+        b = self._edge_state()
+        self.assertEqual(b.fetch_times.items(), [(1000.25, 1.5), (1001.25, 2.5)])
+        self.assertEqual(b.last_value("ttfb"), 0.5)
+        self.assertEqual(b.mode, "unavailable")
+        self.assertEqual(b.comment, "testing")
+
+    def test_lazy(self):
+        a = self._edge_state()
+        a.add_value(1.5, timestamp=1000.25)
+        a.set_state("in")
+
+        b = edgemanage.EdgeState(TEST_EDGE, self.store_dir, store=self.store, lazy=True)
+        self.assertEqual(b.state, "in")
+        self.assertFalse(b._loaded())
+        # Changing the metadata leaves the samples alone
+        b.set_mode("unavailable")
+        self.assertFalse(b._loaded())
+        self.assertEqual(self._edge_state().fetch_times.items(), [(1000.25, 1.5)])
+        # Samples are loaded when they're first used
+        self.assertEqual(len(b), 1)
+        self.assertTrue(b._loaded())
+
+        c = edgemanage.EdgeState("testedge2", self.store_dir, store=self.store, lazy=True)
+        self.assertEqual(c.mode, "available")
+        self.assertEqual(len(c), 0)
+
+    def test_latest_values(self):
+        a = self._edge_state()
+        a.add_value(1.5, timestamp=1000.25)
+        a.add_value(2.5, timestamp=1001.25)
+        self.assertEqual(self.store.latest_values(), {TEST_EDGE: 2.5})
+        self.assertEqual(self.store.latest_values(state="in"), {})
+        a.set_state("in")
+        self.assertEqual(self.store.latest_values([TEST_EDGE], "in"), {TEST_EDGE: 2.5})
+
+    def test_sample_log(self):
+        a = self._edge_state()
+        a.add_value(1.5, timestamp=1000.25)
+        a.add_value(2.5, timestamp=1001.25)
+        a.add_rotation()
+        # Only the first sample was written out in full
+        self.assertEqual(self.store.load(TEST_EDGE)["fetch_times"], {repr(1000.25): 1.5})
+        self.assertEqual([record[0] for record in self.store.load(TEST_EDGE)["sample_log"]],
+                         ["fetch", "rotation"])
+
+        b = self._edge_state()
+        self.assertEqual(b.fetch_times.items(), [(1000.25, 1.5), (1001.25, 2.5)])
+        self.assertEqual(b.rotation_history, a.rotation_history)
+        self.assertEqual(b.trend("minute")[0]["count"], 2)
+
+        # Anything else changing compacts the log
+        b.set_state("in")
+        self.assertEqual(self.store.load(TEST_EDGE)["sample_log"], [])
+        self.assertEqual(self._edge_state().fetch_times.items(),
+                         [(1000.25, 1.5), (1001.25, 2.5)])
+
+    def test_ewma(self):
+        a = self._edge_state()
+        a.add_value(1.5, timestamp=1000.25)
+        self.assertEqual(a.ewma(60), 1.5)
+        # Written out in full with the EWMA...
+        a.set_state("in")
+        # ...and then kept up to date from the sample log
+        a.add_value(2.5, timestamp=1060.25)
+
+        b = self._edge_state()
+        self.assertEqual(b.fetch_times.ewma_state(), a.fetch_times.ewma_state())
+        self.assertEqual(b.ewma(60), a.ewma(60))
+
+
+class JSONHealthStoreTest(HealthStoreTemplate, unittest.TestCase):
+
+    def _make_store(self):
+        return edgemanage.healthstore.JSONHealthStore(self.store_dir)
+
+    def test_header(self):
+        a = self._edge_state()
+        a.add_value(1.5, timestamp=1000.25)
+        metadata = self.store.load(TEST_EDGE, edgemanage.healthstore.METADATA_VALS)
+        self.assertEqual(sorted(metadata), sorted(edgemanage.healthstore.METADATA_VALS))
+        # The whole file is still plain JSON
+        with open(self.store.location(TEST_EDGE)) as statfile_f:
+            self.assertEqual(json.load(statfile_f)["fetch_times"], {"1000.25": 1.5})
+
+        # Files from before the header was written are read in full
+        with open(self.store.location(TEST_EDGE), "w") as statfile_f:
+            json.dump({"mode": "unavailable", "fetch_times": {}}, statfile_f, indent=4)
+        self.assertEqual(self.store.load(TEST_EDGE, ["mode"])["mode"], "unavailable")
+
+    def test_sample_log_crash(self):
+        a = self._edge_state()
+        a.add_value(1.5, timestamp=1000.25)
+        a.add_value(2.5, timestamp=1001.25)
+        # A record left over from before the last full write, and a
+        # partly written one
+        with open(self.store.log_location(TEST_EDGE), "ab") as log_f:
+            log_f.write(edgemanage.healthstore.SAMPLE_LOG_RECORD.pack(0, 1000.25, 9.5))
+            log_f.write("\x00\x01")
+        self.assertEqual(self._edge_state().fetch_times.items(),
+                         [(1000.25, 1.5), (1001.25, 2.5)])
+        a.add_value(3.5, timestamp=1002.25)
+        self.assertEqual(self._edge_state().last_value(), 3.5)
+
+
+class SQLiteHealthStoreTest(HealthStoreTemplate, unittest.TestCase):
+
+    def _make_store(self):
+        return edgemanage.healthstore.SQLiteHealthStore(
+            os.path.join(self.store_dir, edgemanage.const.HEALTHDATA_DB))
+
+    def test_rotation(self):
+        edgemanage.edgestate.FETCH_HISTORY, fetch_history = 2, edgemanage.edgestate.FETCH_HISTORY
+        try:
+            a = self._edge_state()
+            for i in range(3):
+                a.add_value(i, timestamp=1000.0 + i)
+            # Compact the sample log into the samples
+            a.set_comment("compacted")
+        finally:
+            edgemanage.edgestate.FETCH_HISTORY = fetch_history
+        # Rotated out samples are deleted from the database
+        self.assertEqual(self.store.load(TEST_EDGE)["fetch_times"],
+                         {repr(1001.0): 1, repr(1002.0): 2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import time
+
+from .context import edgemanage
+
+TEST_EDGE = "testedge1"
+TEST_HASH = "d41d8cd98f00b204e9800998ecf8427e"
+TEST_FETCH_ARGS = ("test.com", "/test_object", "http", 80, False)
+
+
+class ProbeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+
+    def tearDown(self):
+        self.edge_t.close()
+        shutil.rmtree(self.store_dir)
+
+    def test_claim_in_flight(self):
+        cache = edgemanage.ProbeCache()
+        future, owner = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        self.assertTrue(owner)
+        shared_future, owner = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        self.assertFalse(owner)
+        self.assertIs(shared_future, future)
+
+        phase_times = dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.1)
+        cache.publish(TEST_EDGE, future, 0.1, None, phase_times)
+        self.assertEqual(shared_future.result(), (0.1, None, phase_times))
+        # Results aren't reused by default once the probe is done
+        self.assertTrue(cache.claim(self.edge_t, TEST_FETCH_ARGS)[1])
+
+    def test_claim_max_age(self):
+        cache = edgemanage.ProbeCache(max_age=0.2)
+        future, _ = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        cache.publish(TEST_EDGE, future, 0.1, None,
+                      dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.1))
+        self.assertEqual(cache.claim(self.edge_t, TEST_FETCH_ARGS), (future, False))
+        # A different test of the same edge isn't a match
+        self.assertTrue(cache.claim(self.edge_t, ("other.com",) + TEST_FETCH_ARGS[1:])[1])
+        future, _ = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        cache.publish(TEST_EDGE, future, 0.1, None,
+                      dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.1))
+        time.sleep(0.3)
+        self.assertTrue(cache.claim(self.edge_t, TEST_FETCH_ARGS)[1])
+
+    def test_abandon(self):
+        cache = edgemanage.ProbeCache(max_age=10)
+        future, _ = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        shared_future, _ = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        cache.abandon(TEST_EDGE, future)
+        self.assertIsNone(shared_future.result())
+        # Nobody has a result, so the next claim has to probe
+        self.assertTrue(cache.claim(self.edge_t, TEST_FETCH_ARGS)[1])
+
+    def test_latest(self):
+        cache = edgemanage.ProbeCache()
+        self.assertIsNone(cache.latest(TEST_EDGE))
+        phase_times = dict.fromkeys(edgemanage.const.PROBE_PHASES, 0.1)
+        future, _ = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        cache.publish(TEST_EDGE, future, 0.1, None, phase_times)
+        # The latest result is kept while the next probe is in flight
+        future, _ = cache.claim(self.edge_t, TEST_FETCH_ARGS)
+        self.assertEqual(cache.latest(TEST_EDGE), (0.1, None, phase_times))
+        cache.abandon(TEST_EDGE, future)
+        self.assertEqual(cache.latest(TEST_EDGE), (0.1, None, phase_times))
+
+    def test_edge_state(self):
+        cache = edgemanage.ProbeCache()
+        edge_state = cache.edge_state(TEST_EDGE, self.store_dir)
+        edge_state.add_value(1)
+        self.assertIs(cache.edge_state(TEST_EDGE, self.store_dir), edge_state)
+
+        # Changes made on disk by something else are picked up
+        time.sleep(0.01)
+        other_edge_state = edgemanage.EdgeState(TEST_EDGE, self.store_dir)
+        other_edge_state.set_mode("unavailable")
+        self.assertEqual(cache.edge_state(TEST_EDGE, self.store_dir).mode, "unavailable")
+        self.assertEqual(len(edge_state), 1)
+
+if __name__ == '__main__':
+    unittest.main()
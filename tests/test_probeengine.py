@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+import unittest
+import hashlib
+import socket
+import ssl
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+from .context import edgemanage
+
+TEST_EDGE = "127.0.0.1"
+TEST_OBJECT = "edgemanage test object\n" * 64
+TEST_HASH = hashlib.md5(TEST_OBJECT).hexdigest()
+TEST_ETAG = '"%s"' % TEST_HASH
+TEST_RANGE_SIZE = 100
+TEST_RANGE_HASH = hashlib.md5(TEST_OBJECT[:TEST_RANGE_SIZE]).hexdigest()
+
+
+class ObjectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Allow keep-alive connections
+    protocol_version = "HTTP/1.1"
+
+    # Number of requests for /slow_object so far
+    slow_requests = 0
+
+    def do_GET(self):
+        if self.path == "/slow_object":
+            # Only the first request is slow, so that hedges win
+            ObjectHandler.slow_requests += 1
+            if ObjectHandler.slow_requests == 1:
+                time.sleep(1)
+            self.path = "/test_object"
+
+        if self.path != "/test_object":
+            self.send_error(404)
+            return
+
+        if self.headers.getheader("If-None-Match") == TEST_ETAG:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = TEST_OBJECT
+        range_header = self.headers.getheader("Range")
+        if range_header:
+            range_end = int(range_header.split("-")[1])
+            body = TEST_OBJECT[:range_end + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("ETag", TEST_ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ObjectServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # Don't wait on keep-alive connections when shutting down
+    daemon_threads = True
+
+
+class ProbeEngineTemplate(unittest.TestCase):
+    """
+    Sub-classable test serving the test object from a local web server
+    """
+    def setUp(self):
+        ObjectHandler.slow_requests = 0
+        self.server = ObjectServer((TEST_EDGE, 0), ObjectHandler)
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _closed_port(self):
+        sock = socket.socket()
+        sock.bind((TEST_EDGE, 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def _probe(self, engine, local_sum=TEST_HASH, path="/test_object", port=None,
+               edge_t=None):
+        if edge_t is None:
+            edge_t = edgemanage.EdgeTest(TEST_EDGE, local_sum)
+        with engine:
+            future = engine.submit(edge_t, "test.com", path, "http",
+                                   port or self.port, False)
+            completed = list(engine.as_completed([future]))
+        self.assertEqual(completed, [future])
+        return future.result()[TEST_EDGE]
+
+
+class EventLoopProbeEngineTest(ProbeEngineTemplate):
+
+    def _engine(self):
+        return edgemanage.probeengine.EventLoopProbeEngine(10)
+
+    def test_fetch(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+        fetch_result, fetch_status = self._probe(self._engine(), edge_t=edge_t)
+        self.assertIsNone(fetch_status)
+        self.assertLess(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+        self.assertEqual(edge_t.phase_times["ttfb"], fetch_result)
+        self.assertEqual(sum(edge_t.phase_times.values()) - fetch_result -
+                         edge_t.phase_times["transfer"], edge_t.connect_time)
+
+    def test_verify_failed(self):
+        fetch_result, fetch_status = self._probe(self._engine(), local_sum="nope")
+        self.assertEqual(fetch_status, "verify_failed")
+        self.assertEqual(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+
+    def test_fetch_failed(self):
+        fetch_result, fetch_status = self._probe(self._engine(), path="/missing")
+        self.assertEqual(fetch_status, "fetch_failed")
+        self.assertEqual(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+
+    def test_body_too_large(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, local_size=len(TEST_OBJECT) - 1)
+        fetch_result, fetch_status = self._probe(self._engine(), edge_t=edge_t)
+        self.assertEqual(fetch_status, "verify_failed")
+
+    def test_etag_revalidation(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, conditional="etag")
+        self.assertEqual(self._probe(self._engine(), edge_t=edge_t)[1], None)
+        self.assertEqual(edge_t.etag, TEST_ETAG)
+        # The second fetch is answered with a 304
+        self.assertEqual(self._probe(self._engine(), edge_t=edge_t)[1], None)
+        edge_t.set_local_object("changed")
+        self.assertIsNone(edge_t.etag)
+
+    def test_range_probe(self):
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, conditional="range",
+                                     range_size=TEST_RANGE_SIZE, range_sum=TEST_RANGE_HASH)
+        self.assertEqual(self._probe(self._engine(), edge_t=edge_t)[1], None)
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, conditional="range",
+                                     range_size=TEST_RANGE_SIZE, range_sum="nope")
+        self.assertEqual(self._probe(self._engine(), edge_t=edge_t)[1], "verify_failed")
+
+    def test_connection_refused(self):
+        fetch_result, fetch_status = self._probe(self._engine(), port=self._closed_port())
+        self.assertEqual(fetch_status, "connect_failed")
+        self.assertEqual(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+
+    def test_ssl_contexts(self):
+        engine = self._engine()
+        self.assertEqual(engine.ssl_contexts[False].verify_mode, ssl.CERT_NONE)
+        self.assertEqual(engine.ssl_contexts[True].verify_mode, ssl.CERT_REQUIRED)
+        create_default_context = ssl.create_default_context
+        created = []
+
+        def count_contexts(*args, **kwargs):
+            created.append(args)
+            return create_default_context(*args, **kwargs)
+        ssl.create_default_context = count_contexts
+        try:
+            with engine:
+                futures = [engine.submit(edgemanage.EdgeTest(TEST_EDGE, TEST_HASH), "test.com",
+                                         "/test_object", "https", self.port, verify)
+                           for verify in (False, True, False)]
+                list(engine.as_completed(futures))
+        finally:
+            ssl.create_default_context = create_default_context
+        # The test server doesn't speak TLS, so the handshakes fail, but
+        # every probe got as far as using the engine's contexts
+        for future in futures:
+            self.assertEqual(future.result()[TEST_EDGE][0], edgemanage.const.FETCH_TIMEOUT)
+        self.assertEqual(created, [])
+
+    def test_cancel_queued(self):
+        engine = edgemanage.probeengine.EventLoopProbeEngine(1)
+        futures = [engine.submit(edgemanage.EdgeTest(TEST_EDGE, TEST_HASH), "test.com",
+                                 "/test_object", "http", self.port, False)
+                   for _ in range(3)]
+        with engine:
+            for future in engine.as_completed(futures):
+                # Only one probe runs at a time, so the rest are still queued
+                for other_future in futures:
+                    other_future.cancel()
+        self.assertEqual(len([future for future in futures if future.cancelled()]), 2)
+
+
+class ThreadedProbeEngineTest(ProbeEngineTemplate):
+
+    def test_fetch(self):
+        fetch_result, fetch_status = self._probe(
+            edgemanage.probeengine.ThreadedProbeEngine(2))
+        self.assertIsNone(fetch_status)
+        self.assertLess(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+
+    def test_get_probe_engine(self):
+        engine = edgemanage.get_probe_engine({"workers": 2})
+        self.assertIsInstance(engine, edgemanage.probeengine.ThreadedProbeEngine)
+        engine.shutdown()
+        engine = edgemanage.get_probe_engine({"workers": 2, "probe_engine": "eventloop"})
+        self.assertIsInstance(engine, edgemanage.probeengine.EventLoopProbeEngine)
+        engine.shutdown()
+        self.assertRaises(ValueError, edgemanage.get_probe_engine,
+                          {"workers": 2, "probe_engine": "carrier_pigeon"})
+
+
+class ProbeSchedulerTest(ProbeEngineTemplate):
+
+    def _results(self, engine, edgetests, path="/test_object", port=None, **kwargs):
+        hedge_delay = kwargs.pop("hedge_delay", None)
+        with engine:
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine, **kwargs)
+            for edge_t in edgetests:
+                scheduler.add(edge_t, "test.com", path, "http", port or self.port, False,
+                              hedge_delay=hedge_delay)
+            return scheduler, list(scheduler.results())
+
+    def test_fetch(self):
+        for engine in (edgemanage.probeengine.ThreadedProbeEngine(2),
+                       edgemanage.probeengine.EventLoopProbeEngine(10)):
+            edgetests = [edgemanage.EdgeTest(TEST_EDGE, TEST_HASH),
+                         edgemanage.EdgeTest("localhost", TEST_HASH)]
+            _, results = self._results(engine, edgetests)
+            self.assertEqual(sorted([result[0].edgename for result in results]),
+                             ["127.0.0.1", "localhost"])
+            for _, fetch_result, fetch_status in results:
+                self.assertIsNone(fetch_status)
+                self.assertLess(fetch_result, edgemanage.const.FETCH_TIMEOUT)
+
+    def test_retry(self):
+        for engine in (edgemanage.probeengine.ThreadedProbeEngine(2),
+                       edgemanage.probeengine.EventLoopProbeEngine(10)):
+            edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+            scheduler, results = self._results(engine, [edge_t], port=self._closed_port(),
+                                               max_attempts=3, retry_backoff=0.01)
+            # Giving up on connecting is a timeout, as it always was
+            self.assertEqual(results, [(edge_t, edgemanage.const.FETCH_TIMEOUT, None)])
+            self.assertEqual(scheduler.tasks[TEST_EDGE].attempts, 3)
+
+    def test_retry_after_queueing(self):
+        with edgemanage.probeengine.ThreadedProbeEngine(1) as engine:
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine, max_attempts=3,
+                                                              retry_backoff=0.01)
+            edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+            scheduler.add(edge_t, "test.com", "/test_object", "http",
+                          self._closed_port(), False)
+            # As if the edge had waited behind others for a worker for
+            # longer than a fetch could ever take
+            scheduler.tasks[TEST_EDGE].started -= edgemanage.const.FETCH_TIMEOUT * 2
+            results = list(scheduler.results())
+        self.assertEqual(results, [(edge_t, edgemanage.const.FETCH_TIMEOUT, None)])
+        self.assertEqual(scheduler.tasks[TEST_EDGE].attempts, 3)
+
+    def test_hedge(self):
+        for engine in (edgemanage.probeengine.ThreadedProbeEngine(2),
+                       edgemanage.probeengine.EventLoopProbeEngine(10)):
+            ObjectHandler.slow_requests = 0
+            edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+            start = time.time()
+            scheduler, results = self._results(engine, [edge_t], path="/slow_object",
+                                               hedge_delay=0.1)
+            hedge_t, fetch_result, fetch_status = results[0]
+            self.assertTrue(scheduler.tasks[TEST_EDGE].hedged)
+            self.assertIsNot(hedge_t, edge_t)
+            self.assertIsNone(fetch_status)
+            self.assertLess(fetch_result, 1)
+            self.assertLess(time.time() - start, 5)
+
+    def test_hedge_validators(self):
+        for engine in (edgemanage.probeengine.ThreadedProbeEngine(2),
+                       edgemanage.probeengine.EventLoopProbeEngine(10)):
+            ObjectHandler.slow_requests = 0
+            edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH, conditional="etag")
+            _, results = self._results(engine, [edge_t], path="/slow_object",
+                                       hedge_delay=0.1)
+            self.assertIsNot(results[0][0], edge_t)
+            # The ETag the hedge got is sent with the next fetch
+            self.assertEqual(edge_t.etag, TEST_ETAG)
+            self.assertEqual(edge_t.request_headers("test.com")["If-None-Match"], TEST_ETAG)
+
+    def test_start_delay(self):
+        engine = edgemanage.probeengine.ThreadedProbeEngine(2)
+        edgetests = [edgemanage.EdgeTest(TEST_EDGE, TEST_HASH),
+                     edgemanage.EdgeTest("localhost", TEST_HASH)]
+        start = time.time()
+        with engine:
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine)
+            for edge_t, start_delay in zip(edgetests, (0, 0.3)):
+                scheduler.add(edge_t, "test.com", "/test_object", "http", self.port, False,
+                              start_delay=start_delay)
+            results = list(scheduler.results())
+        self.assertEqual([result[0] for result in results], edgetests)
+        self.assertGreaterEqual(scheduler.tasks["localhost"].started - start, 0.3)
+        self.assertLess(scheduler.tasks[TEST_EDGE].started - start, 0.3)
+
+    def test_cancel_delayed(self):
+        engine = edgemanage.probeengine.ThreadedProbeEngine(2)
+        with engine:
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine)
+            scheduler.add(edgemanage.EdgeTest(TEST_EDGE, TEST_HASH), "test.com",
+                          "/test_object", "http", self.port, False, start_delay=10)
+            self.assertEqual(scheduler.cancel([TEST_EDGE]), (1, 1))
+            start = time.time()
+            self.assertEqual(list(scheduler.results()), [])
+        # The scheduler doesn't wait around for the start of cancelled tests
+        self.assertLess(time.time() - start, 1)
+
+    def test_outstanding(self):
+        for engine in (edgemanage.probeengine.ThreadedProbeEngine(1),
+                       edgemanage.probeengine.EventLoopProbeEngine(1)):
+            with engine:
+                scheduler = edgemanage.probeengine.ProbeScheduler(engine)
+                for edgename, start_delay in ((TEST_EDGE, 0), ("localhost", 0), ("::1", 10)):
+                    scheduler.add(edgemanage.EdgeTest(edgename, TEST_HASH), "test.com",
+                                  "/test_object", "http", self.port, False,
+                                  start_delay=start_delay)
+                self.assertLessEqual(engine.outstanding(), 2)
+                self.assertEqual(scheduler.waiting(), 1)
+                scheduler.cancel(["::1"])
+                self.assertEqual(scheduler.waiting(), 0)
+                self.assertEqual(len(list(scheduler.results())), 2)
+            self.assertEqual(engine.outstanding(), 0)
+
+    def test_cancel(self):
+        engine = edgemanage.probeengine.EventLoopProbeEngine(1)
+        edge_t = edgemanage.EdgeTest(TEST_EDGE, TEST_HASH)
+        with engine:
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine)
+            for edgetest in (edge_t, edgemanage.EdgeTest("localhost", TEST_HASH)):
+                scheduler.add(edgetest, "test.com", "/test_object", "http", self.port, False)
+            # Nothing has started yet, so the fetch is cancelled
+            self.assertEqual(scheduler.cancel(["localhost"]), (1, 1))
+            results = list(scheduler.results())
+        self.assertEqual([result[0] for result in results], [edge_t])
+
+    def test_shared_engine(self):
+        # Schedulers on separate threads take turns running the loop
+        engine = edgemanage.probeengine.EventLoopProbeEngine(10)
+        results = {}
+
+        def run_scheduler(name):
+            scheduler = edgemanage.probeengine.ProbeScheduler(engine)
+            for edgename in (TEST_EDGE, "localhost"):
+                scheduler.add(edgemanage.EdgeTest(edgename, TEST_HASH), "test.com",
+                              "/test_object", "http", self.port, False)
+            results[name] = list(scheduler.results())
+
+        with engine:
+            threads = [threading.Thread(target=run_scheduler, args=(name,))
+                       for name in ("dnet1", "dnet2")]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+        for name in ("dnet1", "dnet2"):
+            self.assertEqual(len(results[name]), 2)
+            for _, fetch_result, fetch_status in results[name]:
+                self.assertIsNone(fetch_status)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+
+from .context import edgemanage
+
+CONFIG = {
+    "goodenough": 0.7,
+    "edge_count": 1,
+    "dnet_edge_count": {},
+    "dnschange_maxfreq": 1,
+    "run_frequency": 60,
+}
+
+
+class ReplayTest(unittest.TestCase):
+
+    def _samples(self, edge2_offset=1):
+        # edge1 is fast for the first hour and then times out, edge2 is
+        # always fast enough
+        samples = []
+        for minute in range(120):
+            timestamp = 1000000.0 + minute * 60
+            if minute < 60:
+                samples.append((timestamp, "edge1", 0.1, None))
+            else:
+                samples.append((timestamp, "edge1", edgemanage.const.FETCH_TIMEOUT, None))
+            samples.append((timestamp + edge2_offset, "edge2", 0.2, None))
+        return samples
+
+    def test_replay(self):
+        summary = edgemanage.replay.Replay(CONFIG).run(self._samples())
+        self.assertEqual(summary["decisions"], 120)
+        # Into rotation at the start, and swapped an hour later
+        self.assertEqual(summary["rotations"], 2)
+        self.assertEqual(summary["zone_rewrites"], 2)
+        self.assertEqual(summary["edges"]["edge1"]["rotations"], 1)
+        self.assertEqual(summary["edges"]["edge2"]["rotations"], 1)
+        self.assertEqual(summary["edges"]["edge1"]["time_in_rotation"] +
+                         summary["edges"]["edge2"]["time_in_rotation"], 120 * 60)
+        self.assertAlmostEqual(summary["edges"]["edge1"]["time_in_rotation"], 3600, delta=120)
+
+    def test_gap(self):
+        samples = self._samples()
+        # Nothing was tested for a day in the middle
+        samples = samples[:40] + [(timestamp + 86400, edgename, value, phase_times)
+                                  for timestamp, edgename, value, phase_times in samples[40:]]
+        summary = edgemanage.replay.Replay(CONFIG).run(samples)
+        # No decisions are made during the gap, once the samples from
+        # before it are two intervals old
+        self.assertEqual(summary["decisions"], 122)
+        self.assertEqual(summary["edges"]["edge1"]["time_in_rotation"] +
+                         summary["edges"]["edge2"]["time_in_rotation"], 122 * 60)
+
+    def _counting_replay(self, interval=None):
+        ''' A Replay that counts the decisions it doesn't skip '''
+        replay = edgemanage.replay.Replay(CONFIG, interval=interval)
+        decide = replay._decide
+        replay.decided = 0
+
+        def count_decisions(edge_states):
+            replay.decided += 1
+            return decide(edge_states)
+        replay._decide = count_decisions
+        return replay
+
+    def test_unchanged_intervals(self):
+        # Deciding every 30 seconds, with both edges sampled at once, so
+        # most decisions with no new samples only repeat the one before
+        samples = self._samples(edge2_offset=0)
+        replay = self._counting_replay(interval=30)
+
+        summary = replay.run(samples)
+        self.assertEqual(summary["decisions"], 238)
+        self.assertLess(replay.decided, 10)
+        self.assertEqual(summary["rotations"], 2)
+        self.assertEqual(summary["zone_rewrites"], 2)
+        self.assertEqual(summary["edges"]["edge1"]["time_in_rotation"] +
+                         summary["edges"]["edge2"]["time_in_rotation"], 238 * 30)
+        self.assertAlmostEqual(summary["edges"]["edge1"]["time_in_rotation"], 3600, delta=120)
+
+    def test_live_edges_passing(self):
+        # Every interval has new samples, but the live edge keeps
+        # passing the threshold for an hour at a time
+        replay = self._counting_replay()
+        summary = replay.run(self._samples())
+        self.assertEqual(summary["decisions"], 120)
+        self.assertLess(replay.decided, 10)
+        self.assertEqual(summary["rotations"], 2)
+        self.assertAlmostEqual(summary["edges"]["edge1"]["time_in_rotation"], 3600, delta=120)
+
+    def test_dnschange_period(self):
+        # The two rotations are an hour apart
+        summary = edgemanage.replay.Replay(CONFIG).run(self._samples())
+        self.assertEqual(summary["maxfreq_exceeded"], 0)
+        summary = edgemanage.replay.Replay(dict(CONFIG, dnschange_period=7200)).run(
+            self._samples())
+        self.assertEqual(summary["maxfreq_exceeded"], 1)
+
+    def test_read_samples(self):
+        samples = edgemanage.replay.read_samples(["# edgename timestamp value",
+                                                  "edge2 1001.5 0.25", "",
+                                                  "edge1 1000.5 0.5"])
+        self.assertEqual(samples, [(1000.5, "edge1", 0.5, None), (1001.5, "edge2", 0.25, None)])
+        self.assertRaises(ValueError, edgemanage.replay.read_samples, ["edge1 soon"])
+
+    def test_store_samples(self):
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = edgemanage.healthstore.JSONHealthStore(store_dir)
+            for edgename, value in [("edge1", 0.5), ("edge2", 0.25)]:
+                edge_state = edgemanage.EdgeState(edgename, store_dir, store=store)
+                edge_state.add_value(value, timestamp=1000.5)
+            self.assertEqual(edgemanage.replay.store_samples(store, ["edge2"]),
+                             [(1000.5, "edge2", 0.25, None)])
+        finally:
+            shutil.rmtree(store_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import unittest
+
+from .context import edgemanage
+
+
+class RollupsTest(unittest.TestCase):
+
+    def test_add(self):
+        rollups = edgemanage.rollup.Rollups()
+        # Two values in one minute and one the next, all in one hour
+        rollups.add(3600.0, 1.0)
+        rollups.add(3630.0, 3.0)
+        rollups.add(3660.0, 2.0)
+
+        minutes = rollups.summaries("minute")
+        self.assertEqual([(minute["start"], minute["count"]) for minute in minutes],
+                         [(3600.0, 2), (3660.0, 1)])
+        self.assertEqual(minutes[0]["mean"], 2.0)
+        self.assertEqual((minutes[0]["min"], minutes[0]["max"]), (1.0, 3.0))
+
+        hours = rollups.summaries("hour")
+        self.assertEqual(len(hours), 1)
+        self.assertEqual(hours[0]["count"], 3)
+        self.assertEqual(rollups.summaries("minute", since=3660.0)[0]["count"], 1)
+
+    def test_bounded(self):
+        rollups = edgemanage.rollup.Rollups()
+        for minute in range(200):
+            rollups.add(minute * 60.0, 1.0)
+        tiers = dict([(name, size) for name, length, size in edgemanage.const.ROLLUP_TIERS])
+        self.assertEqual(len(rollups.summaries("minute")), tiers["minute"])
+        self.assertEqual(rollups.summaries("minute")[-1]["start"], 199 * 60.0)
+        self.assertEqual(rollups.summaries("hour")[-1]["count"], 20)
+
+    def test_quantiles(self):
+        bucket = edgemanage.rollup.RollupBucket(0)
+        self.assertIsNone(bucket.quantile(50))
+        for i in range(1, 101):
+            bucket.add(i / 100.0)
+        self.assertAlmostEqual(bucket.quantile(50), 0.5, delta=0.5 * 0.06)
+        self.assertAlmostEqual(bucket.quantile(95), 0.95, delta=0.95 * 0.06)
+        self.assertEqual(bucket.quantile(100), 1.0)
+
+    def test_dict(self):
+        rollups = edgemanage.rollup.Rollups()
+        rollups.add(60.0, 0.5)
+        rollups.add(120.0, 10.0)
+        loaded = edgemanage.rollup.Rollups.from_dict(rollups.to_dict())
+        self.assertEqual(loaded.summaries("minute"), rollups.summaries("minute"))
+        self.assertEqual(loaded.summaries("day"), rollups.summaries("day"))
+
+if __name__ == '__main__':
+    unittest.main()
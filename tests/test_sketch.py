@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import unittest
+
+from .context import edgemanage
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def _assert_close(self, estimate, value):
+        self.assertTrue(abs(estimate - value) <= value * 0.06,
+                        "%f is not close to %f" % (estimate, value))
+
+    def test_quantile(self):
+        sketch = edgemanage.sketch.QuantileSketch()
+        self.assertEqual(sketch.quantile(50), None)
+        for i in range(1, 101):
+            sketch.add(i / 100.0)
+        self.assertEqual(sketch.count, 100)
+        self._assert_close(sketch.quantile(50), 0.5)
+        self._assert_close(sketch.quantile(95), 0.95)
+        self._assert_close(sketch.quantile(0), 0.01)
+
+    def test_remove_and_merge(self):
+        sketch = edgemanage.sketch.QuantileSketch()
+        other = edgemanage.sketch.QuantileSketch()
+        for i in range(10):
+            sketch.add(0.1)
+            other.add(2.0)
+        sketch.merge(other)
+        self._assert_close(sketch.quantile(90), 2.0)
+        for i in range(10):
+            sketch.remove(2.0)
+        self.assertEqual(sketch.count, 10)
+        self._assert_close(sketch.quantile(90), 0.1)
+
+    def test_dict(self):
+        sketch = edgemanage.sketch.QuantileSketch()
+        for value in [0.05, 0.2, 0.2, 5.0]:
+            sketch.add(value)
+        loaded = edgemanage.sketch.QuantileSketch.from_dict(sketch.to_dict())
+        self.assertEqual(loaded.bins, sketch.bins)
+        self.assertEqual(loaded.count, 4)
+
+    def test_series_sketches(self):
+        # The sketches of a TimeSeries follow its evictions and window
+        series = edgemanage.timeseries.TimeSeries(4)
+        for i in range(6):
+            series.append(float(i), float(i + 1))
+        self.assertEqual(series.sketch.count, 4)
+        self.assertEqual(series.summary_since(4.0), (2, 11.0))
+        self.assertEqual(series.since_sketch.count, 2)
+        self._assert_close(series.since_sketch.quantile(0), 5.0)
+
+if __name__ == '__main__':
+    unittest.main()
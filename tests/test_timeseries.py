@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import unittest
+
+from .context import edgemanage
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def test_append(self):
+        series = edgemanage.timeseries.TimeSeries(3)
+        self.assertIsNone(series.append(1.0, 1))
+        self.assertIsNone(series.append(2.0, 2))
+        self.assertIsNone(series.append(3.0, 3))
+        self.assertEqual(series.last(), 3)
+        self.assertEqual(series.average(), 2)
+
+        self.assertEqual(series.append(4.0, 6), (1.0, 1))
+        self.assertEqual(len(series), 3)
+        self.assertEqual(series.last(), 6)
+        self.assertEqual(series.average(), 11 / 3.0)
+        self.assertEqual(series.items(), [(2.0, 2), (3.0, 3), (4.0, 6)])
+        self.assertEqual(series.window(2.5, 4.0), {3.0: 3, 4.0: 6})
+        self.assertEqual(series["3.0"], 3)
+
+    def test_summary_since(self):
+        series = edgemanage.timeseries.TimeSeries(4)
+        for i in range(4):
+            series.append(float(i), i)
+        self.assertEqual(series.summary_since(2.0), (2, 5))
+        self.assertEqual(series.summary_since(0.5), (3, 6))
+        series.append(4.0, 4)
+        series.append(5.0, 5)
+        self.assertEqual(series.summary_since(3.0), (3, 12))
+        # Values rotated out are no longer counted
+        for i in range(6, 10):
+            series.append(float(i), i)
+        self.assertEqual(series.summary_since(0.0), (4, 30))
+        self.assertEqual(series.summary_since(10.0), (0, 0))
+
+    def test_dict(self):
+        series = edgemanage.timeseries.TimeSeries.from_dict(
+            2, {"1.5": 1.0, "3.5": 3.0, "2.5": 2.0})
+        self.assertEqual(series.items(), [(2.5, 2.0), (3.5, 3.0)])
+        self.assertEqual(series.to_dict(), {"2.5": 2.0, "3.5": 3.0})
+
+    def test_discard_until(self):
+        series = edgemanage.timeseries.TimeSeries(3)
+        for i in range(5):
+            series.append(float(i), i)
+        series.discard_until(2.0)
+        self.assertEqual(series.items(), [(3.0, 3), (4.0, 4)])
+        self.assertEqual(series.average(), 3.5)
+
+    def test_floors(self):
+        series = edgemanage.timeseries.TimeSeries(3)
+        series.append(1.0, 3.0)
+        series.append(2.0, 6.0)
+        self.assertEqual(series.average_floor(), 3.0)
+        series.append(3.0, 6.0)
+        # Appending to a full series evicts its oldest value
+        self.assertEqual(series.average_floor(), 4.0)
+        self.assertLess(series.quantile_floor(30), 1.0)
+        self.assertGreater(series.quantile_floor(50), 5.0)
+
+    def test_ewma(self):
+        series = edgemanage.timeseries.TimeSeries(2)
+        self.assertIsNone(series.ewma(10))
+        series.append(0.0, 1.0)
+        series.append(10.0, 4.0)
+        # The older value counts half as much
+        self.assertEqual(series.ewma(10), 3.0)
+        # Evicted values still count
+        series.append(20.0, 4.0)
+        self.assertAlmostEqual(series.ewma(10), (1 * 0.25 + 4 * 0.5 + 4) / 1.75)
+        ewma = series.ewma(10)
+        series.discard_until(10.0)
+        self.assertEqual(series.ewma(10), ewma)
+        copy = edgemanage.timeseries.TimeSeries(2)
+        copy.set_ewma(*series.ewma_state())
+        self.assertEqual(copy.ewma(10), ewma)
+        self.assertLess(series.ewma_floor(10, 30.0), series.ewma_floor(10, 20.0))
+        # A different half-life is worked out from the values kept
+        self.assertEqual(series.ewma(5), 4.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 import unittest
 from .context import edgemanage
 
+import shutil
 import tempfile
 import subprocess
 
@@ -36,5 +37,26 @@ class UtilTest(unittest.TestCase):
             self.assertEqual(returncode, 0,
                              msg="Could lock already locked temporary file")
 
+    def test_acquire_store_lock(self):
+        store_dir = tempfile.mkdtemp()
+        try:
+            lock_f = edgemanage.util.acquire_store_lock(store_dir)
+            self.assertIsNotNone(lock_f)
+            # flocks are held by the open file, so a second open of the
+            # lock file is refused even in the same process
+            self.assertIsNone(edgemanage.util.acquire_store_lock(store_dir))
+            lock_f.close()
+            lock_f = edgemanage.util.acquire_store_lock(store_dir)
+            self.assertIsNotNone(lock_f)
+            lock_f.close()
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_dnet_lockfile(self):
+        self.assertEqual(edgemanage.util.dnet_lockfile("/var/lock/em.lock", "dnet1"),
+                         "/var/lock/em.lock.dnet1")
+        self.assertEqual(edgemanage.util.dnet_lockfile("/var/lock/{dnet}.lock", "dnet1"),
+                         "/var/lock/dnet1.lock")
+
 if __name__ == '__main__':
     unittest.main()